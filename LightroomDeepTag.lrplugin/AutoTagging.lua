@@ -4,20 +4,30 @@ local LrApplication   = import("LrApplication")
 local LrFileUtils     = import("LrFileUtils")
 local LrPathUtils     = import("LrPathUtils")
 local LrStringUtils   = import("LrStringUtils")
+local LrProgressScope = import("LrProgressScope")
 local json            = require("json")
-local TaggingService  = require("TaggingServiceClip")
-
--- Helper: manually find or create a keyword by name
-local function getOrCreateKeyword(catalog, name)
-    -- search all existing keywords
-    for _, kw in ipairs(catalog:getKeywords()) do
-        if kw:getName() == name then
-            return kw
-        end
-    end
-    -- not found, so create
-    return catalog:createKeyword(name, {}, false, nil)
-end
+local KeywordApplier  = require("KeywordApplier")
+local TaggingState    = require("TaggingState")
+
+-- "clip" (fast), "blip" (captions, slow) or "hybrid" (CLIP, then BLIP only for photos CLIP is unsure about).
+-- blip and hybrid also need transformers, sentence-transformers and the BLIP weights.
+local ENGINE = "clip"
+local SERVICES = {
+    clip = "TaggingServiceClip",
+    blip = "TaggingServiceBlip",
+    hybrid = "TaggingServiceHybrid",
+}
+local TaggingService  = require(SERVICES[ENGINE])
+
+-- Only send photos whose file, models, taxonomy or settings changed since their last run
+local INCREMENTAL = true
+
+-- Classify one photo per burst / group of near-duplicates and give the rest its tags.
+-- Off by default: near-identical frames then share tags instead of being tagged on their own.
+local DEDUPE = false
+
+-- How many failed photos to name in the completion dialog
+local MAX_LISTED_FAILURES = 5
 
 local function runBatchTagging()
     local catalog = LrApplication.activeCatalog()
@@ -35,71 +45,144 @@ local function runBatchTagging()
 
     if response == "ok" then
         LrTasks.startAsyncTask(function()
-            -- 1) Gather all photo paths
+            -- 1) Gather all photo paths (one catalog call, which matters for large selections),
+            --    and map file paths to Lightroom photo objects for quick lookup
             local photoPaths = {}
-            for i, photo in ipairs(selectedPhotos) do
-                local path = photo:getRawMetadata("path")
+            local pathToPhoto = {}
+            local metadata = catalog:batchGetRawMetadata(selectedPhotos, { "path" })
+            for _, photo in ipairs(selectedPhotos) do
+                local path = metadata[photo].path
                 table.insert(photoPaths, path)
+                pathToPhoto[path] = photo
             end
 
-            -- 2) Create a temporary JSON file with all image paths
+            -- 2) Create a temporary NDJSON file with one image path per line,
+            --    so Python can start on the first photos while it reads the rest
             local tempFolder = LrPathUtils.getStandardFilePath("temp")
-            local jsonFile = LrPathUtils.child(tempFolder, "photo_paths.json")
+            local jsonFile = LrPathUtils.child(tempFolder, "photo_paths.ndjson")
 
-            -- Convert photoPaths (Lua table) to JSON string
-            local jsonString = json.encode(photoPaths)
-
-            -- Write the JSON string to a temp file (using standard Lua I/O)
+            -- Write the paths (using standard Lua I/O)
             local file = io.open(jsonFile, "w")
             if file then
-                file:write(jsonString)
+                for _, path in ipairs(photoPaths) do
+                    file:write(json.encode(path), "\n")
+                end
                 file:close()
             else
                 LrDialogs.message("Error", "Failed to open file for writing: " .. jsonFile, "critical")
                 return
             end
 
-            -- 3) Call the TaggingService to process the single JSON file
-            local results = TaggingService.getTagsForImages(jsonFile)
-            if not results or #results == 0 then
-                LrDialogs.message("No results returned", "Check the Python script for errors.", "warning")
-                return
-            end
+            local progress = LrProgressScope({ title = "AI Auto-Tagging " .. #selectedPhotos .. " photo(s)" })
+            local applier = KeywordApplier.new(catalog)
+            progress:setCancelable(true)
+            local processed = 0
+            -- Photos per stage ("clip", "blip", "skipped"), hybrid engine only
+            local stages = {}
+            -- Photos Python returned a result for, to forget again if the run is canceled
+            local resultPaths = {}
+            -- Near-duplicates that got their group's tags instead of being classified
+            local duplicates = 0
+            -- Photos Python couldn't tag ({ path, error, message }), and how many per error code
+            local failures = {}
+            local failuresByCode = {}
 
-            -- Map file paths to Lightroom photo objects for quick lookup
-            local pathToPhoto = {}
-            for _, photo in ipairs(selectedPhotos) do
-                local p = photo:getRawMetadata("path")
-                pathToPhoto[p] = photo
-            end
+            -- 3) Call the TaggingService, applying keywords as each result arrives
+            local completed, timing = TaggingService.streamTagsForImages(jsonFile, function(entry)
+                processed = processed + 1
+                table.insert(resultPaths, entry.image_path)
+                if entry.stage then
+                    stages[entry.stage] = (stages[entry.stage] or 0) + 1
+                end
+                if entry.duplicate_of then
+                    duplicates = duplicates + 1
+                end
+                progress:setPortionComplete(processed, #selectedPhotos)
+                progress:setCaption(LrPathUtils.leafName(entry.image_path or ""))
+
+                -- Once canceled, let Python finish but stop touching the catalog
+                if progress:isCanceled() then
+                    return
+                end
 
-            -- 4) Process each photo in its own withWriteAccessDo
-            for _, entry in ipairs(results) do
-                local p = entry.image_path
-                local photo = pathToPhoto[p]
+                -- A failed photo keeps its keywords; it is only reported
+                if entry.status == "error" then
+                    table.insert(failures, { path = entry.image_path, error = entry.error, message = entry.message })
+                    failuresByCode[entry.error] = (failuresByCode[entry.error] or 0) + 1
+                    return
+                end
+
+                local photo = pathToPhoto[entry.image_path]
                 if photo and entry.tags then
-                    -- One photo per transaction
-                    catalog:withWriteAccessDo("Apply AI Keywords to single photo", function()
-                        -- 1) Remove existing lds_ keywords
-                        local existingKeywords = photo:getRawMetadata("keywords") or {}
-                        for _, kwObj in ipairs(existingKeywords) do
-                            local kwName = kwObj:getName()
-                            if string.find(kwName, "^lds_") then
-                                photo:removeKeyword(kwObj)
-                            end
-                        end
-
-                        -- 2) Add new lds_ keywords
-                        for _, tagName in ipairs(entry.tags) do
-                            local prefixedTagName = "lds_" .. tagName
-                            local kw = getOrCreateKeyword(catalog, prefixedTagName)
-                            photo:addKeyword(kw)
-                        end
-                    end)
+                    -- Both engines return {name, score} pairs, best first
+                    local tagNames = {}
+                    local scoreParts = {}
+                    for _, tag in ipairs(entry.tags) do
+                        table.insert(tagNames, tag[1])
+                        table.insert(scoreParts, string.format("%s %.2f", tag[1], tag[2]))
+                    end
+                    -- Written in chunks of KeywordApplier.chunkSize photos per transaction
+                    applier:add(photo, tagNames, table.concat(scoreParts, ", "))
+                end
+            end, { incremental = INCREMENTAL, dedupe = DEDUPE })
+
+            local canceled = progress:isCanceled()
+            if not canceled then
+                applier:flush()
+            end
+            progress:done()
+
+            if canceled then
+                -- Results that weren't applied must not count as done next time
+                if INCREMENTAL then
+                    TaggingState.forget(resultPaths)
                 end
+                LrDialogs.message("AI Auto-Tagging Canceled", "Stopped applying keywords.\n" .. applier:summary(), "info")
+                return
+            end
+            -- Incremental runs return nothing for unchanged photos
+            local unchanged = INCREMENTAL and completed and (#selectedPhotos - processed) or 0
+            if processed == 0 then
+                if unchanged > 0 then
+                    LrDialogs.message("Nothing to tag", unchanged .. " photo(s) unchanged since their last run.", "info")
+                elseif completed then
+                    LrDialogs.message("No results returned", "Check the Python script for errors.", "warning")
+                end
+                return
             end
 
-            LrDialogs.message("Batch AI Auto-Tagging Complete", "Keywords have been applied to the selected photos.", "info")
+            local summary = applier:summary()
+            if not completed then
+                summary = summary .. "\nPython stopped early; photos without a result were left as they were."
+            end
+            if #failures > 0 then
+                local codes = {}
+                for code, count in pairs(failuresByCode) do
+                    table.insert(codes, string.format("%s: %d", code, count))
+                end
+                table.sort(codes)
+                summary = summary .. string.format("\n%d photo(s) could not be tagged (%s):", #failures, table.concat(codes, ", "))
+                for i = 1, math.min(#failures, MAX_LISTED_FAILURES) do
+                    summary = summary .. "\n  " .. LrPathUtils.leafName(failures[i].path or "") .. " - " .. (failures[i].message or failures[i].error or "")
+                end
+                if #failures > MAX_LISTED_FAILURES then
+                    summary = summary .. string.format("\n  ... and %d more", #failures - MAX_LISTED_FAILURES)
+                end
+            end
+            if unchanged > 0 then
+                summary = summary .. string.format("\n%d unchanged photo(s) skipped.", unchanged)
+            end
+            if duplicates > 0 then
+                summary = summary .. string.format("\n%d near-duplicate photo(s) got their burst's tags.", duplicates)
+            end
+            if next(stages) then
+                summary = summary .. string.format("\nTagged by CLIP: %d, re-tagged by BLIP: %d, skipped: %d.",
+                    stages.clip or 0, stages.blip or 0, stages.skipped or 0)
+            end
+            if timing then
+                summary = summary .. "\n" .. timing
+            end
+            LrDialogs.message("Batch AI Auto-Tagging Complete", "Keywords have been applied to the selected photos.\n" .. summary, "info")
         end)
     end
 end
@@ -0,0 +1,31 @@
+local LrDialogs       = import("LrDialogs")
+local LrTasks         = import("LrTasks")
+local LrApplication   = import("LrApplication")
+local LrPathUtils     = import("LrPathUtils")
+local LrProgressScope = import("LrProgressScope")
+local PhotoSearch     = require("PhotoSearch")
+
+local function findSimilarPhotos()
+    local catalog = LrApplication.activeCatalog()
+    local photo = catalog:getTargetPhoto()
+    if not photo then
+        LrDialogs.message("No photo selected!", "Please select the photo to find similar ones to.", "info")
+        return
+    end
+
+    local path = photo:getRawMetadata("path")
+    local progress = LrProgressScope({ title = "Finding photos similar to " .. LrPathUtils.leafName(path) })
+    local results = PhotoSearch.run({ image_path = path })
+    progress:done()
+
+    if not results then
+        LrDialogs.message("Search Failed", "Check the Python script for errors.", "critical")
+        return
+    end
+    local found = PhotoSearch.showResults("Similar to " .. LrPathUtils.leafName(path), results)
+    if found == 0 then
+        LrDialogs.message("No photos found", "Tag photos with the CLIP or hybrid engine first; search only covers tagged photos.", "info")
+    end
+end
+
+LrTasks.startAsyncTask(findSimilarPhotos)
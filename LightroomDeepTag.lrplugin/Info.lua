@@ -4,10 +4,20 @@ return {
     LrToolkitIdentifier = "com.nickskupien.lightroomphotocategorizer",
     LrPluginInfoUrl = "https://github.com/nickskupien/lightroom-plugin-photo-categorizer",
 
+    LrMetadataProvider = "TagMetadata.lua",
+
     LrExportMenuItems = {
         {
             title = "Categorize Photos",
             file = "AutoTagging.lua"
+        },
+        {
+            title = "Search Photos by Description...",
+            file = "SearchPhotos.lua"
+        },
+        {
+            title = "Find Similar Photos",
+            file = "FindSimilarPhotos.lua"
         }
     }
 }
\ No newline at end of file
@@ -0,0 +1,144 @@
+local LrDate = import "LrDate"
+
+-- Applies lds_ keywords to photos in bulk:
+--   * all existing keywords are indexed by name once, instead of scanning
+--     catalog:getKeywords() for every tag of every photo
+--   * photos are written in chunks, one withWriteAccessDo per chunk
+--   * photos whose lds_ keywords already match the new result are skipped
+--   * the tag scores go to the plugin's "tagScores" field (see TagMetadata.lua)
+local KeywordApplier = {}
+KeywordApplier.__index = KeywordApplier
+
+KeywordApplier.prefix = "lds_"
+
+KeywordApplier.scoreField = "tagScores"
+
+-- Photos per write transaction
+KeywordApplier.chunkSize = 200
+
+function KeywordApplier.new(catalog)
+    local self = setmetatable({}, KeywordApplier)
+    self.catalog = catalog
+    self.pending = {}
+    self.updated = 0
+    self.unchanged = 0
+    self.writeSeconds = 0
+
+    -- name -> keyword index, built once per run
+    local started = LrDate.currentTime()
+    self.keywordsByName = {}
+    for _, kw in ipairs(catalog:getKeywords()) do
+        self.keywordsByName[kw:getName()] = kw
+    end
+    self.writeSeconds = LrDate.currentTime() - started
+
+    return self
+end
+
+-- Queues a photo with its new tag names and score text; writes a chunk once enough are queued
+function KeywordApplier:add(photo, tagNames, scoreText)
+    table.insert(self.pending, { photo = photo, tagNames = tagNames, scoreText = scoreText or "" })
+    if #self.pending >= KeywordApplier.chunkSize then
+        self:flush()
+    end
+end
+
+local function existingPrefixedKeywords(keywords)
+    local byName = {}
+    for _, kw in ipairs(keywords or {}) do
+        local name = kw:getName()
+        if string.sub(name, 1, #KeywordApplier.prefix) == KeywordApplier.prefix then
+            byName[name] = kw
+        end
+    end
+    return byName
+end
+
+local function sameNames(existing, wanted)
+    for name in pairs(existing) do
+        if not wanted[name] then
+            return false
+        end
+    end
+    for name in pairs(wanted) do
+        if not existing[name] then
+            return false
+        end
+    end
+    return true
+end
+
+-- Writes every queued photo in one transaction
+function KeywordApplier:flush()
+    if #self.pending == 0 then
+        return
+    end
+
+    local started = LrDate.currentTime()
+    local chunk = self.pending
+    self.pending = {}
+
+    -- Read current keywords for the whole chunk in one call
+    local photos = {}
+    for i, item in ipairs(chunk) do
+        photos[i] = item.photo
+    end
+    local metadata = self.catalog:batchGetRawMetadata(photos, { "keywords" })
+    local scores = self.catalog:batchGetPropertyForPlugin(photos, _PLUGIN, { KeywordApplier.scoreField })
+
+    local changes = {}
+    for _, item in ipairs(chunk) do
+        local wanted = {}
+        for _, tagName in ipairs(item.tagNames) do
+            wanted[KeywordApplier.prefix .. tagName] = true
+        end
+        local existing = existingPrefixedKeywords(metadata[item.photo] and metadata[item.photo].keywords)
+        local existingScores = scores[item.photo] and scores[item.photo][KeywordApplier.scoreField] or ""
+
+        if sameNames(existing, wanted) and existingScores == item.scoreText then
+            self.unchanged = self.unchanged + 1
+        else
+            table.insert(changes, { photo = item.photo, existing = existing, wanted = wanted, scoreText = item.scoreText })
+        end
+    end
+
+    if #changes > 0 then
+        self.catalog:withWriteAccessDo("Apply AI Keywords", function()
+            for _, change in ipairs(changes) do
+                -- 1) Remove lds_ keywords that are no longer wanted
+                for name, kw in pairs(change.existing) do
+                    if not change.wanted[name] then
+                        change.photo:removeKeyword(kw)
+                    end
+                end
+
+                -- 2) Add new lds_ keywords, creating each missing one only once per run
+                for name in pairs(change.wanted) do
+                    if not change.existing[name] then
+                        local kw = self.keywordsByName[name]
+                        if not kw then
+                            kw = self.catalog:createKeyword(name, {}, false, nil, true)
+                            self.keywordsByName[name] = kw
+                        end
+                        change.photo:addKeyword(kw)
+                    end
+                end
+
+                -- 3) Record the scores next to the keywords
+                change.photo:setPropertyForPlugin(_PLUGIN, KeywordApplier.scoreField, change.scoreText)
+            end
+        end)
+        self.updated = self.updated + #changes
+    end
+
+    self.writeSeconds = self.writeSeconds + (LrDate.currentTime() - started)
+end
+
+function KeywordApplier:summary()
+    return string.format(
+        "%d photo(s) updated, %d already up to date. Keyword write phase: %.1fs.",
+        self.updated, self.unchanged, self.writeSeconds
+    )
+end
+
+return KeywordApplier
@@ -0,0 +1,84 @@
+local LrTasks = import "LrTasks"
+local LrFileUtils = import "LrFileUtils"
+local json = require "json"
+
+-- Follows a results file that Python appends one JSON object per line to,
+-- handing each entry to Lua as soon as its line is complete.
+local NdjsonStream = {}
+
+-- How often to look for new lines while the producer is running (seconds)
+NdjsonStream.pollInterval = 0.25
+
+-- Runs `producer` (a function that blocks until outputFile is complete, e.g.
+-- LrTasks.execute of the Python script) on a background task, and calls
+-- onEntry(entry) for every decoded line meanwhile.
+-- Returns whatever `producer` returned, or nil plus the error if it failed.
+function NdjsonStream.follow(outputFile, producer, onEntry)
+    -- Never pick up lines left over from a previous run
+    if LrFileUtils.exists(outputFile) then
+        LrFileUtils.delete(outputFile)
+    end
+
+    local finished = false
+    local producerResult, producerError
+    LrTasks.startAsyncTask(function()
+        local ok, result = LrTasks.pcall(producer)
+        if ok then
+            producerResult = result
+        else
+            producerError = result
+        end
+        finished = true
+    end)
+
+    local position = 0
+    local buffer = ""
+
+    local function drain()
+        local file = io.open(outputFile, "rb")
+        if not file then
+            return
+        end
+        file:seek("set", position)
+        local chunk = file:read("*a")
+        position = file:seek()
+        file:close()
+
+        if not chunk or #chunk == 0 then
+            return
+        end
+
+        -- Only complete lines are decoded; a partial last line waits for the next poll
+        buffer = buffer .. chunk
+        while true do
+            local newline = string.find(buffer, "\n", 1, true)
+            if not newline then
+                break
+            end
+            local line = string.sub(buffer, 1, newline - 1)
+            buffer = string.sub(buffer, newline + 1)
+            if #line > 0 then
+                local success, entry = pcall(json.decode, line)
+                if success and type(entry) == "table" then
+                    onEntry(entry)
+                end
+            end
+        end
+    end
+
+    while not finished do
+        drain()
+        LrTasks.sleep(NdjsonStream.pollInterval)
+    end
+    drain()
+
+    return producerResult, producerError
+end
+
+-- True if outputFile has any content yet, i.e. some results were handed over already
+function NdjsonStream.hasOutput(outputFile)
+    local attributes = LrFileUtils.fileAttributes(outputFile)
+    return attributes ~= nil and (attributes.fileSize or 0) > 0
+end
+
+return NdjsonStream
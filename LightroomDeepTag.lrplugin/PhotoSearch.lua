@@ -0,0 +1,99 @@
+local LrApplication = import "LrApplication"
+local LrTasks = import "LrTasks"
+local LrPathUtils = import "LrPathUtils"
+local TaggingServer = require "TaggingServer"
+local json = require "json"
+
+-- Finds photos by text or by a reference photo among the photos already tagged
+-- with the CLIP or hybrid engine (photo_search.py), without running the image
+-- model over the library again, and collects them in a Lightroom collection.
+local PhotoSearch = {}
+
+-- Photos per search
+PhotoSearch.top = 100
+
+-- Collection set the search collections are created in
+PhotoSearch.collectionSetName = "AI Search"
+
+-- request is { query = "..." } or { image_path = "..." }.
+-- Returns a list of { image_path = ..., score = ... }, best first, or nil if the search failed.
+function PhotoSearch.run(request)
+    request.top = request.top or PhotoSearch.top
+
+    -- The warm tagging server has CLIP loaded already
+    if TaggingServer.isRunning() then
+        local response = TaggingServer.search(request)
+        if response then
+            return response.results or {}
+        end
+    end
+
+    local tempFolder = LrPathUtils.getStandardFilePath("temp")
+    local outputFile = LrPathUtils.child(tempFolder, "photo_search.json")
+    local queryArgument
+    if request.query then
+        -- Passed in a file, so the query text never goes through the shell
+        local queryFile = LrPathUtils.child(tempFolder, "photo_search_query.txt")
+        local file = io.open(queryFile, "w")
+        if not file then
+            return nil
+        end
+        file:write(request.query)
+        file:close()
+        queryArgument = string.format('--query-file "%s"', queryFile)
+    else
+        queryArgument = string.format('--image "%s"', request.image_path)
+    end
+
+    local command = string.format(
+        '"%s" "%s" %s --top %d > "%s"',
+        LrPathUtils.child(_PLUGIN.path, "venv/bin/python3"),
+        LrPathUtils.child(_PLUGIN.path, "photo_search.py"),
+        queryArgument,
+        request.top,
+        outputFile
+    )
+    if LrTasks.execute(command) ~= 0 then
+        return nil
+    end
+
+    local file = io.open(outputFile, "r")
+    if not file then
+        return nil
+    end
+    local text = file:read("*a")
+    file:close()
+    local success, results = pcall(json.decode, text)
+    if success and type(results) == "table" then
+        return results
+    end
+    return nil
+end
+
+-- Fills the collection `name` (created if needed, emptied otherwise) with the
+-- results' photos and shows it. Returns how many of them are in the catalog.
+function PhotoSearch.showResults(name, results)
+    local catalog = LrApplication.activeCatalog()
+    local photos = {}
+    for _, entry in ipairs(results) do
+        local photo = catalog:findPhotoByPath(entry.image_path)
+        if photo then
+            table.insert(photos, photo)
+        end
+    end
+    if #photos == 0 then
+        return 0
+    end
+
+    local collection
+    catalog:withWriteAccessDo("AI Search", function()
+        local set = catalog:createCollectionSet(PhotoSearch.collectionSetName, nil, true)
+        collection = catalog:createCollection(name, set, true)
+        collection:removeAllPhotos()
+        collection:addPhotos(photos)
+    end)
+    catalog:setActiveSources({ collection })
+    return #photos
+end
+
+return PhotoSearch
@@ -0,0 +1,34 @@
+local LrPathUtils = import "LrPathUtils"
+local LrFileUtils = import "LrFileUtils"
+local json = require "json"
+
+-- Reads the timing sidecar the classifier scripts and the tagging server write
+-- with --metrics / "metrics_file" (see run_metrics.py).
+local RunMetrics = {}
+
+-- Where a run's metrics go; any file left from a previous run is removed first
+function RunMetrics.prepare()
+    local path = LrPathUtils.child(LrPathUtils.getStandardFilePath("temp"), "tagging_metrics.json")
+    if LrFileUtils.exists(path) then
+        LrFileUtils.delete(path)
+    end
+    return path
+end
+
+-- Returns the run's one-line summary, e.g. "120 photos in 41.2s (2.9/s); generate 71%, ...", or nil
+function RunMetrics.summary(path)
+    local file = io.open(path, "r")
+    if not file then
+        return nil
+    end
+    local text = file:read("*a")
+    file:close()
+
+    local success, data = pcall(json.decode, text)
+    if success and type(data) == "table" and type(data.summary) == "string" then
+        return data.summary
+    end
+    return nil
+end
+
+return RunMetrics
@@ -0,0 +1,51 @@
+local LrDialogs         = import("LrDialogs")
+local LrTasks           = import("LrTasks")
+local LrView            = import("LrView")
+local LrBinding         = import("LrBinding")
+local LrFunctionContext = import("LrFunctionContext")
+local LrProgressScope   = import("LrProgressScope")
+local PhotoSearch       = require("PhotoSearch")
+
+-- Longest query kept in the collection name
+local MAX_NAME_LENGTH = 60
+
+local function searchPhotos()
+    LrFunctionContext.callWithContext("searchPhotos", function(context)
+        local props = LrBinding.makePropertyTable(context)
+        props.query = ""
+
+        local f = LrView.osFactory()
+        local contents = f:column {
+            bind_to_object = props,
+            spacing = f:control_spacing(),
+            f:static_text { title = "Find photos showing:" },
+            f:edit_field { value = LrView.bind("query"), width_in_chars = 40, immediate = true },
+            f:static_text { title = "Searches the photos already tagged with the CLIP or hybrid engine." },
+        }
+        local response = LrDialogs.presentModalDialog({
+            title = "Search Photos by Description",
+            contents = contents,
+            actionVerb = "Search",
+        })
+
+        local query = props.query and props.query:match("^%s*(.-)%s*$") or ""
+        if response ~= "ok" or query == "" then
+            return
+        end
+
+        local progress = LrProgressScope({ title = "Searching photos for \"" .. query .. "\"" })
+        local results = PhotoSearch.run({ query = query })
+        progress:done()
+
+        if not results then
+            LrDialogs.message("Search Failed", "Check the Python script for errors.", "critical")
+            return
+        end
+        local found = PhotoSearch.showResults("Search: " .. query:sub(1, MAX_NAME_LENGTH), results)
+        if found == 0 then
+            LrDialogs.message("No photos found", "Tag photos with the CLIP or hybrid engine first; search only covers tagged photos.", "info")
+        end
+    end)
+end
+
+LrTasks.startAsyncTask(searchPhotos)
@@ -0,0 +1,16 @@
+-- Plugin metadata fields, shown in the Library Metadata panel ("Lightroom Photo Categorizer")
+return {
+    metadataFieldsForPhotos = {
+        {
+            -- e.g. "Night 0.94, Portrait 0.31": the tags of the last run with their scores, best first
+            id = "tagScores",
+            title = "AI Tag Scores",
+            dataType = "string",
+            readOnly = true,
+            searchable = true,
+            browsable = false,
+        },
+    },
+
+    schemaVersion = 1,
+}
@@ -0,0 +1,101 @@
+local LrTasks = import "LrTasks"
+local LrPathUtils = import "LrPathUtils"
+local LrDialogs = import "LrDialogs"
+local TaggingServer = require "TaggingServer"
+local NdjsonStream = require "NdjsonStream"
+local RunMetrics = require "RunMetrics"
+
+-- Runs one engine over a list of photos, on the tagging server when it is
+-- running and otherwise with the engine's Python script. The TaggingService
+-- modules only describe their engine:
+--   name       engine name for the tagging server ("clip", "blip", "hybrid")
+--   script     classifier script in the plugin folder
+--   python     interpreter to run it with (default: the plugin's venv)
+--   arguments  the script's engine-specific command-line arguments
+--   request    the same settings as /classify request fields
+local TaggingRunner = {}
+
+-- Calls onResult(entry) for every photo as soon as Python has tagged it,
+-- where entry is { image_path = ..., tags = { ... } }.
+-- jsonFile may be a JSON array of paths or an .ndjson file with one path per line.
+-- With options.incremental, photos unchanged since their last run get no result.
+-- entry.status is "ok", or "error" with entry.error (a code such as "unreadable" or
+-- "decode_timeout") and entry.message for photos that couldn't be tagged.
+-- With options.dedupe, near-duplicates (e.g. burst frames) get the tags of their group's
+-- first photo, and entry.group / entry.duplicate_of say which group they belong to.
+-- Returns true if the run completed, plus a one-line timing summary of the run (or nil).
+function TaggingRunner.streamTags(engine, jsonFile, onResult, options)
+    options = options or {}
+    -- 1) Build the path to the Python script
+    local scriptPath = LrPathUtils.child(_PLUGIN.path, engine.script)
+    local pythonPath = engine.python or LrPathUtils.child(_PLUGIN.path, "venv/bin/python3")
+
+    -- 2) Choose a temporary output file (one JSON line per photo)
+    local tempFolder = LrPathUtils.getStandardFilePath("temp")
+    local outputFile = LrPathUtils.child(tempFolder, "python_output.ndjson")
+    local metricsFile = RunMetrics.prepare()
+
+    -- 3) Prefer the warm tagging server (models already loaded) when it is running,
+    --    otherwise construct a command that streams stdout to outputFile
+    local useServer = TaggingServer.isRunning()
+    local command = string.format(
+        '"%s" "%s" "%s" %s --stream%s%s --metrics "%s" > "%s"',
+        pythonPath,
+        scriptPath,
+        jsonFile,
+        engine.arguments,
+        options.incremental and " --incremental" or "",
+        options.dedupe and " --dedupe" or "",
+        metricsFile,
+        outputFile
+    )
+
+    -- 4) Run it in the background, handing results over as they are written
+    local exitCode = NdjsonStream.follow(outputFile, function()
+        if useServer then
+            local request = {
+                engine = engine.name, json_file = jsonFile, output_file = outputFile,
+                incremental = options.incremental or nil,
+                dedupe = options.dedupe or nil,
+                metrics_file = metricsFile,
+            }
+            for field, value in pairs(engine.request) do
+                request[field] = value
+            end
+            if TaggingServer.classify(request) then
+                return 0
+            end
+            -- Results already handed over can't be produced twice; otherwise
+            -- fall back to the one-shot run, as when the server isn't running
+            if NdjsonStream.hasOutput(outputFile) then
+                return -1
+            end
+        end
+        return LrTasks.execute(command)
+    end, onResult)
+
+    -- LrDialogs.message("Command", command)
+
+    -- If exitCode is non-zero, Python had an error
+    if exitCode ~= 0 then
+        LrDialogs.message("Python Error", "Non-zero exit code: " .. tostring(exitCode), "critical")
+        return false
+    end
+
+    return true, RunMetrics.summary(metricsFile)
+end
+
+-- All results of a run at once
+function TaggingRunner.getTags(engine, jsonFile)
+    local results = {}
+    TaggingRunner.streamTags(engine, jsonFile, function(entry)
+        table.insert(results, entry)
+    end)
+
+    if #results == 0 then
+        LrDialogs.message("No results returned", "Check the Python script for errors.", "warning")
+    end
+    return results
+end
+
+return TaggingRunner
@@ -0,0 +1,78 @@
+local LrHttp = import "LrHttp"
+local LrFileUtils = import "LrFileUtils"
+local LrPathUtils = import "LrPathUtils"
+local json = require "json"
+
+-- Client for the optional long-lived tagging server (tagging_server.py).
+-- When the server is running, models stay loaded between runs; when it isn't,
+-- the TaggingService modules fall back to launching the Python script.
+local TaggingServer = {}
+
+TaggingServer.baseUrl = "http://127.0.0.1:8765"
+
+-- Written by the server at launch (tagging_server.TOKEN_FILE); every POST must carry it
+TaggingServer.tokenFile = LrPathUtils.child(LrPathUtils.getStandardFilePath("home"), ".cache/lightroom-deep-tag/server-token")
+
+local function postHeaders()
+    local token = LrFileUtils.exists(TaggingServer.tokenFile) and LrFileUtils.readFile(TaggingServer.tokenFile) or ""
+    return {
+        { field = "Content-Type", value = "application/json" },
+        { field = "X-Tagging-Token", value = token },
+    }
+end
+
+function TaggingServer.isRunning()
+    -- Short timeout: if nothing is listening we want to fall back quickly
+    local ok, body, headers = pcall(LrHttp.get, TaggingServer.baseUrl .. "/health", nil, 2)
+    if not ok or not body or not headers or headers.status ~= 200 then
+        return false
+    end
+
+    local success, data = pcall(json.decode, body)
+    return success and type(data) == "table" and data.status == "ok"
+end
+
+-- Returns the decoded results table, or nil if the server is unavailable or failed
+function TaggingServer.classify(request)
+    local ok, body, headers = pcall(
+        LrHttp.post,
+        TaggingServer.baseUrl .. "/classify",
+        json.encode(request),
+        postHeaders(),
+        "POST",
+        3600    -- large selections can take a while
+    )
+    if not ok or not body or not headers or headers.status ~= 200 then
+        return nil
+    end
+
+    local success, data = pcall(json.decode, body)
+    if success and data and type(data) == "table" then
+        return data
+    end
+    return nil
+end
+
+-- Returns the decoded /search response ({ results = { ... }, searched = N, ... }),
+-- or nil if the server is unavailable or failed
+function TaggingServer.search(request)
+    local ok, body, headers = pcall(
+        LrHttp.post,
+        TaggingServer.baseUrl .. "/search",
+        json.encode(request),
+        postHeaders(),
+        "POST",
+        60
+    )
+    if not ok or not body or not headers or headers.status ~= 200 then
+        return nil
+    end
+
+    local success, data = pcall(json.decode, body)
+    if success and data and type(data) == "table" then
+        return data
+    end
+    return nil
+end
+
+return TaggingServer
@@ -0,0 +1,24 @@
+local TaggingRunner = require "TaggingRunner"
+
+local TaggingService = {}
+
+-- min_margin: CLIP top-1 minus top-2 probability below which BLIP re-tags
+local ENGINE = {
+    name = "hybrid",
+    script = "hybrid_classifier.py",
+    arguments = string.format("--top-k %d --threshold %.2f --min-margin %.2f", 10, 0.20, 0.15),
+    request = { top_k = 10, threshold = 0.20, min_margin = 0.15 },
+}
+
+-- See TaggingRunner.streamTags for entry fields and options. Entries also carry
+-- stage = "clip" | "blip" | "skipped": CLIP tags every photo; only photos CLIP is
+-- unsure about are captioned by BLIP.
+function TaggingService.streamTagsForImages(jsonFile, onResult, options)
+    return TaggingRunner.streamTags(ENGINE, jsonFile, onResult, options)
+end
+
+function TaggingService.getTagsForImages(jsonFile)
+    return TaggingRunner.getTags(ENGINE, jsonFile)
+end
+
+return TaggingService
@@ -0,0 +1,36 @@
+local LrTasks = import "LrTasks"
+local LrPathUtils = import "LrPathUtils"
+local json = require "json"
+
+-- Incremental runs: Python records every result in its state DB (tagging_state.py)
+-- as it hands it over. Photos whose results were not applied to the catalog
+-- (e.g. the run was canceled) must be forgotten, so the next run tags them again.
+local TaggingState = {}
+
+-- Returns true if the photos were forgotten
+function TaggingState.forget(paths)
+    if #paths == 0 then
+        return true
+    end
+
+    local tempFolder = LrPathUtils.getStandardFilePath("temp")
+    local pathsFile = LrPathUtils.child(tempFolder, "forget_paths.ndjson")
+    local file = io.open(pathsFile, "w")
+    if not file then
+        return false
+    end
+    for _, path in ipairs(paths) do
+        file:write(json.encode(path), "\n")
+    end
+    file:close()
+
+    local command = string.format(
+        '"%s" "%s" --forget "%s"',
+        LrPathUtils.child(_PLUGIN.path, "venv/bin/python3"),
+        LrPathUtils.child(_PLUGIN.path, "tagging_state.py"),
+        pathsFile
+    )
+    return LrTasks.execute(command) == 0
+end
+
+return TaggingState
@@ -7,18 +7,25 @@ warnings.filterwarnings("ignore", category=NotOpenSSLWarning)
 warnings.filterwarnings("ignore", module="urllib3")
 
 import sys
+import time
 import json
 import os
-from PIL import Image, UnidentifiedImageError
-from pillow_heif import register_heif_opener
+import argparse
+
+import burst_groups
+import category_index
+import embedding_cache
+import image_loader
+import image_pipeline
+import inference_backends
+import long_run
+import model_registry
+import process_pool
+import run_metrics
+import tagging_errors
+import tagging_io
+import tagging_state
 
-import torch
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from sentence_transformers import SentenceTransformer, util
-
-
-# Register the HEIF opener so Pillow can handle .heic/.heif/.hif
-register_heif_opener()
 
 debug = False
 
@@ -35,107 +42,297 @@ def dprint(*args, **kwargs):
 # ----------------------------------------
 # 1) SETUP: BLIP for captioning + Sentence-BERT for similarity
 # ----------------------------------------
-# device = "cuda" if torch.cuda.is_available() else "cpu"
-device = "mps" if torch.backends.mps.is_available() else "cpu"
-
-dprint(f"Using device: {device}")
-
 # BLIP model + processor
-blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
+BLIP_MODEL_NAME = "Salesforce/blip-image-captioning-base"
 
 # Sentence-BERT model for text similarity
-similarity_model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2", device=device)
-
-# Your 10 photography prompts
-# tag_prompts = [
-#     "A close-up portrait emphasizing the subject’s expression and personality.",
-#     "A dramatic cityscape showcasing skyscrapers, bridges, and urban design.",
-#     "A sweeping natural vista with mountains, forests, or coastlines.",
-#     "A candid street scene capturing real-life moments and everyday urban life.",
-#     "A moody nighttime shot featuring light trails or illuminated city streets.",
-#     "An extreme close-up revealing fine details, textures, or abstract patterns.",
-#     "A high-energy moment freezing intense motion in a sporting event.",
-#     "A stylish editorial scene focusing on clothing, models, and trendy settings.",
-#     "A surreal or experimental composition playing with light, form, or symbolism.",
-#     "A vibrant travel scene featuring cultural landmarks, bustling markets, or scenic wonders."
-# ]
-categories = [
-    (
-        "Landscape",
-        "A photo of a landscape. There could be mountains, forests, or coastlines. All taken at a distance."
-    ),
-    (
-        "Night",
-        "A photo at night, outside, illuminated with city lights"
-    ),
-    (
-        "Winter Snow",
-        "A photo of the outdoors in the winter. Outside, snow covering the ground or environment."
-    ),
-    (
-        "Urban Downtown",
-        "A photo of urban downtown life, with skyscrapers or bustling streets."
-    ),
-    (
-        "Silhouette",
-        "A silhouette photo, where the subject is dark against a bright background."
-    ),
-    (
-        "Portrait",
-        "A portrait photo focusing on a person’s face or upper body."
-    ),
-    (
-        "Closeup Nature",
-        "A photo of close-up natural elements, like leaves, insects, or small details."
-    ),
-    (
-        "Patterns/Detail",
-        "A photo emphasizing detail, patterns, or repetition in textures."
-    ),
-    (
-        "Fall Colors",
-        "A photo showing autumn foliage with red, orange, or yellow leaves."
-    ),
-    (
-        "Garden/Flowers",
-        "A photo of a garden or flowers in bloom."
-    ),
-    (
-        "Bodies of Water",
-        "A photo including lakes, rivers, or other bodies of water."
-    ),
-    (
-        "Oscar",
-        "A photo of a housecat"
-    ),
-    (
-        "Suburbs",
-        "A photo highlighting the suburbs. The photo is predominantly small residential houses."
+SIMILARITY_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# torch/transformers/sentence_transformers are imported and the models loaded by
+# load_models(), once there are photos to tag, so a bad invocation or an empty
+# path list fails fast
+device = None
+blip_processor = None
+blip_model = None
+similarity_model = None
+
+# Caption decode settings, selected with use_decode_profile(). The active profile
+# is part of the caption cache key, so each profile keeps its own cached captions.
+DECODE_PROFILES = {
+    # Beam search for the most descriptive captions: seconds per photo on CPU
+    "quality": dict(
+        num_beams=7,
+        max_length=100,
+        min_length=30,
+        repetition_penalty=2.5,
+        no_repeat_ngram_size=2,
+        # temperature=0.7
     ),
-    (
-        "Lights & Shadow",
-        "A photo that focuses predominantly on lighting and harsh shadows"
+    # Greedy, short captions for bulk triage
+    "fast": dict(
+        num_beams=1,
+        max_length=30,
+        min_length=5,
+        repetition_penalty=2.5,
+        no_repeat_ngram_size=2,
     ),
-]
-
-# Separate out the prompts for embedding
-tag_names = [c[0] for c in categories]
-tag_prompts = [c[1] for c in categories]
-
-# Pre-encode the category prompts for faster matching
-with torch.no_grad():
-    category_embeddings = similarity_model.encode(tag_prompts, convert_to_tensor=True)
+}
+decode_profile = "quality"
+# Stop a caption once it has this many content words (see _content_word_stop), None to disable
+early_stop_words = None
+
+# Categories come from a taxonomy file (see category_index); switch with use_taxonomy()
+DEFAULT_TAXONOMY = os.path.join(category_index.TAXONOMY_DIR, "blip_default.json")
+taxonomy_path = DEFAULT_TAXONOMY
+tag_names = None
+tag_prompts = None
+category_embeddings = None
+# Per-category thresholds (NaN: use the request's threshold)
+category_thresholds = None
+
+# Exported encoders (see use_backend); None / the original module means eager PyTorch
+text_encoder = None
+_eager_vision_model = None
+# Applied to BLIP whenever it gets loaded (see use_backend / use_precision)
+_vision_backend = ("torch", inference_backends.DEFAULT_MODEL_DIR)
+precision = "fp32"
+
+def load_matcher():
+    """Imports torch/sentence_transformers, loads MiniLM and the default taxonomy's prompt embeddings, once per process."""
+    global device, similarity_model
+    with model_registry.lock:
+        if similarity_model is not None:
+            return
+
+        model_registry.import_module("torch")
+        sentence_transformers = model_registry.import_module("sentence_transformers")
+        device = model_registry.torch_device()
+        dprint(f"Using device: {device}")
+
+        similarity_model = model_registry.get(
+            ("sentence-transformer", SIMILARITY_MODEL_NAME, device),
+            lambda: sentence_transformers.SentenceTransformer(SIMILARITY_MODEL_NAME, device=device),
+            phase=f"load {SIMILARITY_MODEL_NAME} weights")
+        use_taxonomy(taxonomy_path)
+
+def encode_prompts(prompts):
+    """Encodes category prompts with Sentence-BERT. Returns float32 rows as a numpy array."""
+    import torch
+
+    with model_registry.timed("encode category prompts"), torch.no_grad():
+        return similarity_model.encode(prompts, convert_to_numpy=True).astype("float32")
+
+# (taxonomy path, mtime, precision) -> (taxonomy, unit-length category embeddings, thresholds), so switching back is free
+_compiled_taxonomies = {}
+
+def use_taxonomy(path=None):
+    """
+    Switches the categories to a taxonomy file or name (default: DEFAULT_TAXONOMY).
+    Only prompts missing from the on-disk prompt index are encoded; the models stay loaded.
+    Cached captions are re-matched against the new categories without running BLIP.
+    """
+    global taxonomy_path, tag_names, tag_prompts, category_embeddings, category_thresholds
+    path = category_index.resolve_taxonomy(path) if path else DEFAULT_TAXONOMY
+    if similarity_model is None:
+        # load_matcher() compiles taxonomy_path right after loading the model
+        taxonomy_path = path
+        load_matcher()
+        return
+    import torch
+
+    with model_registry.lock:
+        # Prompt embeddings differ between the fp32 and int8 models
+        key = (path, os.stat(path).st_mtime_ns, precision)
+        if key not in _compiled_taxonomies:
+            taxonomy = category_index.load_taxonomy(path)
+            # MiniLM is quantized too with int8, so its prompt embeddings are kept apart
+            index_name = SIMILARITY_MODEL_NAME if precision == "fp32" else f"{SIMILARITY_MODEL_NAME}|{precision}"
+            with model_registry.timed(f"compile taxonomy {taxonomy.name}"):
+                embeddings = category_index.compile_taxonomy(index_name, taxonomy, encode_prompts)
+            thresholds = torch.from_numpy(category_index.threshold_vector(taxonomy)).to(device)
+            _compiled_taxonomies[key] = (taxonomy, torch.from_numpy(embeddings).to(device), thresholds)
+
+        taxonomy, embeddings, category_thresholds = _compiled_taxonomies[key]
+        tag_names, tag_prompts = taxonomy.tag_names, taxonomy.prompts
+        category_embeddings = embeddings.half() if precision == "int8" else embeddings
+        taxonomy_path = path
+
+def load_captioner():
+    """
+    Imports transformers and loads the BLIP processor and model, once per process.
+    Photos with a cached caption never need this.
+    """
+    global blip_processor, blip_model, _eager_vision_model
+    load_matcher()
+    with model_registry.lock:
+        if blip_model is not None:
+            return
+
+        transformers = model_registry.import_module("transformers")
+        processor = model_registry.get(
+            ("blip-processor", BLIP_MODEL_NAME), lambda: transformers.BlipProcessor.from_pretrained(BLIP_MODEL_NAME),
+            phase=f"load {BLIP_MODEL_NAME} processor")
+        captioner = model_registry.get(
+            ("blip", BLIP_MODEL_NAME, device),
+            lambda: transformers.BlipForConditionalGeneration.from_pretrained(BLIP_MODEL_NAME).to(device),
+            phase=f"load {BLIP_MODEL_NAME} weights")
+
+        _eager_vision_model = captioner.vision_model
+        if precision == "int8":
+            _quantize_captioner(captioner)
+        _apply_vision_backend(captioner)
+
+        # Set last: other threads only see BLIP once it is ready
+        blip_processor = processor
+        blip_model = captioner
+
+def load_models():
+    """Loads everything up front (e.g. to preload the tagging server)."""
+    load_matcher()
+    load_captioner()
+
+def _exported_vision_model(encoder):
+    """Builds a stand-in for blip_model.vision_model inside generate() that runs an exported encoder."""
+    import torch
+
+    class ExportedVisionModel(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, pixel_values=None, **kwargs):
+            return (self.encoder(pixel_values).to(device=pixel_values.device, dtype=pixel_values.dtype),)
+
+    return ExportedVisionModel()
+
+def _apply_vision_backend(captioner):
+    backend, model_dir = _vision_backend
+    try:
+        vision_encoder = inference_backends.load_encoder("blip_vision_encoder", backend, BLIP_MODEL_NAME,
+                                                         model_dir=model_dir, device=device)
+    except FileNotFoundError as e:
+        print(f"Using the eager BLIP vision encoder: {e}", file=sys.stderr)
+        vision_encoder = None
+    captioner.vision_model = _exported_vision_model(vision_encoder) if vision_encoder is not None else _eager_vision_model
+
+def use_backend(backend, model_dir=inference_backends.DEFAULT_MODEL_DIR):
+    """
+    Switches the MiniLM caption encoder and, if it was exported, the BLIP vision
+    encoder to TorchScript/ONNX graphs from export_models.py, or back to eager ("torch").
+    Text generation itself always runs in PyTorch.
+    """
+    global text_encoder, _vision_backend
+    load_matcher()
+    text_encoder = inference_backends.load_encoder("minilm_text_encoder", backend, SIMILARITY_MODEL_NAME,
+                                                   model_dir=model_dir, device=device)
+    with model_registry.lock:
+        _vision_backend = (backend, model_dir)
+        if blip_model is not None:
+            _apply_vision_backend(blip_model)
+
+def use_decode_profile(profile, early_stop=None):
+    """
+    Selects the DECODE_PROFILES entry used for new captions, and optionally
+    stops each caption once it has `early_stop` content words.
+    """
+    global decode_profile, early_stop_words
+    if profile not in DECODE_PROFILES:
+        raise ValueError(f"Unknown decode profile: {profile}")
+    with model_registry.lock:
+        decode_profile = profile
+        early_stop_words = early_stop or None
+
+def _quantize_captioner(captioner):
+    # The eager vision encoder may be swapped out of the model by use_backend
+    inference_backends.quantize_linear_int8(_eager_vision_model)
+    inference_backends.quantize_linear_int8(captioner)
+
+def use_precision(new_precision):
+    """
+    "int8" quantizes the Linear layers of BLIP and MiniLM to int8 and keeps
+    category_embeddings in float16; it can't be undone in-process. Only applies on CPU.
+    """
+    global precision
+    load_matcher()
+    with model_registry.lock:
+        if new_precision == precision:
+            return
+        if new_precision != "int8":
+            raise ValueError(f"Can't switch from {precision} to {new_precision} in-process")
+        if device != "cpu":
+            print(f"--precision int8 needs the CPU, staying at {precision} on {device}", file=sys.stderr)
+            return
+        inference_backends.quantize_linear_int8(similarity_model)
+        precision = new_precision
+        # Re-encodes the current taxonomy's prompts with the quantized model, as for any taxonomy compiled later
+        use_taxonomy(taxonomy_path)
+        if blip_model is not None:
+            _quantize_captioner(blip_model)
 
 # ----------------------------------------
 # 2) FUNCTION: Generate BLIP caption
 # ----------------------------------------
-def generate_caption(image_path: str) -> str:
+def load_caption_inputs(image_path: str):
     """
-    Generates a caption using BLIP. Returns a string.
+    Decodes an image and runs the BLIP processor on it. Returns the processor
+    output (still on the CPU), so this can run on a decode worker thread.
+    """
+    load_captioner()
+    # .raf files are read from their embedded JPEG preview; large JPEG/HEIF
+    # files are decoded at reduced size (see image_loader)
+    with run_metrics.timed("decode", [image_path]):
+        image, source = image_loader.load_image(image_path, blip_processor.image_processor.size["height"])
+    dprint(f"At Path: {image_path}, Decoded via: {source}")
+    with run_metrics.timed("preprocess", [image_path]):
+        return blip_processor(images=image, return_tensors="pt")
+
+# Words that don't help matching a caption to a category; together with "##"
+# word pieces and special tokens they don't count towards early_stop_words
+_FUNCTION_WORDS = ["a", "an", "the", "of", "with", "and", "in", "on", "at", "to", "is", "are", "it", "its",
+                   "there", "this", "that", "some", "two", "three", "for", "by", "from", "has", "his", "her",
+                   "their", ",", "."]
+
+_non_content_ids = None
+
+def _content_word_stop(min_words):
+    """
+    Builds a StoppingCriteria that marks a caption done once it has min_words
+    content words. Checked for the whole batch at once on the token ids.
     """
-    image = Image.open(image_path).convert("RGB")
-    inputs = blip_processor(images=image, return_tensors="pt").to(device)
+    import torch
+    from transformers import StoppingCriteria
+
+    global _non_content_ids
+    if _non_content_ids is None:
+        tokenizer = blip_processor.tokenizer
+        ids = set(tokenizer.all_special_ids)
+        ids.update(tokenizer.convert_tokens_to_ids(_FUNCTION_WORDS))
+        ids.update(i for token, i in tokenizer.get_vocab().items() if token.startswith("##"))
+        _non_content_ids = torch.tensor(sorted(ids), device=device)
+
+    class ContentWordStop(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            # One bool per sequence (beam search stops once all its beams are done)
+            content = ~torch.isin(input_ids, _non_content_ids)
+            return content.sum(dim=-1) >= min_words
+
+    return ContentWordStop()
+
+def generate_captions(batch_inputs, use_cache=True):
+    """
+    Captions a batch of load_caption_inputs outputs with one generate() call
+    using the current decode profile. Returns one caption per input.
+    """
+    import torch
+    from transformers import StoppingCriteriaList
+
+    load_captioner()
+    # BLIP resizes every image to the same size, so pixel values stack without
+    # padding; finished captions are padded until the longest is done
+    pixel_values = torch.cat([inputs["pixel_values"] for inputs in batch_inputs]).to(device)
+    stopping_criteria = StoppingCriteriaList()
+    if early_stop_words:
+        stopping_criteria.append(_content_word_stop(early_stop_words))
 
     with torch.no_grad():
         # caption_ids = blip_model.generate(**inputs)
@@ -146,15 +343,10 @@ def generate_caption(image_path: str) -> str:
         #     min_length=30,        # force at least 10 tokens
         #     repetition_penalty=2.0  # discourage repeated phrases
         # )
-        caption_ids = blip_model.generate(
-            **inputs,
-            num_beams=7,
-            max_length=100,
-            min_length=30,
-            repetition_penalty=2.5,
-            no_repeat_ngram_size=2,
-            # temperature=0.7
-        )
+        # use_cache keeps each beam's past keys/values (reordered as beams are
+        # pruned) instead of re-running the decoder over the whole prefix per token
+        caption_ids = blip_model.generate(pixel_values=pixel_values, stopping_criteria=stopping_criteria,
+                                          use_cache=use_cache, **DECODE_PROFILES[decode_profile])
         # caption_ids = blip_model.generate(
         #     **inputs,
         #     do_sample=True,
@@ -166,7 +358,16 @@ def generate_caption(image_path: str) -> str:
         #     no_repeat_ngram_size=2
         # )
 
-    caption = blip_processor.decode(caption_ids[0], skip_special_tokens=True)
+    return [caption.strip() for caption in blip_processor.batch_decode(caption_ids, skip_special_tokens=True)]
+
+def generate_caption(image_path: str, inputs=None) -> str:
+    """
+    Generates a caption using BLIP. Returns a string.
+    Pass `inputs` from load_caption_inputs to skip decoding the image here.
+    """
+    if inputs is None:
+        inputs = load_caption_inputs(image_path)
+    caption = generate_captions([inputs])[0]
 
     dprint(f"At Path: {image_path}, Generated caption: {caption}")
 
@@ -175,83 +376,381 @@ def generate_caption(image_path: str) -> str:
 # ----------------------------------------
 # 3) FUNCTION: Match caption to best category
 # ----------------------------------------
-def match_caption_to_category(caption: str):
+def encode_captions(captions):
+    """Returns the Sentence-BERT embeddings of a list of captions, shape: [len(captions), dim]."""
+    import torch
+
+    load_matcher()
+    with torch.no_grad():
+        if text_encoder is not None:
+            features = similarity_model.tokenize(list(captions))
+            return text_encoder(features["input_ids"], features["attention_mask"]).to(device)
+        return similarity_model.encode(list(captions), convert_to_tensor=True)
+
+def encode_caption(caption: str):
+    """Returns the Sentence-BERT embedding of a caption, shape: [1, dim]."""
+    return encode_captions([caption])
+
+def match_caption_embeddings(caption_embeddings, top_k=3, threshold=0.4):
+    """
+    Scores a [B, D] batch of caption embeddings against every category with one
+    matmul of cosine similarities and picks up to top_k tags per caption that
+    reach the threshold (see category_index.select_tags).
+    Returns [(name, score), ...] per caption; names are the short labels, not the prompts.
+    """
+    import torch
+
+    load_matcher()
+    with torch.no_grad():
+        captions = caption_embeddings.float()
+        captions = captions / captions.norm(dim=-1, keepdim=True)
+        # Category embeddings are already unit length (see category_index.compile_taxonomy)
+        similarities = captions @ category_embeddings.float().T  # shape: [B, len(categories)]
+    return category_index.select_tags(similarities, tag_names, top_k, threshold, category_thresholds)
+
+def match_caption_to_category(caption: str, caption_embedding=None):
     """
     Uses Sentence-BERT to find the single best matching category.
     Returns (best_category, similarity_score).
+    Pass a cached `caption_embedding` to skip re-encoding the caption.
     """
     # Encode the caption
-    caption_embedding = similarity_model.encode([caption], convert_to_tensor=True)
+    if caption_embedding is None:
+        caption_embedding = encode_caption(caption)
 
-    # Compute cosine similarities
-    similarities = util.cos_sim(caption_embedding, category_embeddings)  # shape: [1, len(tag_prompts)]
-    similarities = similarities.squeeze(0)  # shape: [len(tag_prompts)]
-
-    best_idx = int(torch.argmax(similarities))
-    best_score = float(similarities[best_idx])
-    best_tag_name = tag_names[best_idx]  # We return the short label, not the full prompt
-
-    return best_tag_name, best_score
+    return match_caption_embeddings(caption_embedding.reshape(1, -1), top_k=1)[0][0]
 
 # ----------------------------------------
-# 4) FUNCTION: Classify a single image (BLIP + match)
+# 4) FUNCTION: Classify images (BLIP + match)
 # ----------------------------------------
-def classify_image(image_path: str):
+def caption_cache_name():
+    """Cache namespace: captions depend on both models, their precision and the decode settings."""
+    params = json.dumps(DECODE_PROFILES[decode_profile], sort_keys=True)
+    name = f"blip-captions|{BLIP_MODEL_NAME}|{SIMILARITY_MODEL_NAME}|{params}"
+    if early_stop_words:
+        name += f"|early-stop={early_stop_words}"
+    return name if precision == "fp32" else f"{name}|{precision}"
+
+def state_key(top_k, threshold, taxonomy=None, precision="fp32"):
     """
-    Returns a single best matching category in the format:
-    [ (category, score) ]
-    or empty [] if we skip the file.
+    Identifies everything that decides a photo's tags under the current decode
+    profile, for incremental runs (see tagging_state). Loads no model.
     """
-    # Skip .raf
-    if image_path.lower().endswith(".raf"):
-        return []
-
-    # Attempt to open and caption
-    try:
-        caption = generate_caption(image_path)
-    except UnidentifiedImageError:
-        # If PIL can't open it, skip
-        return []
-    except Exception:
-        # Any other error, skip
-        return []
+    digest = category_index.taxonomy_digest(taxonomy or DEFAULT_TAXONOMY)
+    return tagging_state.run_key("blip", BLIP_MODEL_NAME, SIMILARITY_MODEL_NAME, precision,
+                                 DECODE_PROFILES[decode_profile], early_stop_words, digest, top_k, threshold)
 
-    # Match caption to the best category
-    best_category, score = match_caption_to_category(caption)
+def open_cache(cache_dir=embedding_cache.DEFAULT_CACHE_DIR, max_mb=256, hash_content=False):
+    """Opens the on-disk caption cache (caption text + its embedding), or returns None if it's unavailable."""
+    load_matcher()
+    return embedding_cache.open_cache(caption_cache_name(), category_embeddings.shape[-1], cache_dir=cache_dir,
+                                      max_mb=max_mb, hash_content=hash_content)
 
-    dprint(f"Best category: {best_category}, Score: {score}")
-    dprint()
+def classify_image(image_path: str, top_k=3, threshold=0.4):
+    """
+    Returns the best matching categories in the format:
+    [ (category, score), ... ]
+    or an empty tagging_errors.Failure if the file can't be tagged.
+    """
+    return classify_images([image_path], top_k=top_k, threshold=threshold, decode_workers=0, caption_batch=1)[0]
 
-    # Return a list with one (category, score) tuple
-    return [(best_category, score)]
+def iter_classify_images(image_paths, top_k=3, threshold=0.4, decode_workers=2, prefetch_depth=8, cache=None,
+                         rescore_only=False, caption_batch=4, match_batch=64,
+                         decode_timeout=tagging_errors.DEFAULT_DECODE_TIMEOUT, retries=tagging_errors.DEFAULT_RETRIES):
+    """
+    Classifies images in input order while decode_workers threads decode and
+    preprocess up to prefetch_depth images ahead of the captioning model.
+    Yields (path, tags) as each image is done; image_paths may be a stream.
+    Files that can't be tagged get a tagging_errors.Failure (an empty list);
+    decodes are retried and timed out as in clip_classifier.iter_classify_images.
+
+    With a cache (see open_cache), photos captioned before skip decoding and
+    BLIP entirely and are only re-matched against the current categories.
+    With rescore_only, photos without a cached caption fail with "no_cached_caption".
+    BLIP itself is only loaded once a photo needs captioning.
+
+    Photos that need a caption are captioned caption_batch at a time with one
+    generate() call (see generate_captions). Caption embeddings are matched up
+    to match_batch at a time in one matrix operation; results are handed out
+    after every caption batch.
+    """
+    import torch
+
+    load_matcher()
+    load_inputs = tagging_errors.retrying(load_caption_inputs, retries)
+
+    def load(path):
+        # Returns None (no cached caption), ("cached", key, (embedding, caption)) or ("inputs", key, processor output)
+        key = None
+        if cache is not None:
+            key = cache.key(path)
+            entry = cache.get_entry(path, key)
+            if entry is not None and entry[1] is not None:
+                return "cached", key, entry
+        if rescore_only:
+            return None
+        return "inputs", key, load_inputs(path)
+
+    def match(pending):
+        # pending: [[path, caption embedding, or a Failure]]
+        rows = [(path, value) for path, value in pending if not isinstance(value, tagging_errors.Failure)]
+        with run_metrics.timed("score", [path for path, _ in rows]):
+            matched = iter(match_caption_embeddings(torch.stack([value for _, value in rows]), top_k, threshold)
+                           if rows else [])
+        for path, value in pending:
+            tags = value if isinstance(value, tagging_errors.Failure) else next(matched)
+            dprint(f"At Path: {path}, Tags: {tags}")
+            yield path, tags
+
+    uncached = 0
+    pending = []
+    # (index in pending, loaded item) of the photos waiting for a caption
+    to_caption = []
+    loaded = image_pipeline.prefetch(image_paths, load, workers=decode_workers, depth=prefetch_depth)
+    try:
+        for path, future in loaded:
+            item = tagging_errors.resolve(future, decode_timeout)
+            if item is None:
+                uncached += 1
+                pending.append([path, tagging_errors.Failure("no_cached_caption", "--rescore-only")])
+            elif isinstance(item, tagging_errors.Failure):
+                pending.append([path, item])
+            elif item[0] == "cached":
+                embedding, caption = item[2]
+                dprint(f"At Path: {path}, Cached caption: {caption}")
+                pending.append([path, torch.from_numpy(embedding).float().to(category_embeddings.device)])
+            else:
+                # Replaced by the caption embedding once captioned
+                pending.append([path, tagging_errors.Failure("inference_error", "no caption")])
+                to_caption.append((len(pending) - 1, item))
+
+            if len(to_caption) >= caption_batch or (not to_caption and len(pending) >= match_batch):
+                _caption_embeddings(pending, to_caption, cache)
+                # Frees the decoded images before the results are handed out
+                item = None
+                to_caption = []
+                yield from match(pending)
+                pending = []
+        _caption_embeddings(pending, to_caption, cache)
+        yield from match(pending)
+    finally:
+        if cache is not None:
+            cache.save()
+        if uncached:
+            print(f"--rescore-only: {uncached} photo(s) have no cached caption and were skipped", file=sys.stderr)
+
+def _caption_embeddings(pending, to_caption, cache):
+    """
+    Captions the prefetched images of to_caption in one batch and stores each
+    caption's [D] embedding in its pending entry (left a Failure if that fails).
+    """
+    if not to_caption:
+        return
+    try:
+        with run_metrics.timed("generate", [pending[index][0] for index, _ in to_caption]):
+            captions = generate_captions([inputs for _, (_, _, inputs) in to_caption])
+    except Exception:
+        # Caption one by one, so a single bad image only fails itself
+        captions = []
+        for index, (_, _, inputs) in to_caption:
+            try:
+                with run_metrics.timed("generate", [pending[index][0]]):
+                    captions.append(generate_captions([inputs])[0])
+            except Exception as e:
+                pending[index][1] = tagging_errors.Failure("inference_error", f"{type(e).__name__}: {e}")
+                captions.append(None)
+
+    captioned = [(index, key, caption) for (index, (_, key, _)), caption in zip(to_caption, captions) if caption]
+    if not captioned:
+        return
+    try:
+        with run_metrics.timed("forward", [pending[index][0] for index, _, _ in captioned]):
+            embeddings = encode_captions([caption for _, _, caption in captioned]).float()
+    except Exception as e:
+        for index, _, _ in captioned:
+            pending[index][1] = tagging_errors.Failure("inference_error", f"{type(e).__name__}: {e}")
+        return
+    for (index, key, caption), caption_embedding in zip(captioned, embeddings):
+        path = pending[index][0]
+        dprint(f"At Path: {path}, Generated caption: {caption}")
+        if cache is not None:
+            cache.put(path, caption_embedding.cpu().numpy(), key, meta=caption)
+        pending[index][1] = caption_embedding
+
+def classify_images(image_paths, top_k=3, threshold=0.4, decode_workers=2, prefetch_depth=8, cache=None,
+                    rescore_only=False, caption_batch=4):
+    """Returns one tag list per input path, in input order. See iter_classify_images."""
+    return [tags for _, tags in iter_classify_images(image_paths, top_k, threshold, decode_workers, prefetch_depth,
+                                                     cache, rescore_only, caption_batch)]
 
 # ----------------------------------------
 # 5) MAIN: JSON input -> JSON output
 # ----------------------------------------
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python blip_multilabel.py /path/to/photo_paths.json")
-        sys.exit(1)
-
-    json_file = sys.argv[1]
-
-    # Load the list of image paths from JSON
-    with open(json_file, "r") as f:
-        image_paths = json.load(f)
-
-    results = []
-    for path in image_paths:
-        tags = classify_image(path)
-        results.append({"image_path": path, "tags": tags})
-
-    # Output one JSON array with all results
-    print(json.dumps(results))
-    # del similarity_model
-    # del blip_model
-    # import gc
-    # gc.collect()
-    # sys.exit(0)
-    # os._exit(0)
+    parser = argparse.ArgumentParser(
+        description="Tag photos with BLIP captions matched to categories.",
+        usage="python blip_classifier.py /path/to/photo_paths.json [--top-k 3] [--threshold 0.4] [--decode-profile fast|quality] [--caption-batch N] [--decode-workers N] [--prefetch N] [--rescore-only] [--dedupe] [--stream]",
+    )
+    parser.add_argument("json_file", help="JSON array of paths, or NDJSON (.ndjson / - for stdin) with one path per line")
+    parser.add_argument("--top-k", type=int, default=3,
+                        help="Max tags per photo (default: 3)")
+    parser.add_argument("--threshold", type=float, default=0.4,
+                        help="Min caption/category similarity for a tag beyond the best one, unless the taxonomy sets its own (default: 0.4)")
+    parser.add_argument("--decode-profile", choices=sorted(DECODE_PROFILES), default="quality",
+                        help="fast: short greedy captions for bulk triage; quality: beam search (default: quality)")
+    parser.add_argument("--early-stop-words", type=int, default=None,
+                        help="Stop each caption once it has this many content words (default: off)")
+    parser.add_argument("--caption-batch", type=int, default=4,
+                        help="Images captioned per BLIP generate() call (default: 4)")
+    parser.add_argument("--decode-workers", type=int, default=2,
+                        help="Threads decoding/preprocessing images ahead of BLIP, 0 to decode inline (default: 2)")
+    parser.add_argument("--prefetch", type=int, default=8,
+                        help="Max images decoded ahead of BLIP (default: 8)")
+    parser.add_argument("--decode-timeout", type=float, default=tagging_errors.DEFAULT_DECODE_TIMEOUT,
+                        help="Seconds a photo's decode may keep the model waiting before it fails, 0 for no limit; "
+                             "the decode thread itself isn't stopped, and inline decoding (--decode-workers 0) "
+                             "has no limit (default: 60)")
+    parser.add_argument("--retries", type=int, default=tagging_errors.DEFAULT_RETRIES,
+                        help="Extra attempts at a decode that fails with a transient I/O error, e.g. EIO (default: 1)")
+    parser.add_argument("--cache-dir", default=embedding_cache.DEFAULT_CACHE_DIR,
+                        help="Where captions and their embeddings are cached between runs")
+    parser.add_argument("--cache-size-mb", type=float, default=256,
+                        help="Cap on the caption cache; least recently used entries are evicted (default: 256)")
+    parser.add_argument("--hash-content", action="store_true",
+                        help="Key the cache on a hash of the file bytes instead of path/size/mtime")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always caption every image")
+    parser.add_argument("--rescore-only", action="store_true",
+                        help="Only re-match cached captions against the categories; never run BLIP")
+    parser.add_argument("--backend", choices=inference_backends.BACKENDS, default="torch",
+                        help="Encoder backend; torchscript/onnx need export_models.py first (default: torch)")
+    parser.add_argument("--model-dir", default=inference_backends.DEFAULT_MODEL_DIR,
+                        help="Where export_models.py wrote the exported encoders")
+    parser.add_argument("--precision", choices=inference_backends.PRECISIONS, default="fp32",
+                        help="int8: quantize the eager models' Linear layers to cut memory (CPU only)")
+    parser.add_argument("--taxonomy", default=None,
+                        help="Taxonomy file, or name of one in taxonomies/, with the categories to tag with (default: taxonomies/blip_default.json)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes, each with its own model copy; "
+                             "disables the on-disk cache (default: 1)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch threads per worker process (default: cores / workers)")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Tag each burst / group of near-duplicate photos once, from its first photo")
+    parser.add_argument("--dedupe-similarity", type=float, default=burst_groups.DEFAULT_SIMILARITY,
+                        help="Share of perceptual-hash bits near-duplicates agree on, 0.5-1 (default: 0.9)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip photos whose file, models, taxonomy and settings are unchanged since their last run")
+    parser.add_argument("--state-db", default=tagging_state.DEFAULT_STATE_DB,
+                        help="Incremental state database (default: state.sqlite in the cache directory)")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print time spent on imports, loading weights and encoding prompts to stderr")
+    parser.add_argument("--metrics", metavar="FILE", default=None,
+                        help="Write per-stage and per-photo timings, peak RSS and images/sec to this .json or .csv file")
+    parser.add_argument("--profile", choices=run_metrics.PROFILERS, default=None,
+                        help="Run under cProfile or the torch profiler and print the top entries to stderr")
+    parser.add_argument("--profile-output", default=None,
+                        help="Where --profile saves its data (default: tagging.prof / tagging_trace.json)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Print one JSON line per image as soon as it is tagged instead of one array at the end")
+    parser.add_argument("--max-rss-mb", type=float, default=None,
+                        help="Memory ceiling in MB for this process and its workers: above it, free what can be freed, "
+                             f"else stop with exit status {long_run.EXIT_MEMORY_CEILING} (see long_run.py, which resumes)")
+    args = parser.parse_args()
+
+    if args.taxonomy:
+        try:
+            args.taxonomy = category_index.resolve_taxonomy(args.taxonomy)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+    if args.caption_batch < 1 or args.workers < 1:
+        parser.error("--caption-batch and --workers must be at least 1")
+    if not 0.5 <= args.dedupe_similarity <= 1:
+        parser.error("--dedupe-similarity must be between 0.5 and 1")
+    if (args.no_cache or args.workers > 1) and args.rescore_only:
+        parser.error("--rescore-only needs the caption cache (no --no-cache or --workers)")
+
+    use_decode_profile(args.decode_profile, args.early_stop_words)
+
+    if args.metrics:
+        run_metrics.enable()
+    started = time.perf_counter()
+    profiler = run_metrics.start_profiler(args.profile)
+
+    # Load the list of image paths from JSON (read lazily when streamed as NDJSON)
+    image_paths = tagging_io.read_paths(args.json_file)
+    state = tagging_state.open_state(args.state_db) if args.incremental else None
+    if state is not None:
+        image_paths = state.pending(image_paths, state_key(args.top_k, args.threshold, args.taxonomy, args.precision))
+    image_paths = tagging_io.nonempty(image_paths)
+
+    writer = tagging_io.ResultWriter(stream=args.stream)
+    guard = long_run.open_guard(args.max_rss_mb)
+    status = 0
+    # With nothing to tag, answer right away without importing torch or loading any model
+    if image_paths is not None:
+        classify_kwargs = dict(top_k=args.top_k, threshold=args.threshold, decode_workers=args.decode_workers,
+                               prefetch_depth=args.prefetch, caption_batch=args.caption_batch,
+                               decode_timeout=args.decode_timeout, retries=args.retries)
+        if args.workers > 1:
+            setup = [("use_taxonomy", (args.taxonomy,)), ("use_backend", (args.backend, args.model_dir)),
+                     ("use_precision", (args.precision,)),
+                     ("use_decode_profile", (args.decode_profile, args.early_stop_words))]
+
+            def classify(paths):
+                return process_pool.iter_sharded("blip_classifier", paths, classify_kwargs, setup,
+                                                 workers=args.workers, threads_per_worker=args.threads_per_worker)
+        else:
+            use_taxonomy(args.taxonomy)
+            use_backend(args.backend, args.model_dir)
+            use_precision(args.precision)
+
+            cache = None
+            if not args.no_cache:
+                cache = open_cache(args.cache_dir, max_mb=args.cache_size_mb, hash_content=args.hash_content)
+
+            def classify(paths):
+                return iter_classify_images(paths, cache=cache, rescore_only=args.rescore_only, **classify_kwargs)
+
+        if args.dedupe:
+            results = burst_groups.iter_grouped(image_paths, classify, args.dedupe_similarity, args.decode_workers,
+                                                  args.decode_timeout)
+        else:
+            results = ((result, None, None) for result in classify(image_paths))
+
+        for (path, tags), group, duplicate_of in results:
+            entry = tagging_errors.annotate({"image_path": path, "tags": tags})
+            with run_metrics.timed("output", [path]):
+                writer.write(burst_groups.annotate(entry, group, duplicate_of))
+            # Failures worth another try aren't recorded, so the next incremental run retries them
+            if state is not None and tagging_errors.is_final(tags):
+                state.record(path, tags)
+            if guard is not None and not guard.check():
+                # Stops the decode threads / workers and saves the caches, then flushes below
+                results.close()
+                status = long_run.EXIT_MEMORY_CEILING
+                break
+    with run_metrics.timed("output"):
+        writer.close()
+    run_metrics.stop_profiler(profiler, args.profile_output or run_metrics.default_profile_output(args.profile))
+    if args.metrics:
+        result = run_metrics.report(writer.count, time.perf_counter() - started, engine="blip")
+        run_metrics.write_sidecar(args.metrics, result)
+        print(f"Metrics: {result['summary']}", file=sys.stderr)
+    if state is not None:
+        state.close()
+        print(f"Incremental: {state.skipped} unchanged photo(s) skipped", file=sys.stderr)
+
+    if burst_groups.stats:
+        print(f"Near-duplicates: {burst_groups.stats_summary()}", file=sys.stderr)
+    if tagging_errors.stats:
+        print(f"Failed: {tagging_errors.stats_summary()}", file=sys.stderr)
+
+    if image_loader.stats:
+        print(f"Decode paths: {image_loader.stats_summary()}", file=sys.stderr)
+    if args.profile_startup:
+        print(model_registry.startup_report(), file=sys.stderr)
+    return status
 
 if __name__ == "__main__":
-    main()
+    long_run.fast_exit(main())
@@ -0,0 +1,199 @@
+"""
+Near-duplicate grouping, so a burst is classified once instead of per frame.
+
+Every photo gets a 64-bit difference hash (dHash) of a tiny grayscale
+decode: the 9x8 thumbnail's left/right brightness steps, one bit each.
+Frames of one burst differ in a few bits; unrelated photos in about half.
+Two photos are near-duplicates when their hashes agree on at least
+`similarity` of the bits.
+
+iter_grouped() hashes the photos ahead of the classifier, sends only the
+first photo of each group (its representative) through it, and hands out
+the representative's result for the rest of the group, in input order.
+A photo joins the group whose representative is nearest, so tags never
+drift along a long pan.
+"""
+import json
+import threading
+from collections import Counter, deque
+
+import numpy as np
+from PIL import Image
+
+import image_loader
+import image_pipeline
+import run_metrics
+import tagging_errors
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+# Share of the 64 hash bits two photos must agree on (0.9: at most 6 differ)
+DEFAULT_SIMILARITY = 0.9
+
+# Photos, groups and unreadable photos seen, for a summary at the end of a run
+stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def dhash(image_path):
+    """Returns the photo's 64-bit difference hash as an int, or None if it can't be decoded."""
+    with run_metrics.timed("hash", [image_path]):
+        try:
+            # A few dozen pixels are enough: JPEG/RAF previews decode at 1/8 scale
+            image, _ = image_loader.load_image(image_path, HASH_SIZE * 4, count=False)
+        except Exception:
+            # The classifier reports why it can't read the photo
+            return None
+        pixels = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def max_distance(similarity):
+    """Most hash bits two near-duplicates may differ in."""
+    if not 0.5 <= similarity <= 1.0:
+        raise ValueError(f"similarity must be between 0.5 and 1, got {similarity}")
+    return int((1.0 - similarity) * HASH_BITS + 1e-9)
+
+
+class HashIndex:
+    """
+    Finds the nearest stored hash within max_distance bits without comparing
+    against every stored one: the bits are cut into max_distance + 1 bands,
+    and two hashes that differ in at most max_distance bits must agree
+    exactly on at least one band, so only hashes sharing a band are compared.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        bounds = [HASH_BITS * i // bands for i in range(bands + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._buckets = [{} for _ in self._bands]
+        self._values = []
+
+    def add(self, value, item):
+        self._values.append((value, item))
+        position = len(self._values) - 1
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            buckets.setdefault((value >> shift) & mask, []).append(position)
+
+    def nearest(self, value):
+        """Returns the item stored with the nearest hash within max_distance bits, or None."""
+        best, best_distance = None, self.max_distance + 1
+        seen = set()
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            for position in buckets.get((value >> shift) & mask, ()):
+                if position in seen:
+                    continue
+                seen.add(position)
+                stored, item = self._values[position]
+                distance = bin(stored ^ value).count("1")
+                if distance < best_distance:
+                    best, best_distance = item, distance
+        return best
+
+    def __len__(self):
+        return len(self._values)
+
+
+def iter_grouped(image_paths, classify, similarity=DEFAULT_SIMILARITY, decode_workers=4,
+                 decode_timeout=tagging_errors.DEFAULT_DECODE_TIMEOUT):
+    """
+    Yields (result, group, duplicate_of) per input path, in input order.
+
+    classify(paths) must yield one result tuple per path, in order, starting
+    with the path (e.g. clip_classifier.iter_classify_images); it only sees
+    each group's representative. group numbers the groups in order of first
+    appearance; duplicate_of is the representative's path, or None for the
+    representative itself, whose result is passed through unchanged. Other
+    members get the same result with their own path. Photos that can't be
+    hashed in decode_timeout seconds form a group of their own.
+
+    A later photo may join any earlier group, so every hashed group's result
+    is kept for the whole run, compactly: JSON text of everything after the
+    path (about 150 bytes for ten tags). Groups that nothing can join (their
+    photo couldn't be hashed) are forgotten once handed out.
+    """
+    index = HashIndex(max_distance(similarity))
+    # (path, group, representative path or None) in input order, until their result is known
+    pending = deque()
+    representatives = []
+    # group -> result without the path, packed (see pack); hashed groups only once handed out
+    results = {}
+    # Groups sent to classify, whose results come back in the same order
+    waiting = deque()
+    unhashed = set()
+
+    def new_group(path):
+        representatives.append(path)
+        with _stats_lock:
+            stats["groups"] += 1
+        return len(representatives) - 1
+
+    def to_classify():
+        for path, future in image_pipeline.prefetch(image_paths, dhash, workers=decode_workers):
+            value = tagging_errors.resolve(future, decode_timeout)
+            if isinstance(value, tagging_errors.Failure):
+                value = None
+            group = index.nearest(value) if value is not None else None
+            with _stats_lock:
+                stats["photos"] += 1
+                if value is None:
+                    stats["unhashed"] += 1
+            if group is not None:
+                with _stats_lock:
+                    stats["duplicates"] += 1
+                pending.append((path, group, representatives[group]))
+                continue
+            group = new_group(path)
+            if value is not None:
+                index.add(value, group)
+            else:
+                unhashed.add(group)
+            waiting.append(group)
+            pending.append((path, group, None))
+            yield path
+
+    def ready():
+        while pending and pending[0][1] in results:
+            path, group, representative = pending.popleft()
+            result = (path,) + unpack(results[group])
+            if representative is None and group in unhashed:
+                # No photo can join it, and its own photo is the last that needed it
+                del results[group]
+                unhashed.discard(group)
+            yield result, group, representative
+
+    for result in classify(to_classify()):
+        results[waiting.popleft()] = pack(result[1:])
+        yield from ready()
+    # Duplicates of the last representatives
+    yield from ready()
+
+
+def pack(values):
+    """A result without its path as JSON text, or as is if it holds a Failure (which JSON would flatten)."""
+    if any(isinstance(value, tagging_errors.Failure) for value in values):
+        return values
+    return json.dumps(values)
+
+
+def unpack(packed):
+    return tuple(json.loads(packed)) if isinstance(packed, str) else tuple(packed)
+
+
+def annotate(entry, group, duplicate_of):
+    """Adds the group fields to a result entry (nothing when grouping is off)."""
+    if group is not None:
+        entry["group"] = group
+    if duplicate_of is not None:
+        entry["duplicate_of"] = duplicate_of
+    return entry
+
+
+def stats_summary():
+    """One-line summary, e.g. 'photos=120 groups=80 duplicates=40 unhashed=0'."""
+    with _stats_lock:
+        return " ".join(f"{name}={stats[name]}" for name in ("photos", "groups", "duplicates", "unhashed"))
@@ -0,0 +1,239 @@
+"""
+Category taxonomies and their precomputed prompt embeddings.
+
+A taxonomy is a JSON file (see taxonomies/):
+
+  {"name": "default", "categories": [{"name": "Landscape", "prompt": "A photo of a landscape..."}, ...]}
+
+where "prompt" defaults to the category name. A category may instead list
+several "prompts", whose embeddings are averaged into one (prompt ensembling),
+and may set its own "threshold" for select_tags().
+
+Prompt embeddings are compiled once per text model into a PromptIndex and
+memory-mapped from then on:
+
+  <cache_dir>/prompt-index/<model>/embeddings.f32  float32 rows, append-only
+                                   index.json      {"version": 1, "model": ..., "dim": ...,
+                                                    "rows": {sha1(prompt): row}}
+
+Compiling a taxonomy looks every prompt up by hash and encodes only the ones
+not stored yet, so editing a few prompts of a large taxonomy (or switching
+between taxonomies that share prompts) costs only those few.
+"""
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+import embedding_cache
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locking, single process assumed
+    fcntl = None
+
+INDEX_VERSION = 1
+
+TAXONOMY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "taxonomies")
+
+
+class Taxonomy:
+    def __init__(self, name, tag_names, prompts, thresholds):
+        self.name = name
+        self.tag_names = tag_names
+        # One list of prompts per category
+        self.prompts = prompts
+        # Per-category threshold, or None to use the request's threshold
+        self.thresholds = thresholds
+
+    @property
+    def all_prompts(self):
+        return [prompt for prompts in self.prompts for prompt in prompts]
+
+    def __len__(self):
+        return len(self.tag_names)
+
+
+def resolve_taxonomy(name_or_path):
+    """Accepts a taxonomy file path, or the name of a file in taxonomies/ ("clip_v2" or "clip_v2.json")."""
+    if os.path.isfile(name_or_path):
+        return os.path.abspath(name_or_path)
+    file_name = name_or_path if name_or_path.endswith(".json") else name_or_path + ".json"
+    candidate = os.path.join(TAXONOMY_DIR, file_name)
+    if os.path.isfile(candidate):
+        return candidate
+    raise FileNotFoundError(f"No taxonomy file or name: {name_or_path}")
+
+
+def load_taxonomy(path):
+    """Reads a taxonomy file; raises ValueError if it has no categories."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    tag_names = []
+    prompts = []
+    thresholds = []
+    for category in data.get("categories", []):
+        tag_names.append(category["name"])
+        prompts.append(list(category.get("prompts") or [category.get("prompt") or category["name"]]))
+        threshold = category.get("threshold")
+        thresholds.append(float(threshold) if threshold is not None else None)
+    if not tag_names:
+        raise ValueError(f"Taxonomy has no categories: {path}")
+
+    name = data.get("name") or os.path.splitext(os.path.basename(path))[0]
+    return Taxonomy(name, tag_names, prompts, thresholds)
+
+
+def taxonomy_digest(path):
+    """SHA-1 of a taxonomy file's contents, so edits to it (not just renames) count as a new taxonomy."""
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def prompt_key(prompt):
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+
+
+class PromptIndex:
+    """Prompt embeddings of one text model, keyed by prompt hash."""
+
+    def __init__(self, model_name, cache_dir=embedding_cache.DEFAULT_CACHE_DIR):
+        self.model_name = model_name
+        self.directory = os.path.join(cache_dir, "prompt-index", embedding_cache._model_dir_name(model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self._data_path = os.path.join(self.directory, "embeddings.f32")
+        self._index_path = os.path.join(self.directory, "index.json")
+        self.dim = None
+        self._rows = {}
+        self._matrix = None
+        self._load()
+
+    def _load(self):
+        self.dim = None
+        self._rows = {}
+        self._matrix = None
+        if not os.path.exists(self._index_path):
+            return
+        try:
+            with open(self._index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Another format version or model: start over
+        if index.get("version") != INDEX_VERSION or index.get("model") != self.model_name:
+            return
+
+        self.dim = index["dim"]
+        self._rows = index.get("rows", {})
+        if self._rows:
+            count = max(self._rows.values()) + 1
+            self._matrix = np.memmap(self._data_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+
+    def missing(self, prompts):
+        return [p for p in dict.fromkeys(prompts) if prompt_key(p) not in self._rows]
+
+    def embeddings(self, prompts):
+        """Returns a float32 [len(prompts), dim] array; every prompt must be in the index."""
+        rows = [self._rows[prompt_key(p)] for p in prompts]
+        return np.array(self._matrix[rows], dtype=np.float32)
+
+    def add(self, prompts, vectors):
+        """Appends new prompt embeddings and atomically rewrites the index (under a file lock)."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have added prompts since we loaded
+            self._load()
+            if self.dim is None or not self._rows:
+                self.dim = vectors.shape[1]
+                self._rows = {}
+                open(self._data_path, "wb").close()
+
+            first = max(self._rows.values()) + 1 if self._rows else 0
+            with open(self._data_path, "r+b") as f:
+                f.seek(first * self.dim * 4)
+                f.write(vectors.tobytes())
+            for offset, prompt in enumerate(prompts):
+                self._rows[prompt_key(prompt)] = first + offset
+
+            index = {"version": INDEX_VERSION, "model": self.model_name, "dim": self.dim, "rows": self._rows}
+            tmp_path = self._index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self._index_path)
+            self._load()
+
+
+def compile_prompts(model_name, prompts, encode, cache_dir=embedding_cache.DEFAULT_CACHE_DIR):
+    """
+    Returns a float32 [len(prompts), dim] array of prompt embeddings, calling
+    encode(list_of_prompts) -> array only for prompts the index doesn't have yet.
+    Falls back to encoding everything if the index can't be used.
+    """
+    try:
+        index = PromptIndex(model_name, cache_dir)
+        missing = index.missing(prompts)
+        if missing:
+            index.add(missing, encode(missing))
+        return index.embeddings(prompts)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Prompt index disabled: {e}", file=sys.stderr)
+        return np.asarray(encode(list(prompts)), dtype=np.float32)
+
+
+def compile_taxonomy(model_name, taxonomy, encode, cache_dir=embedding_cache.DEFAULT_CACHE_DIR):
+    """
+    Returns a float32 [len(taxonomy), dim] array with one unit-length embedding per
+    category: the mean of its (unit-length) prompt embeddings.
+    """
+    embeddings = compile_prompts(model_name, taxonomy.all_prompts, encode, cache_dir)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    counts = np.array([len(prompts) for prompts in taxonomy.prompts])
+    owners = np.repeat(np.arange(len(taxonomy)), counts)
+    means = np.zeros((len(taxonomy), embeddings.shape[1]), dtype=np.float32)
+    np.add.at(means, owners, embeddings)
+    means /= counts[:, None]
+    return means / np.linalg.norm(means, axis=1, keepdims=True)
+
+
+def threshold_vector(taxonomy):
+    """Per-category thresholds as a float32 array, NaN where the category has none."""
+    return np.array([np.nan if t is None else t for t in taxonomy.thresholds], dtype=np.float32)
+
+
+def select_tags(scores, tag_names, top_k, threshold, category_thresholds=None):
+    """
+    Multi-label selection over a [B, C] torch score matrix, as one batch operation:
+    per image, the top_k categories whose score reaches their threshold (the
+    category's own, from category_thresholds, where it isn't NaN, else `threshold`).
+    The best category is always kept, so every image gets at least one tag.
+    Returns one [(name, score), ...] list per image, best first.
+    """
+    import torch
+
+    k = max(1, min(int(top_k), scores.shape[-1]))
+    values, indices = scores.float().topk(k, dim=-1)
+
+    limits = torch.full((scores.shape[-1],), float(threshold), device=scores.device)
+    if category_thresholds is not None:
+        limits = torch.where(torch.isnan(category_thresholds), limits, category_thresholds)
+    keep = values >= limits[indices]
+    keep[:, 0] = True
+
+    return [
+        [(tag_names[i], round(v, 4)) for i, v, kept in zip(row_indices, row_values, row_keep) if kept]
+        for row_indices, row_values, row_keep in zip(indices.tolist(), values.tolist(), keep.tolist())
+    ]
+
+
+def top_margin(scores):
+    """Top-1 minus top-2 score per row of a [B, C] torch score matrix, as a list (how confident the best tag is)."""
+    if scores.shape[-1] < 2:
+        return [1.0] * scores.shape[0]
+    values = scores.float().topk(2, dim=-1).values
+    return [round(m, 4) for m in (values[:, 0] - values[:, 1]).tolist()]
@@ -1,163 +1,512 @@
-import torch
-import clip
-from PIL import Image, UnidentifiedImageError
-from pillow_heif import register_heif_opener
+import os
 import sys
+import time
 import json
+import argparse
 
-# Register the HEIF opener so Pillow can handle .heic/.heif/.hif
-register_heif_opener()
-
-# Load the CLIP model
-# device = "cuda" if torch.cuda.is_available() else "cpu"
-device = "mps" if torch.backends.mps.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
-
-# pool_of_tags = ["A close-up portrait emphasizing the subject’s expression and personality.", "A dramatic cityscape showcasing skyscrapers, bridges, and urban design.", "A sweeping natural vista with mountains, forests, or coastlines.", "A candid street scene capturing real-life moments and everyday urban life.", "A moody nighttime shot featuring light trails or illuminated city streets.", "An extreme close-up revealing fine details, textures, or abstract patterns.", "A high-energy moment freezing intense motion in a sporting event.", "A stylish editorial scene focusing on clothing, models, and trendy settings.", "A surreal or experimental composition playing with light, form, or symbolism.", "A vibrant travel scene featuring cultural landmarks, bustling markets, or scenic wonders."]
-categories = [
-    (
-        "Landscape",
-        "A photo of a landscape. There could be mountains, forests, or coastlines. All taken at a distance."
-    ),
-    (
-        "Night",
-        "A photo at night, outside, illuminated with city lights"
-    ),
-    (
-        "Winter Snow",
-        "A photo of the outdoors in the winter. Outside, snow covering the ground or environment."
-    ),
-    (
-        "Urban Downtown",
-        "A photo of urban downtown life, with skyscrapers or bustling streets."
-    ),
-    (
-        "Silhouette",
-        "A silhouette photo, where the subject is dark against a bright background."
-    ),
-    (
-        "Portrait",
-        "A photo of a person focusing on their face or upper body."
-    ),
-    (
-        "Closeup Nature",
-        "A photo of close-up natural elements, like leaves, insects, or small details."
-    ),
-    (
-        "Patterns/Detail",
-        "A photo emphasizing detail, patterns, or repetition in textures."
-    ),
-    (
-        "Fall Colors",
-        "A photo showing autumn foliage with red, orange, or yellow leaves."
-    ),
-    (
-        "Garden/Flowers",
-        "A photo of a garden or flowers in bloom."
-    ),
-    (
-        "Bodies of Water",
-        "A photo including lakes, rivers, or other bodies of water."
-    ),
-    (
-        "Oscar",
-        "A photo of a cat"
-    ),
-    (
-        "Suburbs",
-        "A photo highlighting the suburbs. The photo is predominantly small residential houses."
-    ),
-    (
-        "Lights & Shadow",
-        "A photo that focuses predominantly on lighting and harsh shadows"
-    ),
-]
-
-# Separate out the prompts for embedding
-tag_names = [c[0] for c in categories]
-pool_of_tags = [c[1] for c in categories]
-
-# 3) Precompute text embeddings for the 100 tags
-# ----------------------------
-text_tokens = clip.tokenize(pool_of_tags).to(device)
-with torch.no_grad():
-    text_features = model.encode_text(text_tokens)
-    # Normalize text features to unit length
-    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+import burst_groups
+import category_index
+import embedding_cache
+import image_loader
+import image_pipeline
+import inference_backends
+import long_run
+import model_registry
+import process_pool
+import run_metrics
+import tagging_errors
+import tagging_io
+import tagging_state
+import vector_index
 
-def classify_image(image_path, top_k=10, threshold=0.25):
-    """Classifies an image using CLIP and returns the best matching categories."""
+MODEL_NAME = "ViT-B/32"
 
-    # ----------------------------
-    # Check if the image is a RAW file, and skip
-    # ----------------------------
-    if image_path.lower().endswith(".raf"):
-            return []
+# torch/clip are imported and the model loaded by load_models(), once there are
+# photos to tag, so a bad invocation or an empty path list fails fast
+device = None
+model = None
+preprocess = None
+
+# Categories come from a taxonomy file (see category_index); switch with use_taxonomy()
+DEFAULT_TAXONOMY = os.path.join(category_index.TAXONOMY_DIR, "clip_default.json")
+taxonomy_path = DEFAULT_TAXONOMY
+tag_names = None
+pool_of_tags = None
+text_features = None
+# Per-category thresholds (NaN: use the request's threshold)
+category_thresholds = None
+# CLIP's learned temperature; scores are softmax(logit_scale * cosine similarity)
+logit_scale = None
+# dtype of the image features; text_features may be stored more compactly (see use_precision)
+feature_dtype = None
+precision = "fp32"
+
+# (taxonomy path, mtime, precision) -> (taxonomy, unit-length text features, thresholds), so switching back is free
+_compiled_taxonomies = {}
+
+def load_models():
+    """Imports torch/clip, loads CLIP and the default taxonomy's prompt embeddings, once per process."""
+    global device, model, preprocess, feature_dtype, logit_scale
+    with model_registry.lock:
+        if model is not None:
+            return
+
+        model_registry.import_module("torch")
+        clip = model_registry.import_module("clip")
+        device = model_registry.torch_device()
+        loaded_model, loaded_preprocess = model_registry.get(
+            ("clip", MODEL_NAME, device), lambda: clip.load(MODEL_NAME, device=device),
+            phase=f"load CLIP {MODEL_NAME} weights")
+        feature_dtype = loaded_model.dtype
+        logit_scale = float(loaded_model.logit_scale.detach().exp())
+
+        preprocess = loaded_preprocess
+        model = loaded_model
+        use_taxonomy(taxonomy_path)
+
+def encode_prompts(prompts):
+    """Encodes category prompts with CLIP's text tower. Returns unit-length float32 rows as a numpy array."""
+    import torch
+    import clip
+
+    with model_registry.timed("encode CLIP prompts"):
+        text_tokens = clip.tokenize(prompts).to(device)
+        with torch.no_grad():
+            features = model.encode_text(text_tokens)
+            # Normalize text features to unit length
+            features = features / features.norm(dim=-1, keepdim=True)
+    return features.float().cpu().numpy()
+
+def use_taxonomy(path=None):
+    """
+    Switches the categories to a taxonomy file or name (default: DEFAULT_TAXONOMY).
+    Only prompts missing from the on-disk prompt index are encoded; the model stays loaded.
+    """
+    global taxonomy_path, tag_names, pool_of_tags, text_features, category_thresholds
+    path = category_index.resolve_taxonomy(path) if path else DEFAULT_TAXONOMY
+    if model is None:
+        # load_models() compiles taxonomy_path right after loading the model
+        taxonomy_path = path
+        load_models()
+        return
+    import torch
+
+    with model_registry.lock:
+        # Prompt embeddings differ between the fp32 and int8 models
+        key = (path, os.stat(path).st_mtime_ns, precision)
+        if key not in _compiled_taxonomies:
+            taxonomy = category_index.load_taxonomy(path)
+            # The text tower is quantized too with int8, so its prompt embeddings are kept apart
+            index_name = MODEL_NAME if precision == "fp32" else f"{MODEL_NAME}|{precision}"
+            with model_registry.timed(f"compile taxonomy {taxonomy.name}"):
+                embeddings = category_index.compile_taxonomy(index_name, taxonomy, encode_prompts)
+            features = torch.from_numpy(embeddings).to(device=device, dtype=feature_dtype)
+            thresholds = torch.from_numpy(category_index.threshold_vector(taxonomy)).to(device)
+            _compiled_taxonomies[key] = (taxonomy, features, thresholds)
+
+        taxonomy, features, category_thresholds = _compiled_taxonomies[key]
+        tag_names, pool_of_tags = taxonomy.tag_names, taxonomy.prompts
+        text_features = features.half() if precision == "int8" else features
+        taxonomy_path = path
+
+def load_image_input(image_path):
+    """Loads and preprocesses one image. Returns a [3, H, W] tensor; raises if the file can't be decoded."""
 
     # ----------------------------
     # 4) Load and preprocess the image
     # ----------------------------
-    try:
-        image = Image.open(image_path).convert("RGB")
-    except UnidentifiedImageError:
-        # Can't open this file with Pillow, so skip or return empty
-        return []
+    # .raf files are read from their embedded JPEG preview; large JPEG/HEIF
+    # files are decoded at reduced size (see image_loader)
+    with run_metrics.timed("decode", [image_path]):
+        image, _ = image_loader.load_image(image_path, model.visual.input_resolution)
+
+    with run_metrics.timed("preprocess", [image_path]):
+        return preprocess(image)
+
+# Exported image encoder (see use_backend); None means eager model.encode_image
+image_encoder = None
+
+def use_backend(backend, model_dir=inference_backends.DEFAULT_MODEL_DIR):
+    """Switches encode_images to an exported TorchScript/ONNX image encoder, or back to eager ("torch")."""
+    global image_encoder
+    load_models()
+    image_encoder = inference_backends.load_encoder("clip_image_encoder", backend, MODEL_NAME,
+                                                    model_dir=model_dir, device=device)
+
+def use_precision(new_precision):
+    """
+    "int8" quantizes the model's Linear layers to int8 and keeps text_features in
+    float16; it can't be undone in-process. Only applies on CPU.
+    """
+    global precision
+    load_models()
+    with model_registry.lock:
+        if new_precision == precision:
+            return
+        if new_precision != "int8":
+            raise ValueError(f"Can't switch from {precision} to {new_precision} in-process")
+        if device != "cpu":
+            print(f"--precision int8 needs the CPU, staying at {precision} on {device}", file=sys.stderr)
+            return
+        inference_backends.quantize_linear_int8(model)
+        precision = new_precision
+        # Re-encodes the current taxonomy's prompts with the quantized model, as for any taxonomy compiled later
+        use_taxonomy(taxonomy_path)
 
-    image_input = preprocess(image).unsqueeze(0).to(device)
+def encode_images(image_inputs):
+    """Runs one encode_image over a stacked [B, 3, H, W] batch and returns unit-length features."""
+    import torch
 
     with torch.no_grad():
-        # Encode image and normalize
-        image_features = model.encode_image(image_input)
+        if image_encoder is not None:
+            image_features = image_encoder(image_inputs.to(device)).to(device=device, dtype=feature_dtype)
+        else:
+            image_features = model.encode_image(image_inputs.to(device))
         image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+    return image_features
 
-        # Compute cosine similarities to each text embedding
-        similarities = (image_features @ text_features.T).squeeze(0)
+def _encode_each(image_inputs):
+    """
+    encode_images over a list of [3, H, W] inputs; if the batch fails, encodes
+    them one by one. Returns one feature row per input, or a Failure for inputs
+    that fail on their own too.
+    """
+    import torch
 
-        # Get top_k matches
-        # best_matches = similarities.topk(top_k)
-        # top_indices = best_matches.indices.tolist()
-        # top_scores = best_matches.values.tolist()
+    try:
+        return list(encode_images(torch.stack(image_inputs)))
+    except Exception:
+        features = []
+        for image_input in image_inputs:
+            try:
+                features.append(encode_images(image_input.unsqueeze(0))[0])
+            except Exception as e:
+                features.append(tagging_errors.Failure("inference_error", f"{type(e).__name__}: {e}"))
+        return features
 
-    # Map indices to tag names and scores
-    # predicted_tags = []
-    # for idx, score in zip(top_indices, top_scores):
-    #     predicted_tags.append((pool_of_tags[idx], float(score)))
+def tags_from_features(image_features, top_k=10, threshold=0.25, with_margin=False):
+    """
+    Scores a [B, D] batch of image features against every category with a single
+    matmul and picks up to top_k tags per image whose probability reaches the
+    threshold (see category_index.select_tags). Returns [(name, score), ...] per image.
+    With with_margin, returns (tags per image, top-1 minus top-2 probability per image).
+    """
+    import torch
 
-    # ----------------------------
-    # 5) Filter tags by threshold (optional)
-    # ----------------------------
-    # filtered_tags = [(tag, s) for (tag, s) in predicted_tags if s > threshold]
+    with torch.no_grad():
+        # Compute cosine similarities to each text embedding, shape: [B, len(categories)]
+        similarities = image_features @ text_features.T.to(image_features.dtype)
+        # Zero-shot probabilities across the taxonomy, as in CLIP's own classifier
+        probabilities = (logit_scale * similarities.float()).softmax(dim=-1)
+
+    tags = category_index.select_tags(probabilities, tag_names, top_k, threshold, category_thresholds)
+    if with_margin:
+        return tags, category_index.top_margin(probabilities)
+    return tags
+
+def state_key(top_k, threshold, taxonomy=None, precision="fp32"):
+    """Identifies everything that decides a photo's tags, for incremental runs (see tagging_state). Loads no model."""
+    digest = category_index.taxonomy_digest(taxonomy or DEFAULT_TAXONOMY)
+    return tagging_state.run_key("clip", MODEL_NAME, precision, digest, top_k, threshold)
 
-    best_idx = int(torch.argmax(similarities))
-    best_tag_name = tag_names[best_idx]
+def open_cache(cache_dir=embedding_cache.DEFAULT_CACHE_DIR, max_mb=256, hash_content=False):
+    """Opens the on-disk image-embedding cache for this model, or returns None if it's unavailable."""
+    load_models()
+    # int8 embeddings drift slightly, so they don't share entries with fp32 ones
+    cache_name = MODEL_NAME if precision == "fp32" else f"{MODEL_NAME}|{precision}"
+    return embedding_cache.open_cache(cache_name, text_features.shape[-1], cache_dir=cache_dir,
+                                      max_mb=max_mb, hash_content=hash_content)
 
-    return [best_tag_name]
+def open_photo_index(cache_dir=embedding_cache.DEFAULT_CACHE_DIR):
+    """Opens the search index of this model's image embeddings for writing (see photo_search.py), or returns None."""
+    load_models()
+    # One index per model: int8 embeddings drift too little to matter for search
+    return vector_index.open_index(MODEL_NAME, text_features.shape[-1], cache_dir=cache_dir)
+
+def iter_classify_images(image_paths, top_k=10, threshold=0.25, batch_size=16, decode_workers=4, prefetch_depth=None,
+                         cache=None, with_margin=False, decode_timeout=tagging_errors.DEFAULT_DECODE_TIMEOUT,
+                         retries=tagging_errors.DEFAULT_RETRIES, photo_index=None):
+    """
+    Classifies images in mini-batches of batch_size.
+    Yields (path, tags) per input path, in input order, as each batch finishes
+    (a tagging_errors.Failure, an empty list, for files that can't be tagged).
+    image_paths may be any iterable, including a stream.
+    With with_margin, yields (path, tags, margin) instead, where margin is the
+    top-1 minus top-2 probability (None for failed files).
+
+    Images are decoded and preprocessed by decode_workers threads, up to
+    prefetch_depth images ahead of the batch currently running through the model.
+    A decode that fails with an I/O error is retried up to `retries` times; one
+    that keeps the batch waiting for decode_timeout seconds is given up on.
+    With a cache (see open_cache), photos whose embedding is already stored skip
+    decoding and encode_image entirely; new embeddings are added to it.
+    With a photo_index (see open_photo_index), every photo's embedding is
+    added to it, so it can be found by photo_search.py.
+    """
+    load_models()
+    if prefetch_depth is None:
+        prefetch_depth = 2 * batch_size
+    load_input = tagging_errors.retrying(load_image_input, retries)
+
+    def load(path):
+        # Returns ("cached", key, vector) or ("input", key, tensor); raises if the file can't be decoded
+        key = None
+        if cache is not None:
+            key = cache.key(path)
+            cached = cache.get(path, key)
+            if cached is not None:
+                return "cached", key, cached
+        return "input", key, load_input(path)
+
+    loaded = image_pipeline.prefetch(image_paths, load, workers=decode_workers, depth=prefetch_depth)
+
+    try:
+        for batch in image_pipeline.batched(loaded, batch_size):
+            results = _classify_batch(batch, top_k, threshold, cache, with_margin, decode_timeout, photo_index)
+            # Frees the batch's decoded images before its results are handed out
+            batch.clear()
+            yield from results
+    finally:
+        if cache is not None:
+            cache.save()
+        if photo_index is not None:
+            photo_index.save()
+
+def _classify_batch(batch, top_k, threshold, cache, with_margin=False, decode_timeout=None, photo_index=None):
+    """Classifies one batch of (path, future) pairs; returns [(path, tags), ...] in batch order."""
+    import torch
+
+    # Failed files keep a Failure as their result; everything else gets a feature row
+    results = [(path, [], None) if with_margin else (path, []) for path, _ in batch]
+
+    def fail(i, failure):
+        results[i] = (results[i][0], failure, None) if with_margin else (results[i][0], failure)
+
+    rows = {}
+    misses = []
+    for i, (path, future) in enumerate(batch):
+        item = tagging_errors.resolve(future, decode_timeout)
+        if isinstance(item, tagging_errors.Failure):
+            fail(i, item)
+            continue
+        kind, key, value = item
+        if kind == "cached":
+            rows[i] = torch.from_numpy(value).to(device=device, dtype=feature_dtype)
+            if photo_index is not None:
+                photo_index.put(path, value)
+        else:
+            misses.append((i, path, key, value))
+
+    if misses:
+        with run_metrics.timed("forward", [path for _, path, _, _ in misses]):
+            image_features = _encode_each([value for _, _, _, value in misses])
+        for (i, path, key, _), features in zip(misses, image_features):
+            if isinstance(features, tagging_errors.Failure):
+                fail(i, features)
+                continue
+            rows[i] = features
+            if cache is not None or photo_index is not None:
+                vector = features.float().cpu().numpy()
+                if cache is not None:
+                    cache.put(path, vector, key)
+                if photo_index is not None:
+                    photo_index.put(path, vector)
+        del misses
+
+    if not rows:
+        return results
+
+    indices = sorted(rows)
+    image_features = torch.stack([rows[i] for i in indices])
+    with run_metrics.timed("score", [results[i][0] for i in indices]):
+        if with_margin:
+            tags, margins = tags_from_features(image_features, top_k, threshold, with_margin=True)
+        else:
+            tags, margins = tags_from_features(image_features, top_k, threshold), None
+    if with_margin:
+        for i, image_tags, margin in zip(indices, tags, margins):
+            results[i] = (results[i][0], image_tags, margin)
+        return results
+
+    for i, image_tags in zip(indices, tags):
+        results[i] = (results[i][0], image_tags)
+
+    return results
+
+def classify_images(image_paths, top_k=10, threshold=0.25, batch_size=16, decode_workers=4, prefetch_depth=None,
+                    cache=None):
+    """
+    Classifies a list of images in mini-batches of batch_size.
+    Returns one tag list per input path, in input order (a Failure, an empty list, for failed files).
+    See iter_classify_images for the other arguments.
+    """
+    return [tags for _, tags in iter_classify_images(image_paths, top_k, threshold, batch_size, decode_workers,
+                                                     prefetch_depth, cache)]
+
+def classify_image(image_path, top_k=10, threshold=0.25):
+    """Classifies an image using CLIP and returns the best matching categories as [(name, score), ...]."""
+    return classify_images([image_path], top_k=top_k, threshold=threshold, batch_size=1, decode_workers=0)[0]
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python clip_multilabel.py /path/to/photo_paths.json [top_k=10] [threshold=0.25]")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="Tag photos with CLIP.",
+        usage="python clip_classifier.py /path/to/photo_paths.json [top_k=10] [threshold=0.1] [--batch-size N] [--decode-workers N] [--dedupe] [--stream]",
+    )
+    parser.add_argument("json_file", help="JSON array of paths, or NDJSON (.ndjson / - for stdin) with one path per line")
+    parser.add_argument("top_k", nargs="?", type=int, default=10,
+                        help="Max tags per photo (default: 10)")
+    parser.add_argument("threshold", nargs="?", type=float, default=0.1,
+                        help="Min probability (softmax across the taxonomy, not cosine similarity) for a tag beyond the best one, "
+                             "unless the taxonomy sets its own (default: 0.1)")
+    parser.add_argument("--batch-size", type=int, default=16,
+                        help="Number of images per encode_image call (default: 16)")
+    parser.add_argument("--decode-workers", type=int, default=4,
+                        help="Threads decoding/preprocessing images ahead of the model, 0 to decode inline (default: 4)")
+    parser.add_argument("--prefetch", type=int, default=None,
+                        help="Max images decoded ahead of the model (default: 2 x batch size)")
+    parser.add_argument("--decode-timeout", type=float, default=tagging_errors.DEFAULT_DECODE_TIMEOUT,
+                        help="Seconds a photo's decode may keep the model waiting before it fails, 0 for no limit; "
+                             "the decode thread itself isn't stopped, and inline decoding (--decode-workers 0) "
+                             "has no limit (default: 60)")
+    parser.add_argument("--retries", type=int, default=tagging_errors.DEFAULT_RETRIES,
+                        help="Extra attempts at a decode that fails with a transient I/O error, e.g. EIO (default: 1)")
+    parser.add_argument("--cache-dir", default=embedding_cache.DEFAULT_CACHE_DIR,
+                        help="Where image embeddings are cached between runs")
+    parser.add_argument("--cache-size-mb", type=float, default=256,
+                        help="Cap on the embedding cache; least recently used entries are evicted (default: 256)")
+    parser.add_argument("--hash-content", action="store_true",
+                        help="Key the cache on a hash of the file bytes instead of path/size/mtime")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always decode and encode every image")
+    parser.add_argument("--no-photo-index", action="store_true",
+                        help="Don't add the photos' embeddings to the search index (see photo_search.py)")
+    parser.add_argument("--backend", choices=inference_backends.BACKENDS, default="torch",
+                        help="Image encoder backend; torchscript/onnx need export_models.py first (default: torch)")
+    parser.add_argument("--model-dir", default=inference_backends.DEFAULT_MODEL_DIR,
+                        help="Where export_models.py wrote the exported encoders")
+    parser.add_argument("--precision", choices=inference_backends.PRECISIONS, default="fp32",
+                        help="int8: quantize the model's Linear layers to cut memory (torch backend, CPU only)")
+    parser.add_argument("--taxonomy", default=None,
+                        help="Taxonomy file, or name of one in taxonomies/, with the categories to tag with (default: taxonomies/clip_default.json)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes, each with its own model copy; "
+                             "disables the on-disk cache and photo index (default: 1)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch threads per worker process (default: cores / workers)")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Tag each burst / group of near-duplicate photos once, from its first photo")
+    parser.add_argument("--dedupe-similarity", type=float, default=burst_groups.DEFAULT_SIMILARITY,
+                        help="Share of perceptual-hash bits near-duplicates agree on, 0.5-1 (default: 0.9)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip photos whose file, models, taxonomy and settings are unchanged since their last run")
+    parser.add_argument("--state-db", default=tagging_state.DEFAULT_STATE_DB,
+                        help="Incremental state database (default: state.sqlite in the cache directory)")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print time spent on imports, loading weights and encoding prompts to stderr")
+    parser.add_argument("--metrics", metavar="FILE", default=None,
+                        help="Write per-stage and per-photo timings, peak RSS and images/sec to this .json or .csv file")
+    parser.add_argument("--profile", choices=run_metrics.PROFILERS, default=None,
+                        help="Run under cProfile or the torch profiler and print the top entries to stderr")
+    parser.add_argument("--profile-output", default=None,
+                        help="Where --profile saves its data (default: tagging.prof / tagging_trace.json)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Print one JSON line per image as soon as it is tagged instead of one array at the end")
+    parser.add_argument("--max-rss-mb", type=float, default=None,
+                        help="Memory ceiling in MB for this process and its workers: above it, free what can be freed, "
+                             f"else stop with exit status {long_run.EXIT_MEMORY_CEILING} (see long_run.py, which resumes)")
+    args = parser.parse_args()
+
+    if args.taxonomy:
+        try:
+            args.taxonomy = category_index.resolve_taxonomy(args.taxonomy)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+    if args.batch_size < 1 or args.workers < 1:
+        parser.error("--batch-size and --workers must be at least 1")
+    if not 0.5 <= args.dedupe_similarity <= 1:
+        parser.error("--dedupe-similarity must be between 0.5 and 1")
+    if args.precision != "fp32" and args.backend != "torch":
+        parser.error("--precision only applies to the torch backend")
+
+    if args.metrics:
+        run_metrics.enable()
+    started = time.perf_counter()
+    profiler = run_metrics.start_profiler(args.profile)
+
+    # Load the list of image paths from JSON (read lazily when streamed as NDJSON)
+    image_paths = tagging_io.read_paths(args.json_file)
+    state = tagging_state.open_state(args.state_db) if args.incremental else None
+    if state is not None:
+        image_paths = state.pending(image_paths, state_key(args.top_k, args.threshold, args.taxonomy, args.precision))
+    image_paths = tagging_io.nonempty(image_paths)
+
+    writer = tagging_io.ResultWriter(stream=args.stream)
+    guard = long_run.open_guard(args.max_rss_mb)
+    status = 0
+    # With nothing to tag, answer right away without importing torch or loading CLIP
+    if image_paths is not None:
+        classify_kwargs = dict(top_k=args.top_k, threshold=args.threshold, batch_size=args.batch_size,
+                               decode_workers=args.decode_workers, prefetch_depth=args.prefetch,
+                               decode_timeout=args.decode_timeout, retries=args.retries)
+        if args.workers > 1:
+            setup = [("use_taxonomy", (args.taxonomy,)), ("use_backend", (args.backend, args.model_dir)),
+                     ("use_precision", (args.precision,))]
+
+            def classify(paths):
+                return process_pool.iter_sharded("clip_classifier", paths, classify_kwargs, setup,
+                                                 workers=args.workers, threads_per_worker=args.threads_per_worker)
+        else:
+            use_taxonomy(args.taxonomy)
+            use_backend(args.backend, args.model_dir)
+            use_precision(args.precision)
+
+            cache = None
+            if not args.no_cache:
+                cache = open_cache(args.cache_dir, max_mb=args.cache_size_mb, hash_content=args.hash_content)
+            photo_index = None if args.no_photo_index else open_photo_index(args.cache_dir)
 
-    json_file = sys.argv[1]
-    top_k = 10
-    threshold = 0.1
+            def classify(paths):
+                return iter_classify_images(paths, cache=cache, photo_index=photo_index, **classify_kwargs)
 
-    if len(sys.argv) >= 3:
-        top_k = int(sys.argv[2])
-    if len(sys.argv) >= 4:
-        threshold = float(sys.argv[3])
+        if args.dedupe:
+            results = burst_groups.iter_grouped(image_paths, classify, args.dedupe_similarity, args.decode_workers,
+                                                  args.decode_timeout)
+        else:
+            results = ((result, None, None) for result in classify(image_paths))
 
-    # Load the list of image paths from JSON
-    with open(json_file, "r") as f:
-        image_paths = json.load(f)
+        for (path, tags), group, duplicate_of in results:
+            entry = tagging_errors.annotate({"image_path": path, "tags": tags})
+            with run_metrics.timed("output", [path]):
+                writer.write(burst_groups.annotate(entry, group, duplicate_of))
+            # Failures worth another try aren't recorded, so the next incremental run retries them
+            if state is not None and tagging_errors.is_final(tags):
+                state.record(path, tags)
+            if guard is not None and not guard.check():
+                # Stops the decode threads / workers and saves the caches, then flushes below
+                results.close()
+                status = long_run.EXIT_MEMORY_CEILING
+                break
+    with run_metrics.timed("output"):
+        writer.close()
+    run_metrics.stop_profiler(profiler, args.profile_output or run_metrics.default_profile_output(args.profile))
+    if args.metrics:
+        result = run_metrics.report(writer.count, time.perf_counter() - started, engine="clip")
+        run_metrics.write_sidecar(args.metrics, result)
+        print(f"Metrics: {result['summary']}", file=sys.stderr)
+    if state is not None:
+        state.close()
+        print(f"Incremental: {state.skipped} unchanged photo(s) skipped", file=sys.stderr)
 
-    results = []
-    for path in image_paths:
-        tags = classify_image(path, top_k=top_k, threshold=threshold)
-        results.append({"image_path": path, "tags": tags})
+    if burst_groups.stats:
+        print(f"Near-duplicates: {burst_groups.stats_summary()}", file=sys.stderr)
+    if tagging_errors.stats:
+        print(f"Failed: {tagging_errors.stats_summary()}", file=sys.stderr)
 
-    # Output one JSON array with all results
-    print(json.dumps(results))
+    if image_loader.stats:
+        print(f"Decode paths: {image_loader.stats_summary()}", file=sys.stderr)
+    if args.profile_startup:
+        print(model_registry.startup_report(), file=sys.stderr)
+    return status
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    long_run.fast_exit(main())
@@ -0,0 +1,209 @@
+"""
+On-disk cache of image embeddings, keyed by file identity and model.
+
+Each model gets its own directory (so ViT-B/32 vectors never mix with another
+model's) holding:
+
+  embeddings.f16  fixed-capacity float16 matrix, memory-mapped
+  index.json      {"model": ..., "dim": ..., "entries": [[key, slot, meta], ...]}
+                  with entries in least- to most-recently-used order; meta is
+                  optional JSON stored alongside the vector (e.g. a caption)
+
+A file is identified by absolute path + size + mtime, or, with
+hash_content=True, by the SHA-1 of its bytes so renamed/moved files still hit.
+When the matrix is full, the least recently used entries are evicted in a
+batch and the index is rewritten without them before their slots are reused,
+so a crash before save() never leaves a saved key pointing at another file's
+vector.
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locking, single process assumed
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "lightroom-deep-tag")
+
+# Share of the capacity evicted at once when the matrix is full (each eviction rewrites the index)
+EVICT_FRACTION = 1 / 64
+
+
+class CacheLockedError(RuntimeError):
+    """Another process already has this model's cache open."""
+
+
+def file_key(path, hash_content=False):
+    """Returns the cache key for a file, or None if it can't be stat'ed/read."""
+    try:
+        if hash_content:
+            digest = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            return "sha1:" + digest.hexdigest()
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+
+def _model_dir_name(model_name):
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_name)[:40]
+    return f"{safe}-{hashlib.sha1(model_name.encode('utf-8')).hexdigest()[:8]}"
+
+
+class EmbeddingCache:
+    def __init__(self, model_name, dim, cache_dir=DEFAULT_CACHE_DIR, max_mb=256, hash_content=False):
+        self.model_name = model_name
+        self.dim = dim
+        self.hash_content = hash_content
+        self.capacity = max(1, int(max_mb * (1 << 20)) // (dim * 2))
+        self.hits = 0
+        self.misses = 0
+
+        self.directory = os.path.join(cache_dir, _model_dir_name(model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self._data_path = os.path.join(self.directory, "embeddings.f16")
+        self._index_path = os.path.join(self.directory, "index.json")
+
+        self._lock = threading.Lock()
+        self._lock_file = self._acquire_process_lock()
+
+        # key -> slot, least recently used first
+        self._slots = OrderedDict()
+        self._meta = {}
+        self._free = []
+        self._dirty = False
+        self._load()
+
+    def _acquire_process_lock(self):
+        lock_file = open(os.path.join(self.directory, ".lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise CacheLockedError(f"Embedding cache in use by another process: {self.directory}")
+        return lock_file
+
+    def _load(self):
+        entries = []
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r") as f:
+                    index = json.load(f)
+                if index.get("model") == self.model_name and index.get("dim") == self.dim:
+                    entries = index.get("entries", [])
+            except (OSError, ValueError):
+                entries = []
+
+        # Create or resize the backing file; extending it leaves a sparse tail
+        size = self.capacity * self.dim * 2
+        with open(self._data_path, "ab") as f:
+            f.truncate(size)
+        self._matrix = np.memmap(self._data_path, dtype=np.float16, mode="r+", shape=(self.capacity, self.dim))
+
+        used = set()
+        for entry in entries:
+            key, slot = entry[0], entry[1]
+            # Entries beyond a shrunk capacity are simply dropped
+            if 0 <= slot < self.capacity and slot not in used:
+                self._slots[key] = slot
+                if len(entry) > 2 and entry[2] is not None:
+                    self._meta[key] = entry[2]
+                used.add(slot)
+        self._free = [slot for slot in range(self.capacity - 1, -1, -1) if slot not in used]
+
+    def key(self, path):
+        return file_key(path, self.hash_content)
+
+    def get(self, path, key=None):
+        """Returns the cached float16 vector for path (a copy), or None."""
+        entry = self.get_entry(path, key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, path, key=None):
+        """Returns (float16 vector, meta) for path, or None."""
+        key = key or self.key(path)
+        with self._lock:
+            slot = self._slots.get(key) if key else None
+            if slot is None:
+                self.misses += 1
+                return None
+            self._slots.move_to_end(key)
+            self._dirty = True
+            self.hits += 1
+            return np.array(self._matrix[slot]), self._meta.get(key)
+
+    def put(self, path, vector, key=None, meta=None):
+        key = key or self.key(path)
+        if key is None:
+            return
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                if not self._free:
+                    self._evict()
+                slot = self._free.pop()
+            self._slots[key] = slot
+            if meta is not None:
+                self._meta[key] = meta
+            else:
+                self._meta.pop(key, None)
+            self._slots.move_to_end(key)
+            self._matrix[slot] = np.asarray(vector, dtype=np.float16)
+            self._dirty = True
+
+    def _evict(self):
+        # Drop the least recently used entries from the saved index before their slots are overwritten
+        freed = []
+        for _ in range(min(len(self._slots), max(1, int(self.capacity * EVICT_FRACTION)))):
+            evicted, slot = self._slots.popitem(last=False)
+            self._meta.pop(evicted, None)
+            freed.append(slot)
+        self._write_index()
+        self._free.extend(reversed(freed))
+
+    def _write_index(self):
+        self._matrix.flush()
+        index = {
+            "model": self.model_name,
+            "dim": self.dim,
+            "entries": [[key, slot, self._meta.get(key)] for key, slot in self._slots.items()],
+        }
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._slots)
+
+    def save(self):
+        """Flushes vectors and atomically rewrites the index."""
+        with self._lock:
+            if self._dirty:
+                self._write_index()
+
+    def close(self):
+        self.save()
+        del self._matrix
+        self._lock_file.close()
+
+
+def open_cache(model_name, dim, **kwargs):
+    """Opens a cache, or returns None (with a warning) if another process holds it."""
+    try:
+        return EmbeddingCache(model_name, dim, **kwargs)
+    except (CacheLockedError, OSError) as e:
+        print(f"Embedding cache disabled: {e}", file=sys.stderr)
+        return None
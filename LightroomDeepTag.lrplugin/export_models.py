@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Exports the per-image encoders to ONNX or TorchScript for the CPU backends in
+inference_backends.py, and checks that the exported graphs tag like eager PyTorch.
+
+  clip_image_encoder   CLIP ViT-B/32 image tower (clip_classifier.py)
+  minilm_text_encoder  MiniLM caption encoder incl. pooling (blip_classifier.py)
+  blip_vision_encoder  BLIP ViT image encoder (blip_classifier.py)
+
+Usage:
+  python export_models.py --format onnx [--models clip minilm blip] [--model-dir exported_models]
+  python export_models.py --format onnx --check-parity [--images a.jpg b.jpg ...]
+
+--check-parity compares top-1 tags of the exported and eager encoders on a
+fixture set (the given images, or deterministic synthetic ones) and exits
+non-zero on any mismatch.
+"""
+import argparse
+import inspect
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+from PIL import Image
+
+import inference_backends
+
+ONNX_OPSET = 17
+
+
+class _ClipImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.encode_image(pixel_values)
+
+
+class _SentenceEncoder(torch.nn.Module):
+    """SentenceTransformer forward (transformer + pooling + normalize) on token ids."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model({"input_ids": input_ids, "attention_mask": attention_mask})["sentence_embedding"]
+
+
+class _BlipVisionEncoder(torch.nn.Module):
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values)[0]
+
+
+def _export(module, example_inputs, input_names, output_name, dynamic_axes, path, fmt):
+    module = module.eval().cpu()
+    with torch.no_grad():
+        if fmt == "torchscript":
+            torch.jit.trace(module, example_inputs, check_trace=False).save(path)
+            return
+
+        kwargs = {}
+        # Newer torch defaults to the dynamo exporter; the TorchScript-based one handles these models as-is
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            kwargs["dynamo"] = False
+        torch.onnx.export(
+            module, example_inputs, path,
+            input_names=input_names,
+            output_names=[output_name],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+            **kwargs,
+        )
+
+
+def export_clip(model_dir, fmt):
+    import clip_classifier
+
+    clip_classifier.load_models()
+    resolution = clip_classifier.model.visual.input_resolution
+    module = _ClipImageEncoder(clip_classifier.model.float())
+    _export(module, (torch.randn(2, 3, resolution, resolution),), ["pixel_values"], "image_embeds",
+            {"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            inference_backends.exported_path(model_dir, "clip_image_encoder", fmt), fmt)
+    return "clip_image_encoder", clip_classifier.MODEL_NAME
+
+
+def export_minilm(model_dir, fmt):
+    import blip_classifier
+
+    blip_classifier.load_matcher()
+    model = blip_classifier.similarity_model.cpu()
+    features = model.tokenize(["a photo of a cat", "a longer example caption so the sequence axis varies"])
+    _export(_SentenceEncoder(model), (features["input_ids"], features["attention_mask"]),
+            ["input_ids", "attention_mask"], "sentence_embedding",
+            {"input_ids": {0: "batch", 1: "tokens"}, "attention_mask": {0: "batch", 1: "tokens"},
+             "sentence_embedding": {0: "batch"}},
+            inference_backends.exported_path(model_dir, "minilm_text_encoder", fmt), fmt)
+    model.to(blip_classifier.device)
+    return "minilm_text_encoder", blip_classifier.SIMILARITY_MODEL_NAME
+
+
+def export_blip(model_dir, fmt):
+    import blip_classifier
+
+    blip_classifier.load_captioner()
+    vision_model = blip_classifier._eager_vision_model.cpu()
+    size = blip_classifier.blip_processor.image_processor.size["height"]
+    _export(_BlipVisionEncoder(vision_model), (torch.randn(1, 3, size, size),), ["pixel_values"],
+            "last_hidden_state", {"pixel_values": {0: "batch"}, "last_hidden_state": {0: "batch"}},
+            inference_backends.exported_path(model_dir, "blip_vision_encoder", fmt), fmt)
+    vision_model.to(blip_classifier.device)
+    return "blip_vision_encoder", blip_classifier.BLIP_MODEL_NAME
+
+
+EXPORTERS = {
+    "clip": export_clip,
+    "minilm": export_minilm,
+    "blip": export_blip,
+}
+
+
+def write_manifest(model_dir, exported):
+    manifest = inference_backends.read_manifest(model_dir)
+    manifest.update(exported)
+    with open(os.path.join(model_dir, inference_backends.MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+# ----------------------------------------
+# Parity checks: exported graph vs eager PyTorch
+# ----------------------------------------
+def fixture_images(paths, count=16, seed=0):
+    """The given images, or deterministic synthetic ones when none are given."""
+    if paths:
+        return [Image.open(p).convert("RGB") for p in paths]
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        base = rng.integers(0, 256, size=3)
+        noise = rng.integers(-60, 60, size=(480, 640, 3))
+        images.append(Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8), "RGB"))
+    return images
+
+
+def check_clip(images, fmt, model_dir):
+    import clip_classifier
+
+    clip_classifier.load_models()
+    batch = torch.stack([clip_classifier.preprocess(image) for image in images])
+    clip_classifier.use_backend("torch")
+    eager = clip_classifier.tags_from_features(clip_classifier.encode_images(batch))
+    clip_classifier.use_backend(fmt, model_dir)
+    exported = clip_classifier.tags_from_features(clip_classifier.encode_images(batch))
+    clip_classifier.use_backend("torch")
+    return sum(a[0][0] == b[0][0] for a, b in zip(eager, exported)), len(eager)
+
+
+def check_minilm(fmt, model_dir):
+    import blip_classifier
+
+    blip_classifier.load_matcher()
+    # The category prompts themselves plus a few caption-like sentences
+    captions = [prompts[0] for prompts in blip_classifier.tag_prompts] + [
+        "a cat sitting on a window sill",
+        "a city street at night with cars and lights",
+        "a snowy mountain range under a blue sky",
+        "a woman smiling in front of a brick wall",
+    ]
+    blip_classifier.use_backend("torch")
+    eager = [blip_classifier.match_caption_to_category(c)[0] for c in captions]
+    blip_classifier.use_backend(fmt, model_dir)
+    exported = [blip_classifier.match_caption_to_category(c)[0] for c in captions]
+    blip_classifier.use_backend("torch")
+    return sum(a == b for a, b in zip(eager, exported)), len(eager)
+
+
+def check_blip_vision(images, fmt, model_dir):
+    """Max absolute difference of BLIP vision hidden states (captions follow from these)."""
+    import blip_classifier
+
+    blip_classifier.load_captioner()
+    pixel_values = blip_classifier.blip_processor(images=images[:4], return_tensors="pt")["pixel_values"]
+    with torch.no_grad():
+        eager = blip_classifier._eager_vision_model(pixel_values=pixel_values.to(blip_classifier.device))[0].cpu()
+    encoder = inference_backends.load_encoder("blip_vision_encoder", fmt, blip_classifier.BLIP_MODEL_NAME,
+                                              model_dir=model_dir)
+    exported = encoder(pixel_values).cpu()
+    return float((eager - exported).abs().max())
+
+
+def check_parity(models, fmt, model_dir, image_paths):
+    images = fixture_images(image_paths)
+    ok = True
+    if "clip" in models:
+        matched, total = check_clip(images, fmt, model_dir)
+        print(f"clip_image_encoder  top-1 agreement: {matched}/{total}")
+        ok &= matched == total
+    if "minilm" in models:
+        matched, total = check_minilm(fmt, model_dir)
+        print(f"minilm_text_encoder top-1 agreement: {matched}/{total}")
+        ok &= matched == total
+    if "blip" in models:
+        diff = check_blip_vision(images, fmt, model_dir)
+        print(f"blip_vision_encoder max |eager - {fmt}|: {diff:.2e}")
+        ok &= diff < 1e-3
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export CLIP/MiniLM/BLIP encoders for the CPU backends.")
+    parser.add_argument("--format", choices=("onnx", "torchscript"), default="onnx")
+    parser.add_argument("--models", nargs="+", choices=sorted(EXPORTERS), default=sorted(EXPORTERS))
+    parser.add_argument("--model-dir", default=inference_backends.DEFAULT_MODEL_DIR)
+    parser.add_argument("--check-parity", action="store_true",
+                        help="Compare already-exported graphs with eager PyTorch instead of exporting")
+    parser.add_argument("--images", nargs="*", default=[],
+                        help="Fixture images for --check-parity (default: synthetic images)")
+    args = parser.parse_args()
+
+    if args.check_parity:
+        sys.exit(0 if check_parity(args.models, args.format, args.model_dir, args.images) else 1)
+
+    os.makedirs(args.model_dir, exist_ok=True)
+    exported = {}
+    for name in args.models:
+        component, model_name = EXPORTERS[name](args.model_dir, args.format)
+        exported[component] = {"model": model_name}
+        print(f"Exported {component} ({model_name}) as {args.format}")
+    write_manifest(args.model_dir, exported)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Two-stage cascade: CLIP tags every photo, BLIP re-tags only the uncertain ones.
+
+CLIP costs one forward pass per photo; BLIP's beam-search captioning costs
+seconds. A photo goes to BLIP only when CLIP's top-1 probability beats its
+top-2 by less than min_margin, so most photos get CLIP's tags at CLIP cost.
+
+Every result says which stage produced its tags ("clip", "blip", or
+"skipped" for files neither could read; "duplicate" when --dedupe copied
+them from the photo's burst); stats counts them per run.
+"""
+import argparse
+import sys
+import time
+from collections import Counter
+
+import blip_classifier
+import burst_groups
+import category_index
+import clip_classifier
+import embedding_cache
+import image_loader
+import image_pipeline
+import inference_backends
+import long_run
+import model_registry
+import process_pool
+import run_metrics
+import tagging_errors
+import tagging_io
+import tagging_state
+
+ENGINES = (clip_classifier, blip_classifier)
+
+# How many photos each stage handled, for a summary at the end of a run
+stats = Counter()
+
+
+def stats_summary():
+    """One-line summary of the stages, e.g. 'clip=120 blip=14 skipped=2 duplicate=0'."""
+    return " ".join(f"{stage}={stats[stage]}" for stage in ("clip", "blip", "skipped", "duplicate"))
+
+# ----------------------------------------
+# 1) SETUP: both engines, configured together
+# ----------------------------------------
+def load_models():
+    """Loads CLIP and BLIP up front (e.g. to preload the tagging server)."""
+    for engine in ENGINES:
+        engine.load_models()
+
+
+def use_taxonomy(path=None):
+    """Switches both engines to a taxonomy, or each back to its own default taxonomy."""
+    for engine in ENGINES:
+        engine.use_taxonomy(path)
+
+
+def use_backend(backend, model_dir=inference_backends.DEFAULT_MODEL_DIR):
+    for engine in ENGINES:
+        engine.use_backend(backend, model_dir)
+
+
+def use_precision(new_precision):
+    for engine in ENGINES:
+        engine.use_precision(new_precision)
+
+
+def use_decode_profile(profile, early_stop=None):
+    """Selects BLIP's decode profile (see blip_classifier.use_decode_profile)."""
+    blip_classifier.use_decode_profile(profile, early_stop)
+
+
+def state_key(top_k, threshold, min_margin, blip_top_k, blip_threshold, taxonomy=None, precision="fp32"):
+    """Identifies everything that decides a photo's tags, for incremental runs (see tagging_state). Loads no model."""
+    return tagging_state.run_key("hybrid", clip_classifier.state_key(top_k, threshold, taxonomy, precision),
+                                 blip_classifier.state_key(blip_top_k, blip_threshold, taxonomy, precision), min_margin)
+
+# ----------------------------------------
+# 2) FUNCTION: Classify images (CLIP, then BLIP where CLIP is unsure)
+# ----------------------------------------
+def iter_classify_images(image_paths, top_k=10, threshold=0.1, min_margin=0.15, blip_top_k=3, blip_threshold=0.4,
+                         batch_size=16, chunk_size=32, decode_workers=4, clip_cache=None, blip_cache=None,
+                         caption_batch=4, decode_timeout=tagging_errors.DEFAULT_DECODE_TIMEOUT,
+                         retries=tagging_errors.DEFAULT_RETRIES, photo_index=None):
+    """
+    Yields (path, tags, stage) per input path, in input order.
+
+    CLIP results are taken chunk_size at a time; the photos of a chunk whose
+    top-1/top-2 probability margin is below min_margin are captioned by BLIP
+    together (BLIP tags keep BLIP's similarity scores), then the whole chunk
+    is handed out. If BLIP can't tag a photo, it keeps its CLIP tags; photos
+    CLIP can't read keep CLIP's tagging_errors.Failure. CLIP adds every
+    photo's embedding to photo_index (see clip_classifier.open_photo_index).
+    """
+    clip_results = clip_classifier.iter_classify_images(image_paths, top_k, threshold, batch_size, decode_workers,
+                                                        cache=clip_cache, with_margin=True,
+                                                        decode_timeout=decode_timeout, retries=retries,
+                                                        photo_index=photo_index)
+    for chunk in image_pipeline.batched(clip_results, chunk_size):
+        uncertain = [path for path, _, margin in chunk if margin is not None and margin < min_margin]
+        refined = {}
+        if uncertain:
+            for path, tags in blip_classifier.iter_classify_images(uncertain, blip_top_k, blip_threshold,
+                                                                   cache=blip_cache, caption_batch=caption_batch,
+                                                                   decode_timeout=decode_timeout, retries=retries):
+                refined[path] = tags
+
+        for path, tags, margin in chunk:
+            if margin is None:
+                stage = "skipped"
+            elif refined.get(path):
+                stage = "blip"
+                tags = refined[path]
+            else:
+                stage = "clip"
+            stats[stage] += 1
+            yield path, tags, stage
+
+
+def classify_images(image_paths, **kwargs):
+    """Returns one tag list per input path, in input order. See iter_classify_images."""
+    return [tags for _, tags, _ in iter_classify_images(image_paths, **kwargs)]
+
+# ----------------------------------------
+# 3) MAIN: JSON input -> JSON output
+# ----------------------------------------
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tag photos with CLIP, re-tagging only uncertain photos with BLIP captions.",
+        usage="python hybrid_classifier.py /path/to/photo_paths.json [--min-margin 0.15] [--top-k 10] [--threshold 0.1] [--dedupe] [--stream]",
+    )
+    parser.add_argument("json_file", help="JSON array of paths, or NDJSON (.ndjson / - for stdin) with one path per line")
+    parser.add_argument("--min-margin", type=float, default=0.15,
+                        help="Send photos whose CLIP top-1 minus top-2 probability is below this to BLIP (default: 0.15)")
+    parser.add_argument("--top-k", type=int, default=10,
+                        help="Max CLIP tags per photo (default: 10)")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Min CLIP probability for a tag beyond the best one (default: 0.1)")
+    parser.add_argument("--blip-top-k", type=int, default=3,
+                        help="Max BLIP tags per re-tagged photo (default: 3)")
+    parser.add_argument("--blip-threshold", type=float, default=0.4,
+                        help="Min caption/category similarity for a BLIP tag beyond the best one (default: 0.4)")
+    parser.add_argument("--batch-size", type=int, default=16,
+                        help="Number of images per CLIP encode_image call (default: 16)")
+    parser.add_argument("--chunk-size", type=int, default=32,
+                        help="CLIP results collected before the uncertain ones go to BLIP (default: 32)")
+    parser.add_argument("--caption-batch", type=int, default=4,
+                        help="Images captioned per BLIP generate() call (default: 4)")
+    parser.add_argument("--decode-profile", choices=sorted(blip_classifier.DECODE_PROFILES), default="quality",
+                        help="BLIP caption decode profile (default: quality)")
+    parser.add_argument("--decode-workers", type=int, default=4,
+                        help="Threads decoding/preprocessing images ahead of CLIP, 0 to decode inline (default: 4)")
+    parser.add_argument("--decode-timeout", type=float, default=tagging_errors.DEFAULT_DECODE_TIMEOUT,
+                        help="Seconds a photo's decode may keep the model waiting before it fails, 0 for no limit; "
+                             "the decode thread itself isn't stopped, and inline decoding (--decode-workers 0) "
+                             "has no limit (default: 60)")
+    parser.add_argument("--retries", type=int, default=tagging_errors.DEFAULT_RETRIES,
+                        help="Extra attempts at a decode that fails with a transient I/O error, e.g. EIO (default: 1)")
+    parser.add_argument("--cache-dir", default=embedding_cache.DEFAULT_CACHE_DIR,
+                        help="Where image embeddings and captions are cached between runs")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always decode, encode and caption every image")
+    parser.add_argument("--no-photo-index", action="store_true",
+                        help="Don't add the photos' CLIP embeddings to the search index (see photo_search.py)")
+    parser.add_argument("--backend", choices=inference_backends.BACKENDS, default="torch",
+                        help="Encoder backend; torchscript/onnx need export_models.py first (default: torch)")
+    parser.add_argument("--model-dir", default=inference_backends.DEFAULT_MODEL_DIR,
+                        help="Where export_models.py wrote the exported encoders")
+    parser.add_argument("--precision", choices=inference_backends.PRECISIONS, default="fp32",
+                        help="int8: quantize the models' Linear layers to cut memory (torch backend, CPU only)")
+    parser.add_argument("--taxonomy", default=None,
+                        help="Taxonomy file, or name of one in taxonomies/, for both stages (default: each engine's own)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes, each with its own model copy; "
+                             "disables the on-disk cache and photo index (default: 1)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch threads per worker process (default: cores / workers)")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Tag each burst / group of near-duplicate photos once, from its first photo")
+    parser.add_argument("--dedupe-similarity", type=float, default=burst_groups.DEFAULT_SIMILARITY,
+                        help="Share of perceptual-hash bits near-duplicates agree on, 0.5-1 (default: 0.9)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip photos whose file, models, taxonomy and settings are unchanged since their last run")
+    parser.add_argument("--state-db", default=tagging_state.DEFAULT_STATE_DB,
+                        help="Incremental state database (default: state.sqlite in the cache directory)")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print time spent on imports, loading weights and encoding prompts to stderr")
+    parser.add_argument("--metrics", metavar="FILE", default=None,
+                        help="Write per-stage and per-photo timings, peak RSS and images/sec to this .json or .csv file")
+    parser.add_argument("--profile", choices=run_metrics.PROFILERS, default=None,
+                        help="Run under cProfile or the torch profiler and print the top entries to stderr")
+    parser.add_argument("--profile-output", default=None,
+                        help="Where --profile saves its data (default: tagging.prof / tagging_trace.json)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Print one JSON line per image as soon as it is tagged instead of one array at the end")
+    parser.add_argument("--max-rss-mb", type=float, default=None,
+                        help="Memory ceiling in MB for this process and its workers: above it, free what can be freed, "
+                             f"else stop with exit status {long_run.EXIT_MEMORY_CEILING} (see long_run.py, which resumes)")
+    args = parser.parse_args()
+
+    if args.taxonomy:
+        try:
+            args.taxonomy = category_index.resolve_taxonomy(args.taxonomy)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+    if args.batch_size < 1 or args.chunk_size < 1 or args.caption_batch < 1 or args.workers < 1:
+        parser.error("--batch-size, --chunk-size, --caption-batch and --workers must be at least 1")
+    if not 0.5 <= args.dedupe_similarity <= 1:
+        parser.error("--dedupe-similarity must be between 0.5 and 1")
+    if args.precision != "fp32" and args.backend != "torch":
+        parser.error("--precision only applies to the torch backend")
+
+    use_decode_profile(args.decode_profile)
+
+    if args.metrics:
+        run_metrics.enable()
+    started = time.perf_counter()
+    profiler = run_metrics.start_profiler(args.profile)
+
+    # Load the list of image paths from JSON (read lazily when streamed as NDJSON)
+    image_paths = tagging_io.read_paths(args.json_file)
+    state = tagging_state.open_state(args.state_db) if args.incremental else None
+    if state is not None:
+        image_paths = state.pending(image_paths, state_key(args.top_k, args.threshold, args.min_margin, args.blip_top_k,
+                                                        args.blip_threshold, args.taxonomy, args.precision))
+    image_paths = tagging_io.nonempty(image_paths)
+
+    writer = tagging_io.ResultWriter(stream=args.stream)
+    guard = long_run.open_guard(args.max_rss_mb)
+    status = 0
+    # With nothing to tag, answer right away without importing torch or loading any model
+    if image_paths is not None:
+        classify_kwargs = dict(top_k=args.top_k, threshold=args.threshold, min_margin=args.min_margin,
+                               blip_top_k=args.blip_top_k, blip_threshold=args.blip_threshold,
+                               batch_size=args.batch_size, chunk_size=args.chunk_size,
+                               decode_workers=args.decode_workers, caption_batch=args.caption_batch,
+                               decode_timeout=args.decode_timeout, retries=args.retries)
+        if args.workers > 1:
+            setup = [("use_taxonomy", (args.taxonomy,)), ("use_backend", (args.backend, args.model_dir)),
+                     ("use_precision", (args.precision,)), ("use_decode_profile", (args.decode_profile,))]
+
+            def classify(paths):
+                return process_pool.iter_sharded("hybrid_classifier", paths, classify_kwargs, setup,
+                                                 workers=args.workers, threads_per_worker=args.threads_per_worker,
+                                                 chunk_size=args.chunk_size)
+        else:
+            # BLIP itself is only loaded once a photo needs captioning
+            use_taxonomy(args.taxonomy)
+            use_backend(args.backend, args.model_dir)
+            use_precision(args.precision)
+
+            clip_cache = blip_cache = None
+            if not args.no_cache:
+                clip_cache = clip_classifier.open_cache(args.cache_dir)
+                blip_cache = blip_classifier.open_cache(args.cache_dir)
+            photo_index = None if args.no_photo_index else clip_classifier.open_photo_index(args.cache_dir)
+
+            def classify(paths):
+                return iter_classify_images(paths, clip_cache=clip_cache, blip_cache=blip_cache,
+                                            photo_index=photo_index, **classify_kwargs)
+
+        if args.dedupe:
+            results = burst_groups.iter_grouped(image_paths, classify, args.dedupe_similarity, args.decode_workers,
+                                                  args.decode_timeout)
+        else:
+            results = ((result, None, None) for result in classify(image_paths))
+
+        for (path, tags, stage), group, duplicate_of in results:
+            if duplicate_of is not None:
+                # Tagged from its group's first photo, by no stage
+                stage = "duplicate"
+                stats[stage] += 1
+            elif args.workers > 1:
+                # The workers' own counts stay in the workers
+                stats[stage] += 1
+            entry = tagging_errors.annotate({"image_path": path, "tags": tags, "stage": stage})
+            with run_metrics.timed("output", [path]):
+                writer.write(burst_groups.annotate(entry, group, duplicate_of))
+            # Failures worth another try aren't recorded, so the next incremental run retries them
+            if state is not None and tagging_errors.is_final(tags):
+                state.record(path, tags)
+            if guard is not None and not guard.check():
+                # Stops the decode threads / workers and saves the caches, then flushes below
+                results.close()
+                status = long_run.EXIT_MEMORY_CEILING
+                break
+    with run_metrics.timed("output"):
+        writer.close()
+    run_metrics.stop_profiler(profiler, args.profile_output or run_metrics.default_profile_output(args.profile))
+    if args.metrics:
+        result = run_metrics.report(writer.count, time.perf_counter() - started, engine="hybrid")
+        run_metrics.write_sidecar(args.metrics, result)
+        print(f"Metrics: {result['summary']}", file=sys.stderr)
+    if state is not None:
+        state.close()
+        print(f"Incremental: {state.skipped} unchanged photo(s) skipped", file=sys.stderr)
+
+    if stats:
+        print(f"Stages: {stats_summary()}", file=sys.stderr)
+    if burst_groups.stats:
+        print(f"Near-duplicates: {burst_groups.stats_summary()}", file=sys.stderr)
+    if tagging_errors.stats:
+        print(f"Failed: {tagging_errors.stats_summary()}", file=sys.stderr)
+    if image_loader.stats:
+        print(f"Decode paths: {image_loader.stats_summary()}", file=sys.stderr)
+    if args.profile_startup:
+        print(model_registry.startup_report(), file=sys.stderr)
+    return status
+
+if __name__ == "__main__":
+    long_run.fast_exit(main())
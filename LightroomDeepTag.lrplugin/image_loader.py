@@ -0,0 +1,90 @@
+"""
+Fast image loading shared by clip_classifier.py and blip_classifier.py.
+
+The models only look at 224/384 px inputs, so there is no point decoding a
+45-60 MP original at full resolution. load_image picks the cheapest source
+that is still at least `min_size` pixels on its short side:
+
+  raf_preview     the JPEG preview embedded in a Fujifilm .raf file
+  heif_thumbnail  an embedded HEIF/HIF thumbnail (via pillow_heif's draft())
+  jpeg_draft      JPEG DCT-domain downscaling (1/2, 1/4 or 1/8 decode)
+  full            a regular full-resolution decode
+
+EXIF orientation is applied in every case.
+"""
+import io
+import struct
+import threading
+from collections import Counter
+
+from PIL import Image, ImageOps
+from pillow_heif import register_heif_opener
+
+# Register the HEIF opener so Pillow can handle .heic/.heif/.hif
+register_heif_opener()
+
+# Like Image.thumbnail(): decode at >= 2x the target size, so the final
+# resampling step still has enough pixels to avoid aliasing
+REDUCING_GAP = 2.0
+
+RAF_MAGIC = b"FUJIFILMCCD-RAW"
+
+# How many images took each path, for a summary at the end of a run
+stats = Counter()
+_stats_lock = threading.Lock()
+
+
+class NoPreviewError(ValueError):
+    """A raw file has no usable embedded preview."""
+
+
+def _raf_preview(path):
+    """Returns the embedded JPEG preview of a Fujifilm .raf file as bytes."""
+    with open(path, "rb") as f:
+        header = f.read(92)
+        if len(header) < 92 or not header.startswith(RAF_MAGIC):
+            raise NoPreviewError(f"Not a RAF file: {path}")
+        # Big-endian offset and length of the embedded JPEG, at fixed header positions
+        offset, length = struct.unpack(">II", header[84:92])
+        if offset == 0 or length == 0:
+            raise NoPreviewError(f"RAF file has no embedded preview: {path}")
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise NoPreviewError(f"Truncated RAF preview: {path}")
+    return data
+
+
+def load_image(image_path, min_size, count=True):
+    """
+    Opens image_path as an upright RGB image whose short side is at least
+    min_size pixels where the source allows it.
+    Returns (image, source) where source names the path taken (see module docstring).
+    With count=False the decode is left out of stats (e.g. a thumbnail for hashing).
+    """
+    if image_path.lower().endswith(".raf"):
+        image = Image.open(io.BytesIO(_raf_preview(image_path)))
+        source = "raf_preview"
+    else:
+        image = Image.open(image_path)
+        source = "full"
+
+    full_size = image.size
+    draft_size = int(min_size * REDUCING_GAP)
+    image.draft("RGB", (draft_size, draft_size))
+    if source == "full" and image.size != full_size:
+        source = "heif_thumbnail" if image.format == "HEIF" else "jpeg_draft"
+
+    image = ImageOps.exif_transpose(image).convert("RGB")
+
+    if count:
+        with _stats_lock:
+            stats[source] += 1
+
+    return image, source
+
+
+def stats_summary():
+    """One-line summary of which decode paths were taken, e.g. 'jpeg_draft=120 full=3'."""
+    with _stats_lock:
+        return " ".join(f"{source}={count}" for source, count in stats.most_common())
@@ -0,0 +1,75 @@
+"""
+Producer/consumer helpers that keep image decoding off the model's thread.
+
+Decoding large JPEG/HEIC originals and running the model preprocess is mostly
+spent inside Pillow, which releases the GIL, so a small thread pool can decode
+the next images while the caller runs the model forward on the current batch.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(items, load_fn, workers=4, depth=16):
+    """
+    Yields (item, future) pairs in input order while up to `depth` calls to
+    load_fn(item) run ahead on `workers` threads.
+
+    `items` may be any iterable (including a generator of streamed paths); it is
+    consumed lazily, so at most `depth` loaded results are held in memory no
+    matter how long the input is. Call future.result() to get the loaded value
+    or re-raise the exception load_fn raised for that item.
+    A load still running when the caller is done is not waited for.
+
+    With workers <= 0 everything runs inline on the caller's thread.
+    """
+    if workers <= 0:
+        for item in items:
+            yield item, _completed(load_fn, item)
+        return
+
+    depth = max(depth, 1)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+    try:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(load_fn, item)))
+            if len(pending) >= depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        # The caller may still be waiting on the last futures; just don't block
+        # on a load it gave up on (see tagging_errors.resolve)
+        pool.shutdown(wait=False)
+
+
+def batched(pairs, batch_size):
+    """Groups an iterable into lists of at most batch_size elements."""
+    batch = []
+    for pair in pairs:
+        batch.append(pair)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _Completed:
+    """Future-like wrapper for a value computed inline (workers <= 0)."""
+
+    def __init__(self, value=None, error=None):
+        self._value = value
+        self._error = error
+
+    def result(self, timeout=None):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+def _completed(load_fn, item):
+    try:
+        return _Completed(value=load_fn(item))
+    except Exception as e:
+        return _Completed(error=e)
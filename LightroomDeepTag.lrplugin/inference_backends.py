@@ -0,0 +1,112 @@
+"""
+Pluggable inference backends for the encoders the classifiers run per image.
+
+  torch        eager PyTorch (default)
+  torchscript  traced graphs written by export_models.py, run with torch.jit
+  onnx         ONNX graphs written by export_models.py, run with onnxruntime (CPU)
+
+Exported components (see export_models.py):
+
+  clip_image_encoder   pixel_values [B, 3, H, W]          -> image embeddings [B, D]
+  minilm_text_encoder  input_ids, attention_mask [B, T]   -> sentence embeddings [B, D]
+  blip_vision_encoder  pixel_values [B, 3, H, W]          -> last_hidden_state [B, N, D]
+
+Precisions for the eager models (--precision):
+
+  fp32  as loaded (default)
+  int8  nn.Linear weights dynamically quantized to int8, precomputed
+        text/category embeddings kept in float16 (CPU only)
+"""
+import json
+import os
+import warnings
+
+BACKENDS = ("torch", "torchscript", "onnx")
+PRECISIONS = ("fp32", "int8")
+
+DEFAULT_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "exported_models")
+MANIFEST_NAME = "manifest.json"
+
+
+def exported_path(model_dir, component, backend):
+    extension = ".onnx" if backend == "onnx" else ".pt"
+    return os.path.join(model_dir, component + extension)
+
+
+def read_manifest(model_dir):
+    path = os.path.join(model_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class OnnxEncoder:
+    """Runs an exported ONNX graph on CPU; takes and returns torch tensors."""
+
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        import torch
+
+        feeds = {name: tensor.detach().cpu().numpy() for name, tensor in zip(self.input_names, inputs)}
+        return torch.from_numpy(self.session.run(None, feeds)[0])
+
+
+class TorchScriptEncoder:
+    """Runs a traced TorchScript module."""
+
+    def __init__(self, path, device="cpu"):
+        import torch
+
+        self.module = torch.jit.load(path, map_location=device).eval()
+
+    def __call__(self, *inputs):
+        import torch
+
+        with torch.no_grad():
+            return self.module(*inputs)
+
+
+def load_encoder(component, backend, model_name, model_dir=DEFAULT_MODEL_DIR, device="cpu"):
+    """
+    Loads an exported encoder for `component`, or returns None for the eager
+    "torch" backend (callers then use the model they already have).
+    Refuses graphs exported from a different model than `model_name`.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    if backend == "torch":
+        return None
+
+    path = exported_path(model_dir, component, backend)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No exported {component} at {path}; run export_models.py --format {backend} first")
+
+    exported_from = read_manifest(model_dir).get(component, {}).get("model")
+    if exported_from != model_name:
+        raise ValueError(f"{path} was exported from {exported_from!r}, not {model_name!r}; re-run export_models.py")
+
+    if backend == "onnx":
+        return OnnxEncoder(path)
+    return TorchScriptEncoder(path, device=device)
+
+
+def quantize_linear_int8(module):
+    """
+    Replaces every nn.Linear in `module` with a dynamically quantized int8 one,
+    in place, so the fp32 weights are freed. Activations stay float; CPU only.
+    """
+    import torch
+
+    with warnings.catch_warnings():
+        # Newer torch warns that torch.ao.quantization is moving to torchao
+        warnings.simplefilter("ignore")
+        return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
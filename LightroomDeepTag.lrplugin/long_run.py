@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Memory-bounded, resumable runs over large libraries (e.g. 20k photos overnight).
+
+  python long_run.py --checkpoint job.sqlite --output results.ndjson --max-rss-mb 6000 \\
+      clip_classifier.py photo_paths.ndjson [classifier options]
+
+runs the classifier script with --stream, so results are written to the
+output file as each photo is done, and with --incremental on the checkpoint
+database (see tagging_state), which records every finished photo. Paths are
+read lazily when the input is NDJSON.
+
+With --max-rss-mb, the script checks its memory every few photos (see
+MemoryGuard). Above the ceiling it first collects garbage and hands freed
+memory back to the OS; if that isn't enough, it stops after the photo at
+hand, flushes its results and checkpoint and exits with EXIT_MEMORY_CEILING.
+long_run.py then starts it again, and it carries on where it stopped; the
+same happens after an OOM kill or a crash, as long as the previous attempt
+got at least one photo further. Results are written before they are
+checkpointed, so a photo in flight when the process died may be in the
+output twice (the last line for a path wins).
+
+The classifier scripts leave with fast_exit() once everything is flushed,
+skipping the interpreter's teardown of torch and of decode threads that
+are still running.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+try:
+    import psutil
+except ImportError:  # Optional: only needed for current RSS outside Linux
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Exit status of a classifier script that stopped at its --max-rss-mb ceiling (EX_TEMPFAIL)
+EXIT_MEMORY_CEILING = 75
+
+# Photos between two memory checks
+CHECK_EVERY = 16
+
+DEFAULT_MAX_RESTARTS = 100
+
+_libc = None
+
+
+def _proc_mb(pid):
+    """
+    Anonymous memory of a process in MB, from /proc (Linux), or None. Uses its
+    proportional share (Pss_Anon), so worker processes sharing their fork
+    server's pages copy-on-write aren't counted twice; file-backed pages (the memmapped
+    caches and index, model weights) can be dropped by the OS and don't count.
+    """
+    for name, field in (("smaps_rollup", "Pss_Anon:"), ("status", "RssAnon:")):
+        try:
+            with open(f"/proc/{pid}/{name}") as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return None
+
+
+def _descendants(pid):
+    # The worker processes are the children of process_pool's fork server
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+    return children + [grandchild for child in children for grandchild in _descendants(child)]
+
+
+def rss_mb():
+    """
+    Current memory of this process and its worker processes in MB. Falls back
+    to psutil's RSS, then to the peak RSS, which never goes down.
+    """
+    own = _proc_mb(os.getpid())
+    if own is not None:
+        return own + sum(_proc_mb(child) or 0 for child in _descendants(os.getpid()))
+    if psutil is not None:
+        process = psutil.Process()
+        return sum(p.memory_info().rss for p in [process] + process.children(recursive=True)) / (1024 * 1024)
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is bytes on macOS, kilobytes on Linux
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    return None
+
+
+def release_memory():
+    """Collects garbage, empties torch's GPU caches and returns freed heap memory to the OS (glibc)."""
+    global _libc
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+            torch.mps.empty_cache()
+    if sys.platform.startswith("linux"):
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+        # Decoded images freed on the decode threads stay in their malloc arenas otherwise
+        if hasattr(_libc, "malloc_trim"):
+            _libc.malloc_trim(0)
+
+
+class MemoryGuard:
+    """Tells a classifier script when to stop: check() is False once memory stays above max_mb."""
+
+    def __init__(self, max_mb, check_every=CHECK_EVERY):
+        self.max_mb = max_mb
+        self.check_every = check_every
+        self._count = 0
+
+    def check(self):
+        """Call once per photo done."""
+        self._count += 1
+        if self._count % self.check_every:
+            return True
+        used = rss_mb()
+        if used is None or used <= self.max_mb:
+            return True
+        release_memory()
+        used = rss_mb()
+        if used <= self.max_mb:
+            return True
+        print(f"Memory ceiling: {used:.0f} MB after {self._count} photo(s) (--max-rss-mb {self.max_mb:g}); "
+              f"stopping, exit status {EXIT_MEMORY_CEILING}", file=sys.stderr)
+        return False
+
+
+def open_guard(max_mb):
+    return MemoryGuard(max_mb) if max_mb else None
+
+
+def fast_exit(status=0):
+    """
+    Ends the process right away, once the caller has closed its writer, caches
+    and state: the OS reclaims the models and other memory faster than the
+    interpreter's teardown, which also waits for decode threads still running.
+    """
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+    os._exit(status or 0)
+
+
+def _trim_partial_line(path):
+    """Cuts an unterminated last line (the process died while writing it) off the output file."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            chunk = f.read(end - start)
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            f.truncate(end)
+
+
+def checkpointed(db_path):
+    """Photos recorded in the checkpoint database so far."""
+    if not os.path.exists(db_path):
+        return 0
+    try:
+        db = sqlite3.connect(db_path, timeout=30)
+        try:
+            return db.execute("SELECT COUNT(*) FROM photos").fetchone()[0]
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return 0
+
+
+def supervise(command, checkpoint, output, max_restarts=DEFAULT_MAX_RESTARTS):
+    """
+    Runs command (appending its stdout to output) until it succeeds. Restarts it
+    after a memory-ceiling exit, crash or kill as long as that attempt got
+    further than the one before. Returns (exit status, restarts).
+    """
+    restarts = 0
+    while True:
+        _trim_partial_line(output)
+        done = checkpointed(checkpoint)
+        with open(output, "ab") as out:
+            process = subprocess.Popen(command, stdout=out)
+            try:
+                status = process.wait()
+            except KeyboardInterrupt:
+                # The script got the same SIGINT; let it flush its checkpoint
+                process.wait()
+                raise
+        if status == 0:
+            return status, restarts
+        progress = checkpointed(checkpoint) - done
+        if progress <= 0:
+            print(f"Long run: exit status {status} without progress; giving up", file=sys.stderr)
+            return status, restarts
+        if restarts >= max_restarts:
+            print(f"Long run: exit status {status}; giving up after {restarts} restart(s)", file=sys.stderr)
+            return status, restarts
+        restarts += 1
+        print(f"Long run: exit status {status} after {progress} more photo(s); resuming", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a classifier script over a large library with a memory ceiling, resuming after crashes.")
+    parser.add_argument("script", help="clip_classifier.py, blip_classifier.py or hybrid_classifier.py")
+    parser.add_argument("json_file", help="JSON array of paths, or NDJSON (.ndjson) with one path per line")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Further options for the script")
+    parser.add_argument("--checkpoint", required=True,
+                        help="Database of the photos done so far; run again with the same one to resume")
+    parser.add_argument("--output", required=True, help="NDJSON file the results are appended to")
+    parser.add_argument("--max-rss-mb", type=float, default=None,
+                        help="Memory ceiling of the script and its workers, in MB; restart it above that")
+    parser.add_argument("--max-restarts", type=int, default=DEFAULT_MAX_RESTARTS,
+                        help=f"Give up after this many restarts (default: {DEFAULT_MAX_RESTARTS})")
+    args = parser.parse_args()
+
+    script = args.script
+    if not os.path.exists(script):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    if not os.path.exists(script):
+        parser.error(f"no such script: {args.script}")
+
+    command = [sys.executable, script, args.json_file] + args.script_args + [
+        "--stream", "--incremental", "--state-db", os.path.abspath(args.checkpoint)]
+    if args.max_rss_mb:
+        command += ["--max-rss-mb", str(args.max_rss_mb)]
+
+    started = time.perf_counter()
+    try:
+        status, restarts = supervise(command, args.checkpoint, args.output, args.max_restarts)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    print(json.dumps({"status": "ok" if status == 0 else "error", "exit_status": status, "restarts": restarts,
+                      "photos": checkpointed(args.checkpoint), "output": args.output,
+                      "seconds": round(time.perf_counter() - started, 1)}))
+    # A signal's negative status as the shell reports it
+    sys.exit(status if status >= 0 else 128 - status)
+
+
+if __name__ == "__main__":
+    main()
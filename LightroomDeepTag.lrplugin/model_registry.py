@@ -0,0 +1,72 @@
+"""
+Loads heavy libraries and models once per process, on first use.
+
+The classifier scripts import nothing heavier than Pillow/numpy at module level;
+torch, clip, transformers and sentence_transformers are imported and the model
+weights loaded only once there is a photo to tag, through get()/import_module().
+Everything loaded here is shared, e.g. by both engines in the tagging server.
+
+Each step is timed, so --profile-startup can show where startup time goes:
+imports, weight loading and prompt encoding.
+"""
+import importlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Decode worker threads may trigger the first load, so loading is serialized
+lock = threading.RLock()
+
+_loaded = {}
+
+# Startup phase -> seconds, in the order the phases first ran
+timings = OrderedDict()
+
+_process_start = time.perf_counter()
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+
+def import_module(name):
+    """Imports a (heavy) module, timing it as "import <name>" the first time."""
+    if name in sys.modules:
+        return sys.modules[name]
+    with lock, timed(f"import {name}"):
+        return importlib.import_module(name)
+
+
+def get(key, loader, phase=None):
+    """Returns the object cached under `key`, calling loader() the first time (timed as `phase`)."""
+    with lock:
+        if key not in _loaded:
+            with timed(phase or f"load {key}"):
+                _loaded[key] = loader()
+        return _loaded[key]
+
+
+def is_loaded(key):
+    return key in _loaded
+
+
+def torch_device():
+    """The device the classifiers run on."""
+    torch = import_module("torch")
+    # return "cuda" if torch.cuda.is_available() else "cpu"
+    return "mps" if torch.backends.mps.is_available() else "cpu"
+
+
+def startup_report():
+    """One line per startup phase plus the wall time since this module was imported."""
+    width = max([len(phase) for phase in timings] + [24])
+    lines = [f"  {phase:<{width}} {seconds:7.2f}s" for phase, seconds in timings.items()]
+    lines.append(f"  {'wall time so far':<{width}} {time.perf_counter() - _process_start:7.2f}s")
+    return "Startup profile:\n" + "\n".join(lines)
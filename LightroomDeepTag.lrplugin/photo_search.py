@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Finds photos by free text or by a reference photo, without re-running the
+image model over the library.
+
+Every CLIP (or hybrid) run adds the photos' image embeddings to the photo
+index (vector_index.py). A search encodes only the query, with CLIP's text
+tower or, for a reference photo, its image tower, and ranks the indexed
+photos by cosine similarity. Prints a JSON array of
+{"image_path": ..., "score": ...}, best first; photos whose file is gone are
+left out. The tagging server answers the same query on /search with CLIP
+already loaded.
+
+Usage: python photo_search.py "dog on the beach at sunset" [--top 50] [--min-score 0.2]
+       python photo_search.py --image /path/to/reference.jpg
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+import clip_classifier
+import embedding_cache
+import model_registry
+import vector_index
+
+DEFAULT_TOP = 50
+
+
+def open_index(cache_dir=embedding_cache.DEFAULT_CACHE_DIR):
+    """Opens CLIP's photo index read-only; a tagging run (or the server) may be writing to it meanwhile."""
+    return vector_index.PhotoIndex(clip_classifier.MODEL_NAME, cache_dir=cache_dir, writable=False)
+
+
+def encode_query(text=None, image_path=None):
+    """Unit-length CLIP embedding of the text, the reference photo, or (with both) their mean."""
+    clip_classifier.load_models()
+    vectors = []
+    if text:
+        vectors.append(clip_classifier.encode_prompts([text])[0])
+    if image_path:
+        image_input = clip_classifier.load_image_input(image_path).unsqueeze(0)
+        vectors.append(clip_classifier.encode_images(image_input)[0].float().cpu().numpy())
+    if not vectors:
+        raise ValueError("A search needs a query text or a reference image")
+    query = np.mean(vectors, axis=0)
+    return query / np.linalg.norm(query)
+
+
+def search(index, text=None, image_path=None, top=DEFAULT_TOP, min_score=None, nprobe=vector_index.DEFAULT_NPROBE):
+    """
+    Runs one query against a PhotoIndex. Returns {"results": [{"image_path", "score"}, ...],
+    "searched": photos scored, "milliseconds": time spent ranking them}.
+    """
+    query = encode_query(text, image_path)
+    start = time.perf_counter()
+    matches, searched = index.search(query, top=top, nprobe=nprobe)
+    milliseconds = 1000 * (time.perf_counter() - start)
+    if min_score is not None:
+        matches = [(path, score) for path, score in matches if score >= min_score]
+    return {
+        "results": [{"image_path": path, "score": score} for path, score in matches],
+        "searched": searched,
+        "milliseconds": round(milliseconds, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search tagged photos by text or by a reference photo.")
+    parser.add_argument("query", nargs="?", default=None, help="What to look for, e.g. \"dog on the beach\"")
+    parser.add_argument("--query-file", default=None,
+                        help="Read the query text from this file (UTF-8) instead")
+    parser.add_argument("--image", default=None, help="Find photos that look like this one")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP,
+                        help=f"Number of photos to return (default: {DEFAULT_TOP})")
+    parser.add_argument("--min-score", type=float, default=None,
+                        help="Leave out photos whose cosine similarity to the query is below this")
+    parser.add_argument("--nprobe", type=int, default=vector_index.DEFAULT_NPROBE,
+                        help="IVF lists searched in large indexes; more is slower and more exact (default: 16)")
+    parser.add_argument("--cache-dir", default=embedding_cache.DEFAULT_CACHE_DIR,
+                        help="Where the classifier scripts keep the photo index")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print time spent on imports, loading weights and encoding the query to stderr")
+    args = parser.parse_args()
+
+    text = args.query
+    if args.query_file:
+        with open(args.query_file, "r", encoding="utf-8") as f:
+            text = f.read().strip()
+    if not text and not args.image:
+        parser.error("give a query text, --query-file or --image")
+    if args.top < 1 or args.nprobe < 1:
+        parser.error("--top and --nprobe must be at least 1")
+
+    index = open_index(args.cache_dir)
+    # An empty index answers right away, without loading CLIP
+    if not len(index):
+        print("Photo index is empty: tag some photos with the CLIP or hybrid engine first", file=sys.stderr)
+        print("[]")
+        return
+
+    result = search(index, text, args.image, args.top, args.min_score, args.nprobe)
+    print(json.dumps(result["results"]))
+    print(f"Searched {result['searched']} of {len(index)} photos in {result['milliseconds']:.1f} ms", file=sys.stderr)
+    if args.profile_startup:
+        print(model_registry.startup_report(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
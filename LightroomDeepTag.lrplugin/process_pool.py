@@ -0,0 +1,88 @@
+"""
+Sharded execution: one classifier copy per worker process.
+
+A single process doesn't scale to many cores, autoregressive BLIP generation
+least of all. iter_sharded() hands the input paths out in chunks to N worker
+processes, each limited to its own torch thread budget, and yields the
+results in input order as they arrive.
+
+The workers are never forked from the coordinator: once it has run any torch
+computation, torch's OpenMP thread pool is live, and a forked child that
+uses more than one thread can deadlock in it. Where the platform has it,
+the workers come from a fork server that has imported the engine module but
+run no computation (so torch isn't imported again per worker); elsewhere
+they are spawned. Either way each worker loads its own copy of the models,
+so N workers take about N times the model memory.
+
+Each worker's on-disk caches are disabled (a cache can only be open in one
+process at a time).
+"""
+import importlib
+import multiprocessing
+import os
+from collections import deque
+
+import image_pipeline
+
+# Chunks submitted per worker before waiting for the oldest one
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+# Set in each worker process by _init_worker
+_engine = None
+_classify_kwargs = None
+
+
+def default_threads(workers):
+    """Splits the cores evenly between the workers."""
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _init_worker(module_name, setup, threads, classify_kwargs):
+    global _engine, _classify_kwargs
+    import torch
+
+    torch.set_num_threads(threads)
+    _engine = importlib.import_module(module_name)
+    # Workers start from scratch; the models are loaded by the first chunk
+    for function_name, args in setup:
+        getattr(_engine, function_name)(*args)
+    _classify_kwargs = classify_kwargs
+
+
+def _classify_chunk(paths):
+    return list(_engine.iter_classify_images(paths, **_classify_kwargs))
+
+
+def iter_sharded(module_name, image_paths, classify_kwargs=None, setup=(), workers=2, threads_per_worker=None,
+                 chunk_size=8):
+    """
+    Yields what module.iter_classify_images(paths, **classify_kwargs) yields
+    for every path, in input order, computed by `workers` processes.
+
+    setup is a list of (function name, args) calls that configure the module
+    (use_taxonomy, use_backend, ...); they run in each worker. Paths are
+    handed out chunk_size at a time, so faster workers take more chunks.
+    image_paths is read on the calling thread, at most
+    CHUNKS_IN_FLIGHT_PER_WORKER chunks per worker ahead of the results, so a
+    lazy input (NDJSON, burst_groups' dedupe) stays lazy.
+    """
+    threads = threads_per_worker or default_threads(workers)
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # Only takes effect when the fork server starts, i.e. for the first pool of the run
+        context.set_forkserver_preload(["torch", module_name])
+    else:
+        context = multiprocessing.get_context("spawn")
+
+    # The Hugging Face tokenizers' own thread pool doesn't survive a fork; the workers don't need it
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    initargs = (module_name, list(setup), threads, dict(classify_kwargs or {}))
+    with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+        in_flight = deque()
+        for chunk in image_pipeline.batched(image_paths, chunk_size):
+            if len(in_flight) >= workers * CHUNKS_IN_FLIGHT_PER_WORKER:
+                yield from in_flight.popleft().get()
+            in_flight.append(pool.apply_async(_classify_chunk, (chunk,)))
+        while in_flight:
+            yield from in_flight.popleft().get()
@@ -0,0 +1,208 @@
+"""
+Where a tagging run's time goes.
+
+The classifiers time their stages with timed(stage, paths):
+
+  hash        perceptual hash for --dedupe (burst_groups)
+  decode      reading/decoding the file (image_loader)
+  preprocess  resizing/normalizing for the model
+  forward     CLIP image encoder / Sentence-BERT caption encoder
+  generate    BLIP caption generation
+  score       matching against the categories and picking tags
+  output      writing the result
+
+Time spent on a batch is split evenly over its photos. Per-stage totals are
+always kept (they cost a perf_counter() pair per call); per-photo rows only
+once enable() was called, i.e. when a sidecar file is written. report() adds
+the startup phases from model_registry (imports, weight loading, prompt
+encoding), peak RSS and images/sec. write_sidecar() writes it as JSON, or as
+CSV with one row per photo.
+
+start_profiler()/stop_profiler() wrap a run in cProfile or the torch profiler.
+
+With --workers, the stages run in the worker processes and aren't counted.
+"""
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import model_registry
+
+try:
+    import resource
+except ImportError:  # Windows: no getrusage, peak RSS isn't reported
+    resource = None
+
+STAGES = ("hash", "decode", "preprocess", "forward", "generate", "score", "output")
+
+PROFILERS = ("cprofile", "torch")
+
+# stage -> [seconds, photos, calls]
+stages = OrderedDict()
+# path -> {stage: seconds}, only collected once enable() was called
+per_image = None
+_lock = threading.Lock()
+
+
+def enable():
+    """Also keeps per-photo timings (for a sidecar file)."""
+    global per_image
+    with _lock:
+        if per_image is None:
+            per_image = {}
+
+
+def reset():
+    """Forgets everything recorded so far (the tagging server does this per request)."""
+    global per_image
+    with _lock:
+        stages.clear()
+        per_image = {} if per_image is not None else None
+
+
+def add(stage, seconds, paths=()):
+    """Counts `seconds` of `stage`, split evenly over the photos in paths."""
+    with _lock:
+        totals = stages.setdefault(stage, [0.0, 0, 0])
+        totals[0] += seconds
+        totals[1] += len(paths)
+        totals[2] += 1
+        if per_image is not None and paths:
+            share = seconds / len(paths)
+            for path in paths:
+                row = per_image.setdefault(path, {})
+                row[stage] = row.get(stage, 0.0) + share
+
+
+@contextmanager
+def timed(stage, paths=()):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(stage, time.perf_counter() - start, paths)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def report(images, elapsed, **extra):
+    """The run's metrics as a dict; `extra` (engine, settings, ...) is included as is."""
+    with _lock:
+        stage_report = OrderedDict(
+            (stage, {"seconds": round(seconds, 4), "photos": photos, "calls": calls,
+                     "ms_per_photo": round(1000 * seconds / photos, 2) if photos else None})
+            for stage, (seconds, photos, calls) in sorted(stages.items(), key=lambda item: _stage_order(item[0]))
+        )
+    result = dict(extra)
+    result.update({
+        "images": images,
+        "elapsed_seconds": round(elapsed, 3),
+        "images_per_second": round(images / elapsed, 2) if elapsed > 0 else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1) if resource is not None else None,
+        "startup": OrderedDict((phase, round(seconds, 3)) for phase, seconds in model_registry.timings.items()),
+        "stages": stage_report,
+    })
+    result["summary"] = summary_line(result)
+    return result
+
+
+def _stage_order(stage):
+    return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+
+def summary_line(result):
+    """e.g. '120 photos in 41.2s (2.9/s); generate 71%, decode 12%, forward 9%; startup 6.1s; peak RSS 1830 MB'."""
+    parts = [f"{result['images']} photos in {result['elapsed_seconds']:.1f}s"]
+    if result["images_per_second"] is not None:
+        parts[0] += f" ({result['images_per_second']:.1f}/s)"
+    busy = sum(stage["seconds"] for stage in result["stages"].values())
+    if busy > 0:
+        top = sorted(result["stages"].items(), key=lambda item: -item[1]["seconds"])[:3]
+        parts.append(", ".join(f"{name} {100 * stage['seconds'] / busy:.0f}%" for name, stage in top))
+    startup = sum(result["startup"].values())
+    if startup:
+        parts.append(f"startup {startup:.1f}s")
+    if result["peak_rss_mb"] is not None:
+        parts.append(f"peak RSS {result['peak_rss_mb']:.0f} MB")
+    return "; ".join(parts)
+
+
+def write_sidecar(path, result):
+    """Writes the report as JSON (with per-photo rows), or as CSV (.csv) with one row per photo."""
+    with _lock:
+        rows = dict(per_image or {})
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        if path.lower().endswith(".csv"):
+            columns = [stage for stage in STAGES if any(stage in row for row in rows.values())]
+            writer = csv.writer(f)
+            writer.writerow(["image_path"] + [f"{stage}_ms" for stage in columns] + ["total_ms"])
+            for image_path, row in rows.items():
+                writer.writerow([image_path] + [f"{1000 * row.get(stage, 0.0):.2f}" for stage in columns]
+                                + [f"{1000 * sum(row.values()):.2f}"])
+        else:
+            result = dict(result)
+            result["per_image"] = [
+                dict({"image_path": image_path}, **{f"{stage}_ms": round(1000 * seconds, 2)
+                                                    for stage, seconds in row.items()})
+                for image_path, row in rows.items()
+            ]
+            json.dump(result, f, indent=1)
+    # Written in one go, so a reader (the Lightroom plugin) never sees half a file
+    os.replace(tmp_path, path)
+
+
+def start_profiler(kind):
+    """
+    Starts cProfile ("cprofile") or the torch profiler ("torch", CPU activity);
+    returns a handle for stop_profiler(), or None for kind None.
+    """
+    if kind is None:
+        return None
+    if kind == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return kind, profiler
+    if kind == "torch":
+        torch = model_registry.import_module("torch")
+        profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True)
+        profiler.start()
+        return kind, profiler
+    raise ValueError(f"Unknown profiler: {kind}")
+
+
+def stop_profiler(handle, output):
+    """
+    Stops a profiler from start_profiler(), saves its data to output (cProfile
+    stats, or a Chrome trace for torch) and prints the top entries to stderr.
+    """
+    if handle is None:
+        return
+    kind, profiler = handle
+    if kind == "cprofile":
+        import pstats
+
+        profiler.disable()
+        profiler.dump_stats(output)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+    else:
+        profiler.stop()
+        profiler.export_chrome_trace(output)
+        print(profiler.key_averages().table(sort_by="cpu_time_total", row_limit=25), file=sys.stderr)
+
+
+def default_profile_output(kind):
+    return "tagging.prof" if kind == "cprofile" else "tagging_trace.json"
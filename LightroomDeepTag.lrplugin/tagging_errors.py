@@ -0,0 +1,131 @@
+"""
+Per-photo failures, so one bad file costs only its own result.
+
+A photo that can't be tagged still gets its result, in input order, with an
+empty tag list; that list is a Failure, which also says what went wrong:
+
+  missing            the file doesn't exist or can't be opened
+  unreadable         not an image Pillow can open, or a raw file without a preview
+  decode_error       decoding failed, e.g. a truncated JPEG/HEIF
+  decode_timeout     decoding took longer than the time budget
+  inference_error    the model failed on this photo, also when run on it alone
+  no_cached_caption  --rescore-only and no cached caption
+
+Code that only looks at the tags sees [] as before. annotate() adds
+"status" ("ok"/"error") plus "error" and "message" to a result entry.
+
+Reads that fail with a transient I/O error (RETRY_ERRNOS, e.g. a flaky
+network drive) are retried a bounded number of times (retrying()); decode
+errors such as a truncated file fail the same way every time and aren't.
+
+The decode timeout only bounds how long the model waits for a photo
+(resolve()). Python can't stop a thread, so an overrunning decode keeps its
+decode thread busy in the background until it finishes, and its result is
+dropped; it isn't retried. With --decode-workers 0 photos are decoded inline
+and there is no time limit at all.
+"""
+import concurrent.futures
+import errno
+import threading
+import time
+from collections import Counter
+
+from PIL import UnidentifiedImageError
+
+import image_loader
+
+# Seconds a photo's decode may keep the model waiting (0: no limit)
+DEFAULT_DECODE_TIMEOUT = 60.0
+# Extra attempts at a decode that failed with an I/O error
+DEFAULT_RETRIES = 1
+RETRY_DELAY = 0.2
+# OSError errnos worth another attempt; anything else fails the same way again
+RETRY_ERRNOS = frozenset([errno.EIO, errno.EAGAIN, errno.ETIMEDOUT, errno.EINTR, errno.EBUSY,
+                          errno.ECONNRESET, getattr(errno, "ESTALE", errno.EIO)])
+
+# Not recorded by incremental runs, so the photo is tried again next run
+TRANSIENT_CODES = frozenset(["decode_timeout", "inference_error", "no_cached_caption"])
+
+# Failed photos per error code, for a summary at the end of a run
+stats = Counter()
+_stats_lock = threading.Lock()
+
+
+class Failure(list):
+    """An empty tag list that records why the photo has no tags."""
+
+    def __init__(self, code, message=""):
+        super().__init__()
+        self.code = code
+        self.message = message
+
+    def __repr__(self):
+        return f"Failure({self.code!r}, {self.message!r})"
+
+
+def failure(error):
+    """Maps an exception raised while loading or tagging one photo to a Failure."""
+    message = f"{type(error).__name__}: {error}"
+    if isinstance(error, (FileNotFoundError, IsADirectoryError, PermissionError)):
+        return Failure("missing", message)
+    if isinstance(error, (UnidentifiedImageError, image_loader.NoPreviewError)):
+        return Failure("unreadable", message)
+    return Failure("decode_error", message)
+
+
+def _retryable(error):
+    # Pillow's decode errors ("image file is truncated", ...) are OSErrors without an errno
+    return isinstance(error, OSError) and error.errno in RETRY_ERRNOS
+
+
+def retrying(load_fn, retries=DEFAULT_RETRIES):
+    """Wraps load_fn(path) so transient I/O errors (see RETRY_ERRNOS) are retried up to `retries` times."""
+    def load(path):
+        for attempt in range(retries + 1):
+            try:
+                return load_fn(path)
+            except Exception as e:
+                if attempt >= retries or not _retryable(e):
+                    raise
+            time.sleep(RETRY_DELAY * (attempt + 1))
+    return load
+
+
+def resolve(future, timeout=None):
+    """
+    Returns the value of a prefetched load (see image_pipeline.prefetch), or a
+    Failure if it raised or isn't done within timeout seconds (None/0: wait).
+    Only the wait is bounded: the load itself runs on (see module docstring).
+    """
+    try:
+        return future.result(timeout=timeout or None)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        return Failure("decode_timeout", f"not decoded within {timeout:g}s")
+    except Exception as e:
+        return failure(e)
+
+
+def is_final(tags):
+    """False for failures worth retrying on the next incremental run."""
+    return not (isinstance(tags, Failure) and tags.code in TRANSIENT_CODES)
+
+
+def annotate(entry):
+    """Adds "status" (and "error"/"message" for failures) to a result entry, counting failures."""
+    tags = entry["tags"]
+    if not isinstance(tags, Failure):
+        entry["status"] = "ok"
+        return entry
+    entry["status"] = "error"
+    entry["error"] = tags.code
+    entry["message"] = tags.message
+    with _stats_lock:
+        stats[tags.code] += 1
+    return entry
+
+
+def stats_summary():
+    """One-line summary of the failures, e.g. 'unreadable=2 decode_timeout=1'."""
+    with _stats_lock:
+        return " ".join(f"{code}={count}" for code, count in stats.most_common())
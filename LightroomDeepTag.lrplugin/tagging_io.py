@@ -0,0 +1,72 @@
+"""
+Input/output helpers shared by the classifier scripts.
+
+Paths come either as one JSON array (photo_paths.json) or streamed as NDJSON,
+one path per line (photo_paths.ndjson, or "-" for stdin). Results go out
+either as one JSON array at the end of the run, or as NDJSON, one
+{"image_path": ..., "tags": [...], "status": "ok"} object per line, flushed
+as soon as each image is done ("status": "error" plus "error" and "message"
+for photos that couldn't be tagged, see tagging_errors).
+"""
+import itertools
+import json
+import sys
+
+
+def is_streamed(source):
+    return source == "-" or source.lower().endswith((".ndjson", ".jsonl"))
+
+
+def read_paths(source):
+    """
+    Yields image paths from a JSON array file, or lazily from an NDJSON file /
+    stdin ("-"), where each line is a JSON string or a bare path.
+    """
+    if not is_streamed(source):
+        with open(source, "r") as f:
+            yield from json.load(f)
+        return
+
+    f = sys.stdin if source == "-" else open(source, "r")
+    try:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield json.loads(line) if line.startswith('"') else line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def nonempty(paths):
+    """Returns an iterator over the same paths, or None if there are none (reads at most one path ahead)."""
+    paths = iter(paths)
+    for first in paths:
+        return itertools.chain([first], paths)
+    return None
+
+
+class ResultWriter:
+    """Writes result entries as NDJSON lines (stream=True) or one JSON array on close()."""
+
+    def __init__(self, stream=False, out=None):
+        self.stream = stream
+        self.out = out if out is not None else sys.stdout
+        self.count = 0
+        self._entries = []
+
+    def write(self, entry):
+        self.count += 1
+        if self.stream:
+            self.out.write(json.dumps(entry) + "\n")
+            self.out.flush()
+        else:
+            self._entries.append(entry)
+
+    def close(self):
+        if not self.stream:
+            # Output one JSON array with all results
+            self.out.write(json.dumps(self._entries) + "\n")
+            self.out.flush()
+            self._entries = []
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+Long-lived local tagging server.
+
+Keeps the CLIP / BLIP models and their category embeddings loaded between
+Lightroom runs, so a click on "Categorize Photos" only pays for the photos
+themselves. Listens on localhost only and shuts itself down after
+--idle-timeout seconds without requests.
+
+POST requests must be Content-Type: application/json, carry the token the
+server writes to TOKEN_FILE (readable by the user only) at launch in an
+X-Tagging-Token header, and have no Origin header, so neither web pages
+open in a browser nor other users can drive it. "json_file", "output_file"
+and "metrics_file" must be inside --file-dir (the temp directory, where the
+plugin writes them).
+
+Endpoints:
+  GET  /health    -> {"status": "ok", "engines": [...], "idle_seconds": ...}
+  POST /classify  -> body {"engine": "clip"|"blip"|"hybrid", "paths": [...]}
+                     or {"engine": ..., "json_file": "/path/to/photo_paths.json"}
+                     plus optional "taxonomy" (file or name in taxonomies/),
+                     "top_k", "threshold", "batch_size" (clip) or "rescore_only",
+                     "decode_profile", "early_stop_words", "caption_batch" (blip),
+                     "min_margin", "blip_top_k", "blip_threshold" (hybrid, which also
+                     adds "stage" to every result), "incremental" to only tag
+                     photos that changed since their last run (see tagging_state.py),
+                     and "dedupe" (+ "dedupe_similarity") to tag each group of
+                     near-duplicates once (see burst_groups.py), "decode_timeout"
+                     and "retries" (see tagging_errors.py), and "metrics_file" to write
+                     the request's timings there (see run_metrics.py);
+                     returns the same JSON array the classifier scripts print,
+                     or, with "output_file", streams NDJSON lines to that file
+                     as photos finish and returns {"status": "ok", "count": N}.
+                     clip and hybrid requests add the photos' embeddings to the
+                     photo index (see vector_index.py).
+  POST /search    -> body {"query": "dog on the beach"} and/or {"image_path": "/reference.jpg"},
+                     optional "top" (50), "min_score", "nprobe"; returns
+                     {"results": [{"image_path": ..., "score": ...}, ...], "searched": N,
+                     "milliseconds": ...} (see photo_search.py)
+  POST /shutdown  -> stops the server
+
+Usage: python tagging_server.py [--port 8765] [--idle-timeout 1800] [--preload clip blip]
+                                [--backend torch|torchscript|onnx] [--model-dir exported_models]
+                                [--precision fp32|int8] [--file-dir /tmp]
+"""
+import argparse
+import functools
+import hmac
+import importlib
+import json
+import os
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import burst_groups
+import category_index
+import embedding_cache
+import inference_backends
+import photo_search
+import run_metrics
+import tagging_errors
+import tagging_io
+import tagging_state
+import vector_index
+
+DEFAULT_PORT = 8765
+
+# Written at launch; TaggingServer.lua sends it back with every POST
+TOKEN_FILE = os.path.join(embedding_cache.DEFAULT_CACHE_DIR, "server-token")
+TOKEN_HEADER = "X-Tagging-Token"
+
+ENGINE_MODULES = {
+    "clip": "clip_classifier",
+    "blip": "blip_classifier",
+    "hybrid": "hybrid_classifier",
+}
+
+# Models are not thread-safe to share, so one classify call runs at a time
+_engines = {}
+_caches = {}
+_engine_lock = threading.Lock()
+
+# Inference backend every engine switches to when it is loaded (see inference_backends.py)
+_backend = ("torch", inference_backends.DEFAULT_MODEL_DIR)
+_precision = "fp32"
+
+# The only folder requests may name files in
+_file_dir = tempfile.gettempdir()
+
+
+def request_file(request, field):
+    """The request's path in `field` (or None), if it is inside the file directory."""
+    path = request.get(field)
+    if path is None:
+        return None
+    folder = os.path.realpath(_file_dir)
+    # Resolves symlinks too, so a link in the folder can't point elsewhere
+    if os.path.commonpath([folder, os.path.realpath(path)]) != folder:
+        raise ValueError(f"'{field}' must be inside {_file_dir}")
+    return path
+
+
+def write_token(path=TOKEN_FILE):
+    """Creates this launch's token and stores it where only the user can read it."""
+    token = secrets.token_hex(16)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    os.chmod(path, 0o600)
+    return token
+
+
+def get_engine(name):
+    """Imports (and therefore loads) a classifier module once, then reuses it."""
+    if name not in ENGINE_MODULES:
+        raise ValueError(f"Unknown engine: {name}")
+    if name not in _engines:
+        engine = importlib.import_module(ENGINE_MODULES[name])
+        engine.load_models()
+        engine.use_backend(*_backend)
+        engine.use_precision(_precision)
+        _engines[name] = engine
+    return _engines[name]
+
+
+def engine_cache(name):
+    """
+    The server owns each engine's cache for as long as it runs; the hybrid
+    engine shares the clip and blip ones (a cache can only be open once).
+    """
+    engine = get_engine(name)
+    cache = _caches.get(name)
+    # The caption cache is per decode profile
+    if name == "blip" and cache is not None and cache.model_name != engine.caption_cache_name():
+        cache.close()
+        del _caches[name]
+    if name not in _caches:
+        _caches[name] = engine.open_cache()
+    return _caches[name]
+
+
+def photo_index():
+    """The server keeps CLIP's photo index open for writing: clip and hybrid runs add to it, /search reads it."""
+    if "photo_index" not in _caches:
+        _caches["photo_index"] = get_engine("clip").open_photo_index()
+    return _caches["photo_index"]
+
+
+def iter_results(request):
+    """Runs one /classify request body against the requested engine, yielding result entries in input order."""
+    engine_name = request.get("engine", "clip")
+
+    if "paths" in request:
+        image_paths = request["paths"]
+    elif "json_file" in request:
+        image_paths = tagging_io.read_paths(request_file(request, "json_file"))
+    else:
+        raise ValueError("Request needs either 'paths' or 'json_file'")
+
+    taxonomy = request.get("taxonomy")
+    if taxonomy:
+        taxonomy = category_index.resolve_taxonomy(taxonomy)
+    # CLIP (and the hybrid engine's CLIP stage) vs BLIP defaults
+    clip_defaults = engine_name != "blip"
+    top_k = int(request.get("top_k", 10 if clip_defaults else 3))
+    threshold = float(request.get("threshold", 0.1 if clip_defaults else 0.4))
+    decode_timeout = float(request.get("decode_timeout", tagging_errors.DEFAULT_DECODE_TIMEOUT))
+    retries = int(request.get("retries", tagging_errors.DEFAULT_RETRIES))
+    caption_batch = int(request.get("caption_batch", 4))
+    if caption_batch < 1:
+        raise ValueError("'caption_batch' must be at least 1")
+
+    with _engine_lock:
+        # Stage timings cover this request only
+        run_metrics.reset()
+        metrics_file = request_file(request, "metrics_file")
+        if metrics_file:
+            run_metrics.enable()
+        started = time.perf_counter()
+        count = 0
+
+        engine = get_engine(engine_name)
+        # Every request names its taxonomy (or gets the default); compiled ones are reused
+        engine.use_taxonomy(taxonomy)
+        if engine_name != "clip":
+            get_engine("blip").use_decode_profile(request.get("decode_profile", "quality"),
+                                                  request.get("early_stop_words"))
+
+        if engine_name == "hybrid":
+            min_margin = float(request.get("min_margin", 0.15))
+            blip_top_k = int(request.get("blip_top_k", 3))
+            blip_threshold = float(request.get("blip_threshold", 0.4))
+            key = engine.state_key(top_k, threshold, min_margin, blip_top_k, blip_threshold, taxonomy, _precision)
+        else:
+            key = engine.state_key(top_k, threshold, taxonomy, _precision)
+
+        # Incremental requests only get results for photos that changed since their last run
+        state = tagging_state.open_state() if request.get("incremental") else None
+        if state is not None:
+            image_paths = state.pending(image_paths, key)
+
+        if engine_name == "clip":
+            run = functools.partial(
+                engine.iter_classify_images,
+                top_k=top_k,
+                threshold=threshold,
+                batch_size=int(request.get("batch_size", 16)),
+                cache=engine_cache("clip"),
+                decode_timeout=decode_timeout,
+                retries=retries,
+                photo_index=photo_index(),
+            )
+        elif engine_name == "blip":
+            run = functools.partial(
+                engine.iter_classify_images,
+                top_k=top_k,
+                threshold=threshold,
+                cache=engine_cache("blip"),
+                rescore_only=bool(request.get("rescore_only", False)),
+                caption_batch=caption_batch,
+                decode_timeout=decode_timeout,
+                retries=retries,
+            )
+        else:
+            run = functools.partial(
+                engine.iter_classify_images,
+                top_k=top_k,
+                threshold=threshold,
+                min_margin=min_margin,
+                blip_top_k=blip_top_k,
+                blip_threshold=blip_threshold,
+                batch_size=int(request.get("batch_size", 16)),
+                clip_cache=engine_cache("clip"),
+                blip_cache=engine_cache("blip"),
+                caption_batch=caption_batch,
+                decode_timeout=decode_timeout,
+                retries=retries,
+                photo_index=photo_index(),
+            )
+
+        if request.get("dedupe"):
+            # Only the first photo of each burst / near-duplicate group is classified
+            similarity = float(request.get("dedupe_similarity", burst_groups.DEFAULT_SIMILARITY))
+            results = burst_groups.iter_grouped(image_paths, run, similarity, decode_timeout=decode_timeout)
+        else:
+            results = ((result, None, None) for result in run(image_paths))
+
+        try:
+            for result, group, duplicate_of in results:
+                entry = {"image_path": result[0], "tags": result[1]}
+                # The hybrid engine also says which stage tagged the photo
+                if len(result) > 2:
+                    entry["stage"] = "duplicate" if duplicate_of is not None else result[2]
+                burst_groups.annotate(entry, group, duplicate_of)
+                tagging_errors.annotate(entry)
+                if state is not None and tagging_errors.is_final(entry["tags"]):
+                    state.record(entry["image_path"], entry["tags"])
+                count += 1
+                yield entry
+        finally:
+            if state is not None:
+                state.close()
+            if metrics_file:
+                run_metrics.write_sidecar(metrics_file, run_metrics.report(count, time.perf_counter() - started,
+                                                                           engine=engine_name))
+
+
+def classify(request):
+    """
+    Runs one /classify request. With "output_file", results are streamed to
+    that file as NDJSON while they are produced and only a count is returned.
+    """
+    if "output_file" not in request:
+        return list(iter_results(request))
+
+    with open(request_file(request, "output_file"), "w") as f:
+        writer = tagging_io.ResultWriter(stream=True, out=f)
+        for entry in iter_results(request):
+            with run_metrics.timed("output", [entry["image_path"]]):
+                writer.write(entry)
+    return {"status": "ok", "count": writer.count}
+
+
+def search(request):
+    """Runs one /search request with the loaded CLIP model."""
+    text = request.get("query")
+    image_path = request.get("image_path")
+    if not text and not image_path:
+        raise ValueError("Request needs 'query' or 'image_path'")
+    min_score = request.get("min_score")
+    with _engine_lock:
+        index = photo_index()
+        if index is None:
+            raise ValueError("Photo index unavailable (in use by another process?)")
+        return photo_search.search(index, text, image_path, top=int(request.get("top", photo_search.DEFAULT_TOP)),
+                                   min_score=float(min_score) if min_score is not None else None,
+                                   nprobe=int(request.get("nprobe", vector_index.DEFAULT_NPROBE)))
+
+
+class TaggingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, idle_timeout, token=None):
+        super().__init__(address, TaggingRequestHandler)
+        self.idle_timeout = idle_timeout
+        self.token = token or secrets.token_hex(16)
+        self.last_activity = time.monotonic()
+        self.active_requests = 0
+        self._activity_lock = threading.Lock()
+
+    def begin_request(self):
+        with self._activity_lock:
+            self.active_requests += 1
+            self.last_activity = time.monotonic()
+
+    def end_request(self):
+        with self._activity_lock:
+            self.active_requests -= 1
+            self.last_activity = time.monotonic()
+
+    def idle_seconds(self):
+        with self._activity_lock:
+            if self.active_requests:
+                return 0.0
+            return time.monotonic() - self.last_activity
+
+    def watch_idle(self):
+        """Shuts the server down once it has been idle for idle_timeout seconds."""
+        while True:
+            time.sleep(min(5.0, self.idle_timeout))
+            if self.idle_seconds() >= self.idle_timeout:
+                print(f"Idle for {self.idle_timeout:.0f}s, shutting down", file=sys.stderr)
+                self.shutdown()
+                return
+
+
+class TaggingRequestHandler(BaseHTTPRequestHandler):
+    server_version = "LightroomTaggingServer/1.0"
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        self.send_json(200, {
+            "status": "ok",
+            "engines": sorted(_engines),
+            "idle_seconds": round(self.server.idle_seconds(), 1),
+            "idle_timeout": self.server.idle_timeout,
+        })
+
+    def rejection(self):
+        """Why a POST must be refused as (status, message), or None."""
+        # Browsers send Origin with every POST; Lightroom and the scripts don't
+        if self.headers.get("Origin") is not None:
+            return 403, "Requests from web pages are not accepted"
+        content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            return 415, "Content-Type must be application/json"
+        if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ""), self.server.token):
+            return 403, f"Missing or wrong {TOKEN_HEADER} (see {TOKEN_FILE})"
+        return None
+
+    def do_POST(self):
+        rejection = self.rejection()
+        if rejection is not None:
+            self.send_json(rejection[0], {"error": rejection[1]})
+            return
+        if self.path == "/shutdown":
+            self.send_json(200, {"status": "shutting down"})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        handlers = {"/classify": classify, "/search": search}
+        if self.path not in handlers:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+
+        self.server.begin_request()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            results = handlers[self.path](request)
+        except (ValueError, OSError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        finally:
+            self.server.end_request()
+
+        self.send_json(200, results)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep request logs on stderr, like the classifier scripts' warnings
+        print(f"[tagging_server] {format % args}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve CLIP/BLIP tagging over localhost HTTP.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--idle-timeout", type=float, default=1800,
+                        help="Seconds without requests before the server exits (default: 1800)")
+    parser.add_argument("--preload", nargs="*", default=["clip"], choices=sorted(ENGINE_MODULES),
+                        help="Engines to load before accepting requests (default: clip)")
+    parser.add_argument("--backend", choices=inference_backends.BACKENDS, default="torch",
+                        help="Inference backend for the per-image encoders (default: torch)")
+    parser.add_argument("--model-dir", default=inference_backends.DEFAULT_MODEL_DIR,
+                        help="Folder with graphs written by export_models.py")
+    parser.add_argument("--precision", choices=inference_backends.PRECISIONS, default="fp32",
+                        help="int8: quantize the eager models' Linear layers to cut memory (CPU only)")
+    parser.add_argument("--file-dir", default=tempfile.gettempdir(),
+                        help="Folder that requests' json_file / output_file / metrics_file must be in "
+                             "(default: the temp directory, which the plugin uses)")
+    args = parser.parse_args()
+
+    global _backend, _precision, _file_dir
+    _backend = (args.backend, args.model_dir)
+    _precision = args.precision
+    _file_dir = args.file_dir
+
+    for name in args.preload:
+        get_engine(name)
+
+    server = TaggingServer(("127.0.0.1", args.port), args.idle_timeout, token=write_token())
+    threading.Thread(target=server.watch_idle, daemon=True).start()
+    print(f"Tagging server listening on http://127.0.0.1:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # Unless a newer server has replaced it
+        try:
+            with open(TOKEN_FILE) as f:
+                if f.read() == server.token:
+                    os.remove(TOKEN_FILE)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    main()
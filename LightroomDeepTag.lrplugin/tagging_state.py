@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Per-photo record of the last tagging run, for incremental runs.
+
+A SQLite database (state.sqlite in the cache directory) stores, per photo
+path, the file identity (path + size + mtime, see embedding_cache.file_key),
+a run key covering everything that decides the tags (engine, models,
+precision, decode settings, taxonomy content, top_k/threshold) and the
+tags returned. With --incremental, the classifier scripts skip photos whose
+file identity and run key are unchanged, before loading any model, and
+print nothing for them.
+
+Results are recorded as they are handed to Lightroom. If Lightroom doesn't
+apply them (e.g. the run is canceled), it calls
+
+  python tagging_state.py --forget photo_paths.ndjson
+
+so those photos are tagged again next time.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import embedding_cache
+import tagging_io
+
+DEFAULT_STATE_DB = os.path.join(embedding_cache.DEFAULT_CACHE_DIR, "state.sqlite")
+
+# Records per transaction, and the most seconds a record stays uncommitted
+# (what a crashed run redoes when resuming, see long_run)
+COMMIT_EVERY = 256
+COMMIT_SECONDS = 2
+
+
+def run_key(*parts):
+    """Hashes the settings that decide a photo's tags into one short key."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class TaggingState:
+    def __init__(self, db_path=DEFAULT_STATE_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # The tagging server records results on its request threads
+        self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS photos ("
+            " path TEXT PRIMARY KEY, file_key TEXT NOT NULL, run_key TEXT NOT NULL, tags TEXT, updated REAL)"
+        )
+        self._db.commit()
+        self._file_keys = {}
+        self._run_key = None
+        self._uncommitted = 0
+        self._committed = time.monotonic()
+        self.skipped = 0
+
+    def pending(self, image_paths, key):
+        """Yields the paths whose file or run key changed since they were last recorded under `key`."""
+        self._run_key = key
+        for path in image_paths:
+            file_key = embedding_cache.file_key(path)
+            row = self._db.execute("SELECT file_key, run_key FROM photos WHERE path = ?", (path,)).fetchone()
+            if file_key is not None and row == (file_key, key):
+                self.skipped += 1
+                continue
+            self._file_keys[path] = file_key
+            yield path
+
+    def record(self, path, tags):
+        """
+        Stores the tags a pending path got. Unreadable photos ([] tags) are
+        recorded too, so they are only retried once the file changes.
+        """
+        file_key = self._file_keys.pop(path, None)
+        if file_key is None:
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO photos (path, file_key, run_key, tags, updated) VALUES (?, ?, ?, ?, ?)",
+            (path, file_key, self._run_key, json.dumps(tags), time.time()),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY or time.monotonic() - self._committed >= COMMIT_SECONDS:
+            self.commit()
+
+    def forget(self, image_paths):
+        """Drops the records of these paths; returns how many there were."""
+        forgotten = 0
+        for path in image_paths:
+            forgotten += self._db.execute("DELETE FROM photos WHERE path = ?", (path,)).rowcount
+        self._db.commit()
+        return forgotten
+
+    def commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+        self._committed = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+
+def open_state(db_path=DEFAULT_STATE_DB):
+    """Opens the state database, or returns None (with a warning) if it can't be used."""
+    try:
+        return TaggingState(db_path)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Incremental state disabled: {e}", file=sys.stderr)
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the incremental tagging state.")
+    parser.add_argument("--forget", metavar="JSON_FILE",
+                        help="Forget the photos in this JSON array / NDJSON file, so they are tagged again")
+    parser.add_argument("--state-db", default=DEFAULT_STATE_DB,
+                        help="Incremental state database (default: state.sqlite in the cache directory)")
+    args = parser.parse_args()
+
+    if not args.forget:
+        parser.error("nothing to do; pass --forget")
+    state = TaggingState(args.state_db)
+    forgotten = state.forget(tagging_io.read_paths(args.forget))
+    state.close()
+    print(json.dumps({"status": "ok", "forgotten": forgotten}))
+
+
+if __name__ == "__main__":
+    main()
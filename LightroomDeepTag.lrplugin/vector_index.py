@@ -0,0 +1,277 @@
+"""
+Catalog-wide index of the photos' CLIP image embeddings, for search.
+
+Classification runs add every photo they encode (or find in the embedding
+cache) under its absolute path; a photo tagged again overwrites its row.
+Each model gets its own directory holding:
+
+  vectors.f16  float16 [capacity, dim] matrix, memory-mapped and grown as needed
+  index.json   {"version": ..., "model": ..., "dim": ..., "paths": [...]}, row i = paths[i]
+  ivf.npz      coarse quantizer once the index is large (see below)
+
+A query is a unit-length vector in the same space (a CLIP text or image
+embedding); search() returns the rows with the highest cosine similarity.
+Up to IVF_MIN_PHOTOS photos every row is scored. Beyond that, save() trains
+an inverted-file index: k-means centroids over the rows, each row filed
+under its nearest centroid, so a query only scores the rows of its nprobe
+nearest lists plus the rows added since training. It is retrained once the
+index has doubled. Rows overwritten after training stay in their old list.
+
+One process writes at a time (the writer holds a lock); any number may
+search, seeing the index as of the writer's last save().
+"""
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+import embedding_cache
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locking, single process assumed
+    fcntl = None
+
+INDEX_VERSION = 1
+
+# Below this many photos a query scores every row; from here on it probes the IVF lists
+IVF_MIN_PHOTOS = 20000
+# IVF lists scored per query
+DEFAULT_NPROBE = 16
+MAX_LISTS = 4096
+KMEANS_ITERATIONS = 10
+# Rows k-means is trained on; the rest are only assigned to the resulting lists
+KMEANS_SAMPLE = 50000
+# Rows scored per matmul when assigning lists
+CHUNK_ROWS = 8192
+
+
+class IndexLockedError(RuntimeError):
+    """Another process already has this model's index open for writing."""
+
+
+class PhotoIndex:
+    def __init__(self, model_name, dim=None, cache_dir=embedding_cache.DEFAULT_CACHE_DIR, writable=True):
+        self.model_name = model_name
+        self.dim = dim
+        self.writable = writable
+        self.directory = os.path.join(cache_dir, "photo-index", embedding_cache._model_dir_name(model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self._data_path = os.path.join(self.directory, "vectors.f16")
+        self._index_path = os.path.join(self.directory, "index.json")
+        self._ivf_path = os.path.join(self.directory, "ivf.npz")
+
+        self._lock = threading.Lock()
+        self._lock_file = self._acquire_process_lock() if writable else None
+
+        # abs path -> row, and row -> abs path
+        self._rows = {}
+        self._paths = []
+        self._matrix = None
+        self._capacity = 0
+        # (centroids [K, D] float32, rows ordered by list, list start offsets [K + 1], rows trained on)
+        self._ivf = None
+        # float32 copy of the rows for full scans, until the next put()
+        self._dense = None
+        self._dirty = False
+        self._load()
+
+    def _acquire_process_lock(self):
+        lock_file = open(os.path.join(self.directory, ".lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise IndexLockedError(f"Photo index in use by another process: {self.directory}")
+        return lock_file
+
+    def _load(self):
+        paths = []
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r") as f:
+                    index = json.load(f)
+                # Another format version, model or embedding size: start over
+                if (index.get("version") == INDEX_VERSION and index.get("model") == self.model_name
+                        and (self.dim is None or index.get("dim") == self.dim)):
+                    self.dim = index["dim"]
+                    paths = index.get("paths", [])
+            except (OSError, ValueError, KeyError):
+                paths = []
+        if self.dim is None:
+            # A reader of an index that was never written: nothing to search
+            return
+
+        self._paths = list(paths)
+        self._rows = {path: row for row, path in enumerate(self._paths)}
+        if self.writable:
+            self._map(max(len(self._paths), 1024))
+        elif self._paths:
+            self._matrix = np.memmap(self._data_path, dtype=np.float16, mode="r", shape=(len(self._paths), self.dim))
+            self._capacity = len(self._paths)
+
+        if os.path.exists(self._ivf_path):
+            try:
+                with np.load(self._ivf_path) as ivf:
+                    trained = int(ivf["trained"])
+                    if trained <= len(self._paths) and ivf["centroids"].shape[1] == self.dim:
+                        self._ivf = (ivf["centroids"], ivf["order"], ivf["offsets"], trained)
+            except (OSError, ValueError, KeyError):
+                self._ivf = None
+
+    def _map(self, capacity):
+        """(Re)maps the backing file with room for `capacity` rows; extending it leaves a sparse tail."""
+        if self._matrix is not None:
+            self._matrix.flush()
+            del self._matrix
+        size = capacity * self.dim * 2
+        if not os.path.exists(self._data_path) or os.path.getsize(self._data_path) < size:
+            with open(self._data_path, "ab") as f:
+                f.truncate(size)
+        self._matrix = np.memmap(self._data_path, dtype=np.float16, mode="r+", shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    def __len__(self):
+        return len(self._paths)
+
+    def put(self, path, vector):
+        """Adds or overwrites the photo's embedding (stored unit-length)."""
+        self.put_many([path], np.asarray(vector)[None])
+
+    def put_many(self, paths, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._map(1024)
+            for path, vector in zip(paths, vectors):
+                path = os.path.abspath(path)
+                row = self._rows.get(path)
+                if row is None:
+                    row = len(self._paths)
+                    if row >= self._capacity:
+                        self._map(2 * self._capacity)
+                    self._rows[path] = row
+                    self._paths.append(path)
+                self._matrix[row] = vector.astype(np.float16)
+            self._dense = None
+            self._dirty = True
+
+    def save(self):
+        """Flushes the vectors, atomically rewrites the index, and (re)trains the IVF lists once it has grown enough."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._matrix.flush()
+            index = {"version": INDEX_VERSION, "model": self.model_name, "dim": self.dim, "paths": self._paths}
+            tmp_path = self._index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self._index_path)
+            self._dirty = False
+
+            count = len(self._paths)
+            if count >= IVF_MIN_PHOTOS and (self._ivf is None or count >= 2 * self._ivf[3]):
+                self._train()
+
+    def _train(self):
+        """k-means (on the unit sphere) over a sample of the rows, then files every row under its nearest centroid."""
+        count = len(self._paths)
+        rng = np.random.default_rng(0)
+        lists = int(min(MAX_LISTS, max(16, np.sqrt(count))))
+        sample_rows = np.sort(rng.choice(count, min(count, KMEANS_SAMPLE), replace=False))
+        sample = np.asarray(self._matrix[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assigned = (sample @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assigned, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # A list nothing was assigned to keeps its centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        assigned = np.concatenate([
+            (np.asarray(self._matrix[start:min(start + CHUNK_ROWS, count)], dtype=np.float32) @ centroids.T).argmax(axis=1)
+            for start in range(0, count, CHUNK_ROWS)
+        ])
+        order = np.argsort(assigned, kind="stable").astype(np.int64)
+        offsets = np.searchsorted(assigned[order], np.arange(lists + 1))
+        self._ivf = (centroids, order, offsets, count)
+
+        tmp_path = self._ivf_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=centroids, order=order, offsets=offsets, trained=count)
+        os.replace(tmp_path, self._ivf_path)
+        print(f"Photo index: trained {lists} IVF lists over {count} photos", file=sys.stderr)
+
+    def _candidates(self, query, nprobe):
+        """Rows worth scoring for query: all of them, or those in the nprobe nearest IVF lists plus untrained ones."""
+        count = len(self._paths)
+        if self._ivf is None or count < IVF_MIN_PHOTOS:
+            return None
+        centroids, order, offsets, trained = self._ivf
+        nprobe = min(nprobe, len(centroids))
+        probes = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+        rows = [order[offsets[i]:offsets[i + 1]] for i in probes]
+        rows.append(np.arange(trained, count))
+        return np.sort(np.concatenate(rows))
+
+    def search(self, query, top=50, nprobe=DEFAULT_NPROBE, existing_only=True):
+        """
+        Returns up to `top` (path, cosine similarity) pairs for a query vector, best
+        first, and the number of photos scored. With existing_only, photos whose file
+        is gone (deleted or moved since they were indexed) are left out.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            if not self._paths:
+                return [], 0
+            if self.dim != query.shape[0]:
+                raise ValueError(f"Query has {query.shape[0]} dimensions, the index {self.dim}")
+            rows = self._candidates(query, nprobe)
+            if rows is None:
+                if self._dense is None:
+                    self._dense = np.asarray(self._matrix[:len(self._paths)], dtype=np.float32)
+                scores = self._dense @ query
+            else:
+                scores = np.asarray(self._matrix[rows], dtype=np.float32) @ query
+            paths = self._paths
+
+        results = []
+        # A few more than asked for, in case some files are gone
+        wanted = min(len(scores), max(1, top) * 2 if existing_only else max(1, top))
+        while True:
+            best = np.argpartition(-scores, wanted - 1)[:wanted]
+            best = best[np.argsort(-scores[best], kind="stable")]
+            results = []
+            for i in best:
+                path = paths[rows[i] if rows is not None else i]
+                if existing_only and not os.path.exists(path):
+                    continue
+                results.append((path, round(min(float(scores[i]), 1.0), 4)))
+                if len(results) >= top:
+                    return results, len(scores)
+            if wanted >= len(scores):
+                return results, len(scores)
+            wanted = min(len(scores), wanted * 4)
+
+    def close(self):
+        if self.writable:
+            self.save()
+            self._lock_file.close()
+        self._matrix = None
+        self._dense = None
+
+
+def open_index(model_name, dim, **kwargs):
+    """Opens a model's index for writing, or returns None (with a warning) if another process holds it."""
+    try:
+        return PhotoIndex(model_name, dim, **kwargs)
+    except (IndexLockedError, OSError) as e:
+        print(f"Photo index disabled: {e}", file=sys.stderr)
+        return None
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the CLIP image encoder across inference backends.
+
+Times clip_classifier.encode_images + tags_from_features on synthetic images
+with eager PyTorch and with each exported backend found in --model-dir
+(run export_models.py --format onnx / torchscript first).
+
+Usage: python benchmarks/backend_benchmark.py [--images 64] [--batch-size 16] [--backends torch onnx torchscript]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The classifiers live in the plugin folder, not in an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LightroomDeepTag.lrplugin"))
+
+import clip_classifier
+import inference_backends
+from clip_batch_benchmark import run, synthetic_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CLIP throughput across inference backends.")
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--backends", nargs="+", choices=inference_backends.BACKENDS,
+                        default=list(inference_backends.BACKENDS))
+    parser.add_argument("--model-dir", default=inference_backends.DEFAULT_MODEL_DIR)
+    args = parser.parse_args()
+
+    clip_classifier.load_models()
+    image_inputs = [clip_classifier.preprocess(image) for image in synthetic_images(args.images)]
+
+    print(f"device={clip_classifier.device} images={args.images} batch_size={args.batch_size}")
+    for backend in args.backends:
+        try:
+            clip_classifier.use_backend(backend, args.model_dir)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"{backend:<12} skipped: {e}")
+            continue
+
+        # Warm up once so session / kernel initialisation isn't timed
+        run(image_inputs[:args.batch_size], args.batch_size)
+        elapsed = run(image_inputs, args.batch_size)
+        print(f"{backend:<12} {elapsed:7.2f}s  {args.images / elapsed:7.1f} images/sec")
+
+
+if __name__ == "__main__":
+    main()
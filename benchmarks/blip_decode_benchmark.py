@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Captions/sec and category agreement of the BLIP decode profiles.
+
+Captions the fixture images with every decode profile (optionally also with
+--early-stop-words) at each caption batch size, and reports throughput plus
+how often the top-1 category matches the "quality" profile at batch size 1.
+Also checks that batched captions equal unbatched ones and that the KV cache
+(use_cache) leaves beam search output unchanged while speeding it up.
+
+Usage: python benchmarks/blip_decode_benchmark.py [--images a.jpg ...] [--count 8] [--batch-sizes 1 4] [--early-stop-words 8]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The classifiers live in the plugin folder, not in an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LightroomDeepTag.lrplugin"))
+
+import blip_classifier
+from clip_batch_benchmark import synthetic_images
+
+
+def caption_all(inputs, batch_size, use_cache=True):
+    """Captions every preprocessed input at the given batch size; returns (captions, elapsed seconds)."""
+    captions = []
+    start = time.perf_counter()
+    for offset in range(0, len(inputs), batch_size):
+        captions.extend(blip_classifier.generate_captions(inputs[offset:offset + batch_size], use_cache=use_cache))
+    return captions, time.perf_counter() - start
+
+
+def top1(captions):
+    embeddings = blip_classifier.encode_captions(captions)
+    return [tags[0][0] for tags in blip_classifier.match_caption_embeddings(embeddings, top_k=1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare BLIP decode profiles: captions/sec and category agreement.")
+    parser.add_argument("--images", nargs="*", default=[], help="Fixture images (default: synthetic)")
+    parser.add_argument("--count", type=int, default=8, help="Number of synthetic images (default: 8)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--early-stop-words", type=int, default=8,
+                        help="Also run each profile with this early stop, 0 to skip (default: 8)")
+    args = parser.parse_args()
+
+    blip_classifier.load_models()
+    if args.images:
+        inputs = [blip_classifier.load_caption_inputs(path) for path in args.images]
+    else:
+        inputs = [blip_classifier.blip_processor(images=image, return_tensors="pt")
+                  for image in synthetic_images(args.count)]
+
+    # Warm up once so lazy initialisation isn't timed
+    caption_all(inputs[:1], 1)
+
+    runs = [(profile, None) for profile in blip_classifier.DECODE_PROFILES]
+    if args.early_stop_words:
+        runs += [(profile, args.early_stop_words) for profile in blip_classifier.DECODE_PROFILES]
+
+    print(f"device={blip_classifier.device} images={len(inputs)}")
+    print(f"{'profile':<9} {'early stop':>10} {'batch':>5} {'captions/sec':>13} {'avg words':>9}  "
+          f"same as batch 1  top-1 agreement")
+    baseline = None
+    for profile, early_stop in runs:
+        blip_classifier.use_decode_profile(profile, early_stop)
+        unbatched = None
+        for batch_size in args.batch_sizes:
+            captions, elapsed = caption_all(inputs, batch_size)
+            categories = top1(captions)
+            if unbatched is None:
+                unbatched = captions
+            if baseline is None:
+                baseline = categories
+            words = sum(len(caption.split()) for caption in captions) / len(captions)
+            same = sum(a == b for a, b in zip(unbatched, captions))
+            agreed = sum(a == b for a, b in zip(baseline, categories))
+            print(f"{profile:<9} {early_stop or '-':>10} {batch_size:>5} {len(inputs) / elapsed:13.2f} {words:9.1f}  "
+                  f"{same:>7}/{len(inputs):<7}  {agreed}/{len(inputs)}")
+
+    # Beam search with and without reusing past keys/values: same captions, different cost
+    blip_classifier.use_decode_profile("quality")
+    cached, cached_seconds = caption_all(inputs, 1, use_cache=True)
+    uncached, uncached_seconds = caption_all(inputs, 1, use_cache=False)
+    same = sum(a == b for a, b in zip(cached, uncached))
+    print(f"KV cache (quality, batch 1): identical captions {same}/{len(inputs)}, "
+          f"use_cache=True {cached_seconds:.2f}s vs use_cache=False {uncached_seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for batched CLIP inference.
+
+Generates synthetic images in memory, preprocesses them once, and then times
+clip_classifier.encode_images + tags_from_features at several batch sizes.
+
+Usage: python benchmarks/clip_batch_benchmark.py [--images 64] [--batch-sizes 1 8 32]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+# The classifiers live in the plugin folder, not in an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LightroomDeepTag.lrplugin"))
+
+import torch
+import clip_classifier
+
+
+def synthetic_images(count, size=(1024, 768), seed=0):
+    """Deterministic noise + gradient images, so every run decodes the same pixels."""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    images = []
+    for _ in range(count):
+        noise = rng.integers(0, 96, size=(height, width, 3)).astype(np.float32)
+        pixels = np.clip(noise + gradient * rng.random(3, dtype=np.float32), 0, 255).astype(np.uint8)
+        images.append(Image.fromarray(pixels, "RGB"))
+    return images
+
+
+def run(image_inputs, batch_size):
+    """Classifies every preprocessed input at the given batch size; returns elapsed seconds."""
+    start = time.perf_counter()
+    for offset in range(0, len(image_inputs), batch_size):
+        batch = torch.stack(image_inputs[offset:offset + batch_size])
+        clip_classifier.tags_from_features(clip_classifier.encode_images(batch))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CLIP throughput across batch sizes.")
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    clip_classifier.load_models()
+    image_inputs = [clip_classifier.preprocess(image) for image in synthetic_images(args.images)]
+
+    # Warm up once so lazy kernel initialisation doesn't count against batch size 1
+    run(image_inputs[:1], 1)
+
+    print(f"device={clip_classifier.device} images={args.images}")
+    for batch_size in args.batch_sizes:
+        elapsed = run(image_inputs, batch_size)
+        print(f"batch_size={batch_size:>3}  {elapsed:7.2f}s  {args.images / elapsed:7.1f} images/sec")
+
+
+if __name__ == "__main__":
+    main()
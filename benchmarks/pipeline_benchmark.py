@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark suite and regression gate for the tagging pipeline.
+
+Writes a deterministic synthetic corpus (JPEG, PNG and HEIF at several sizes,
+with a few burst frames for --dedupe), then runs every case in a fresh
+subprocess, the way the plugin launches the scripts:
+
+  clip, clip-stream, clip-dedupe, clip-int8, blip, blip-fast, hybrid
+      the classifier script's main() on the corpus, caches off
+  server-clip, server-hybrid
+      the tagging server in-process, sent the /classify request the plugin's
+      TaggingService sends (NDJSON output file); a cold request that loads
+      the models, then the measured warm one
+
+Per case it reports images/sec (model loading excluded), p50/p95 per-photo
+latency (each photo's share of the stage timings, see run_metrics.py),
+startup (imports, weights, prompt encoding), peak RSS and the subprocess's
+wall time, as JSON. Each case runs --repeat times; the median run by
+images/sec is kept.
+
+With --baseline, the results are compared against a stored report and the
+script exits with status 1 if a case got slower or bigger than the
+--max-* thresholds allow; --save-baseline stores this run as one. Baselines
+only compare like with like: same machine, models and corpus.
+
+--models tiny swaps in tiny random-weight stand-ins (tiny_models.py), so the
+suite runs offline in seconds; the default uses the real models, which must
+be downloaded or cached already.
+
+This process never imports torch: on Linux a child inherits its parent's
+peak RSS, so the workers' numbers would include it.
+
+Usage: python benchmarks/pipeline_benchmark.py [--models real|tiny] [--cases clip blip-fast ...] [--count 24]
+                                               [--output report.json] [--baseline baseline.json] [--save-baseline FILE]
+"""
+import argparse
+import contextlib
+import hashlib
+import importlib
+import importlib.metadata
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The classifiers live in the plugin folder, not in an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LightroomDeepTag.lrplugin"))
+
+import embedding_cache
+import tiny_models
+
+REPORT_VERSION = 1
+
+# name -> (classifier module, command-line arguments after the paths file)
+SCRIPT_CASES = OrderedDict([
+    ("clip", ("clip_classifier", ["10", "0.2", "--no-photo-index"])),
+    ("clip-stream", ("clip_classifier", ["10", "0.2", "--no-photo-index", "--stream"])),
+    ("clip-dedupe", ("clip_classifier", ["10", "0.2", "--no-photo-index", "--dedupe"])),
+    ("clip-int8", ("clip_classifier", ["10", "0.2", "--no-photo-index", "--precision", "int8"])),
+    ("blip", ("blip_classifier", [])),
+    ("blip-fast", ("blip_classifier", ["--decode-profile", "fast"])),
+    ("hybrid", ("hybrid_classifier", ["--no-photo-index"])),
+])
+
+# name -> /classify request, as the plugin's TaggingService modules send it
+SERVER_CASES = OrderedDict([
+    ("server-clip", {"engine": "clip", "top_k": 10, "threshold": 0.2}),
+    ("server-hybrid", {"engine": "hybrid"}),
+])
+
+CASES = list(SCRIPT_CASES) + list(SERVER_CASES)
+
+# Corpus: formats and sizes are cycled through, so every run writes the same files
+CORPUS_FORMATS = (("jpeg", ".jpg"), ("png", ".png"), ("heif", ".heic"))
+# Pillow save() options per format; x265's fastest preset keeps writing HEIF bearable
+SAVE_OPTIONS = {
+    "jpeg": {"quality": 90},
+    "png": {},
+    "heif": {"quality": 90, "enc_params": {"preset": "ultrafast"}},
+}
+CORPUS_SIZES = ((640, 480), (1600, 1200), (1200, 1600), (3000, 2000))
+# Every BURST_EVERY-th photo is a slightly shifted copy of the one before it
+BURST_EVERY = 6
+
+DEFAULT_TINY_MODELS_DIR = os.path.join(embedding_cache.DEFAULT_CACHE_DIR, "tiny-models")
+
+# metric -> (higher is better, threshold flag)
+GATED_METRICS = OrderedDict([
+    ("images_per_second", (True, "max_throughput_drop")),
+    ("latency_p95_ms", (False, "max_latency_growth")),
+    ("startup_seconds", (False, "max_startup_growth")),
+    ("peak_rss_mb", (False, "max_rss_growth")),
+])
+
+
+def synthetic_photo(size, seed):
+    """
+    A deterministic photo-like image: a sky/ground gradient with a few shapes and
+    mild grain. Smooth enough to compress like a photo (pure noise makes JPEG and
+    HEIF encoding, and decoding, unrealistically slow).
+    """
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(seed)
+    width, height = size
+    top, bottom = rng.integers(0, 256, size=(2, 3))
+    ramp = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None, None]
+    pixels = np.broadcast_to(top + (bottom - top) * ramp, (height, width, 3))
+    image = Image.fromarray(pixels.astype(np.uint8), "RGB")
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x0, x1 = sorted(rng.integers(0, width, size=2))
+        y0, y1 = sorted(rng.integers(0, height, size=2))
+        fill = tuple(int(c) for c in rng.integers(0, 256, size=3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)([x0, y0, x1, y1], fill=fill)
+
+    grain = rng.normal(0, 6, size=(height, width, 1)).astype(np.float32)
+    return Image.fromarray(np.clip(np.asarray(image, dtype=np.float32) + grain, 0, 255).astype(np.uint8), "RGB")
+
+
+def write_corpus(folder, count, seed=0):
+    """Writes `count` synthetic photos to folder; returns (paths, SHA-1 over their bytes)."""
+    from PIL import Image
+
+    # Registers Pillow's HEIF plugin, as the classifiers do
+    import image_loader  # noqa: F401
+
+    paths = []
+    digest = hashlib.sha1()
+    previous = None
+    for i in range(count):
+        if previous is not None and i % BURST_EVERY == BURST_EVERY - 1:
+            # A burst frame: the previous photo, moved by a few pixels
+            image = Image.fromarray(np.roll(np.asarray(previous), 4, axis=1))
+        else:
+            size = CORPUS_SIZES[i % len(CORPUS_SIZES)]
+            image = synthetic_photo(size, seed + i)
+        file_format, extension = CORPUS_FORMATS[i % len(CORPUS_FORMATS)]
+        path = os.path.join(folder, f"corpus_{i:04d}{extension}")
+        image.save(path, format=file_format.upper(), **SAVE_OPTIONS[file_format])
+        with open(path, "rb") as f:
+            digest.update(f.read())
+        paths.append(path)
+        previous = image
+    return paths, digest.hexdigest()
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)), 2) if values else None
+
+
+def summarize(metrics):
+    """Reduces a run_metrics sidecar (see run_metrics.write_sidecar) to the numbers the suite reports."""
+    latencies = [sum(value for key, value in row.items() if key.endswith("_ms")) for row in metrics["per_image"]]
+    startup = sum(metrics["startup"].values())
+    # Model loading happens inside the run; throughput is what's left
+    busy = max(metrics["elapsed_seconds"] - startup, 1e-9)
+    return OrderedDict([
+        ("images", metrics["images"]),
+        ("images_per_second", round(metrics["images"] / busy, 2)),
+        ("latency_p50_ms", _percentile(latencies, 50)),
+        ("latency_p95_ms", _percentile(latencies, 95)),
+        ("startup_seconds", round(startup, 3)),
+        ("elapsed_seconds", metrics["elapsed_seconds"]),
+        ("peak_rss_mb", metrics["peak_rss_mb"]),
+        ("stages", OrderedDict((stage, values["ms_per_photo"]) for stage, values in metrics["stages"].items())),
+    ])
+
+
+def run_script_case(module_name, arguments, paths_file, work_dir):
+    """Runs a classifier script's main() on the corpus (stdout discarded) and returns its metrics sidecar."""
+    engine = importlib.import_module(module_name)
+    metrics_file = os.path.join(work_dir, "metrics.json")
+    sys.argv = [f"{module_name}.py", paths_file, *arguments, "--no-cache",
+                "--cache-dir", os.path.join(work_dir, "cache"), "--metrics", metrics_file]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        engine.main()
+    with open(metrics_file, "r") as f:
+        return json.load(f)
+
+
+def run_server_case(request, paths_file, work_dir):
+    """
+    Serves the tagging server in-process and posts the plugin's /classify request
+    twice; returns the warm request's metrics sidecar plus both round-trip times.
+    """
+    import tagging_server
+
+    # No caches, so the warm request decodes and encodes every photo again
+    tagging_server._caches.update(clip=None, blip=None, photo_index=None)
+    server = tagging_server.TaggingServer(("127.0.0.1", 0), idle_timeout=3600)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/classify"
+
+    metrics_file = os.path.join(work_dir, "metrics.json")
+    body = json.dumps(dict(request, json_file=paths_file, output_file=os.path.join(work_dir, "output.ndjson"),
+                           metrics_file=metrics_file)).encode("utf-8")
+    round_trips = []
+    try:
+        for _ in range(2):
+            start = time.perf_counter()
+            post = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json",
+                                                                   tagging_server.TOKEN_HEADER: server.token})
+            with urllib.request.urlopen(post, timeout=3600) as response:
+                json.load(response)
+            round_trips.append(time.perf_counter() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with open(metrics_file, "r") as f:
+        metrics = json.load(f)
+    # The cold request paid for loading the models; the sidecar only covers the warm one
+    import model_registry
+    metrics["startup"] = dict(model_registry.timings)
+    metrics["round_trip_seconds"] = {"cold": round(round_trips[0], 3), "warm": round(round_trips[1], 3)}
+    return metrics
+
+
+def worker(case, paths_file, models_dir):
+    """Runs one case in this (fresh) process and prints its summary as one JSON line."""
+    if models_dir:
+        tiny_models.install(models_dir)
+    with tempfile.TemporaryDirectory() as work_dir:
+        if case in SCRIPT_CASES:
+            metrics = run_script_case(*SCRIPT_CASES[case], paths_file, work_dir)
+        else:
+            metrics = run_server_case(SERVER_CASES[case], paths_file, work_dir)
+    result = summarize(metrics)
+    if "round_trip_seconds" in metrics:
+        result["round_trip_seconds"] = metrics["round_trip_seconds"]
+        # The warm round trip is what a click on "Categorize Photos" costs with the server running
+        result["images_per_second"] = round(metrics["images"] / metrics["round_trip_seconds"]["warm"], 2)
+    print(json.dumps(result))
+
+
+def run_worker(case, paths_file, models_dir):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", case, "--paths-file", paths_file]
+    if models_dir:
+        command += ["--tiny-models-dir", models_dir]
+    start = time.perf_counter()
+    completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"case {case} failed:\n{completed.stderr}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1], object_pairs_hook=OrderedDict)
+    # Includes starting Python and importing everything, as a launch from Lightroom does
+    result["wall_seconds"] = round(wall, 3)
+    return result
+
+
+def environment(models):
+    info = OrderedDict([
+        ("platform", platform.platform()),
+        ("machine", platform.machine()),
+        ("cpus", os.cpu_count()),
+        ("python", platform.python_version()),
+        ("models", models),
+    ])
+    # Read from the package metadata, without importing anything
+    for package in ("torch", "transformers", "sentence-transformers", "pillow", "pillow-heif"):
+        try:
+            info[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            info[package] = None
+    return info
+
+
+def compare(report, baseline, thresholds):
+    """Returns (lines describing each case against the baseline, list of regressions)."""
+    lines = []
+    regressions = []
+    for key in ("models", "cpus", "machine"):
+        if baseline["environment"].get(key) != report["environment"].get(key):
+            lines.append(f"warning: baseline {key} is {baseline['environment'].get(key)!r}, "
+                         f"this run's {report['environment'].get(key)!r}")
+    if baseline["corpus"] != report["corpus"]:
+        lines.append("warning: the baseline was measured on another corpus")
+
+    for case, result in report["cases"].items():
+        reference = baseline["cases"].get(case)
+        if reference is None:
+            lines.append(f"{case}: not in the baseline")
+            continue
+        for metric, (higher_is_better, flag) in GATED_METRICS.items():
+            now, before = result.get(metric), reference.get(metric)
+            if not now or not before:
+                continue
+            change = now / before - 1
+            worse = -change if higher_is_better else change
+            status = "ok"
+            if worse > thresholds[flag]:
+                status = "REGRESSION"
+                regressions.append(f"{case} {metric}: {before} -> {now}")
+            lines.append(f"{case:<14} {metric:<18} {before:>10} -> {now:>10} ({100 * change:+6.1f}%)  {status}")
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tagging pipeline and gate on regressions.")
+    parser.add_argument("--models", choices=("real", "tiny"), default="real",
+                        help="real: the classifiers' models (must be cached); tiny: random-weight stand-ins, offline")
+    parser.add_argument("--tiny-models-dir", default=None,
+                        help="Where the tiny stand-ins are written and reused (default: tiny-models in the cache directory)")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument("--count", type=int, default=24, help="Number of synthetic photos (default: 24)")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus seed (default: 0)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per case; the median by images/sec is reported (default: 3)")
+    parser.add_argument("--output", default=None, help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", default=None, help="Compare against this stored report")
+    parser.add_argument("--save-baseline", default=None, help="Store this run's report as a baseline here")
+    parser.add_argument("--max-throughput-drop", type=float, default=0.10,
+                        help="Fail if images/sec drops by more than this fraction (default: 0.10)")
+    parser.add_argument("--max-latency-growth", type=float, default=0.15,
+                        help="Fail if p95 per-photo latency grows by more than this fraction (default: 0.15)")
+    parser.add_argument("--max-startup-growth", type=float, default=0.25,
+                        help="Fail if startup time grows by more than this fraction (default: 0.25)")
+    parser.add_argument("--max-rss-growth", type=float, default=0.10,
+                        help="Fail if peak RSS grows by more than this fraction (default: 0.10)")
+    parser.add_argument("--worker", choices=CASES, help=argparse.SUPPRESS)
+    parser.add_argument("--paths-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.paths_file, args.tiny_models_dir)
+        return
+    if args.count < 1 or args.repeat < 1:
+        parser.error("--count and --repeat must be at least 1")
+
+    models_dir = None
+    if args.models == "tiny":
+        # Built in a child process, which imports torch and transformers
+        models_dir = args.tiny_models_dir or DEFAULT_TINY_MODELS_DIR
+        subprocess.run([sys.executable, tiny_models.__file__, models_dir], check=True, stdout=subprocess.DEVNULL)
+
+    report = OrderedDict([
+        ("version", REPORT_VERSION),
+        ("environment", environment(args.models)),
+        ("corpus", None),
+        ("cases", OrderedDict()),
+    ])
+    with tempfile.TemporaryDirectory() as folder:
+        paths, digest = write_corpus(folder, args.count, args.seed)
+        paths_file = os.path.join(folder, "photo_paths.ndjson")
+        with open(paths_file, "w") as f:
+            for path in paths:
+                f.write(json.dumps(path) + "\n")
+        report["corpus"] = OrderedDict([("count", args.count), ("seed", args.seed), ("sha1", digest)])
+
+        for case in args.cases:
+            runs = [run_worker(case, paths_file, models_dir) for _ in range(args.repeat)]
+            runs.sort(key=lambda run: run["images_per_second"])
+            result = runs[len(runs) // 2]
+            result["runs"] = len(runs)
+            result["images_per_second_spread"] = [runs[0]["images_per_second"], runs[-1]["images_per_second"]]
+            report["cases"][case] = result
+            print(f"{case:<14} {result['images_per_second']:8.2f} img/s  p50 {result['latency_p50_ms']:8.1f} ms  "
+                  f"p95 {result['latency_p95_ms']:8.1f} ms  startup {result['startup_seconds']:6.2f}s  "
+                  f"peak RSS {result['peak_rss_mb']:7.0f} MB", file=sys.stderr)
+
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(text + "\n")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        lines, regressions = compare(report, baseline, vars(args))
+        for line in lines:
+            print(line, file=sys.stderr)
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.baseline}", file=sys.stderr)
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
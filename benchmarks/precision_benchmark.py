@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Accuracy drift, peak RSS and latency of --precision int8 vs fp32.
+
+Each (engine, precision) pair runs in its own subprocess, so peak RSS covers
+exactly one set of loaded models. The fixture set is the given images, or
+deterministic synthetic ones written to a temporary folder. Drift is reported
+as top-1 tag agreement with the fp32 run of the same engine.
+
+Usage: python benchmarks/precision_benchmark.py [--engines clip blip] [--images a.jpg ...] [--count 16]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The classifiers live in the plugin folder, not in an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LightroomDeepTag.lrplugin"))
+
+ENGINE_MODULES = {
+    "clip": "clip_classifier",
+    "blip": "blip_classifier",
+}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def worker(engine_name, precision, image_paths):
+    """Loads one engine at one precision, tags the fixture set and prints a JSON report."""
+    import importlib
+
+    start = time.perf_counter()
+    engine = importlib.import_module(ENGINE_MODULES[engine_name])
+    engine.use_precision(precision)
+    load_seconds = time.perf_counter() - start
+
+    # Warm up on one image so lazy initialisation isn't timed
+    engine.classify_image(image_paths[0])
+
+    start = time.perf_counter()
+    results = engine.classify_images(image_paths)
+    elapsed = time.perf_counter() - start
+
+    top1 = []
+    for tags in results:
+        tag = tags[0] if tags else None
+        top1.append(tag[0] if isinstance(tag, (list, tuple)) else tag)
+
+    print(json.dumps({
+        "engine": engine_name,
+        "precision": engine.precision,
+        "load_seconds": load_seconds,
+        "seconds_per_image": elapsed / len(image_paths),
+        "peak_rss_mb": peak_rss_mb(),
+        "top1": top1,
+    }))
+
+
+def write_fixtures(folder, count):
+    from clip_batch_benchmark import synthetic_images
+
+    paths = []
+    for i, image in enumerate(synthetic_images(count)):
+        path = os.path.join(folder, f"fixture_{i:03d}.jpg")
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def run_worker(engine_name, precision, image_paths):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", engine_name, precision, "--images", *image_paths]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare int8 and fp32 precision: drift, peak RSS, latency.")
+    parser.add_argument("--engines", nargs="+", choices=sorted(ENGINE_MODULES), default=["clip", "blip"])
+    parser.add_argument("--images", nargs="*", default=[], help="Fixture images (default: synthetic)")
+    parser.add_argument("--count", type=int, default=16, help="Number of synthetic images (default: 16)")
+    parser.add_argument("--worker", nargs=2, metavar=("ENGINE", "PRECISION"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker[0], args.worker[1], args.images)
+        return
+
+    with tempfile.TemporaryDirectory() as folder:
+        image_paths = args.images or write_fixtures(folder, args.count)
+        print(f"images={len(image_paths)}")
+        print(f"{'engine':<6} {'precision':<9} {'peak RSS':>10} {'load':>8} {'per image':>10}  top-1 agreement")
+        for engine_name in args.engines:
+            baseline = None
+            for precision in ("fp32", "int8"):
+                report = run_worker(engine_name, precision, image_paths)
+                if baseline is None:
+                    baseline = report
+                matched = sum(a == b for a, b in zip(baseline["top1"], report["top1"]))
+                print(f"{engine_name:<6} {report['precision']:<9} {report['peak_rss_mb']:8.0f}MB "
+                      f"{report['load_seconds']:7.2f}s {report['seconds_per_image']:9.3f}s  "
+                      f"{matched}/{len(image_paths)}")
+
+
+if __name__ == "__main__":
+    main()
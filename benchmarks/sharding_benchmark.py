@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Images/sec against worker count for sharded execution (process_pool.py).
+
+Tags the same fixture set in-process (one process, all cores) and then with
+process_pool.iter_sharded at each worker count, every worker getting
+cores / workers torch threads. Caches are off throughout, so every run
+decodes and encodes every image.
+
+Usage: python benchmarks/sharding_benchmark.py [--engine clip|blip|hybrid] [--workers 1 2 4 8] [--images a.jpg ...] [--count 64]
+"""
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The classifiers live in the plugin folder, not in an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LightroomDeepTag.lrplugin"))
+
+import process_pool
+from precision_benchmark import write_fixtures
+
+ENGINE_MODULES = {
+    "clip": "clip_classifier",
+    "blip": "blip_classifier",
+    "hybrid": "hybrid_classifier",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sharded throughput across worker counts.")
+    parser.add_argument("--engine", choices=sorted(ENGINE_MODULES), default="clip")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--images", nargs="*", default=[], help="Fixture images (default: synthetic)")
+    parser.add_argument("--count", type=int, default=64, help="Number of synthetic images (default: 64)")
+    parser.add_argument("--chunk-size", type=int, default=8, help="Paths per worker task (default: 8)")
+    args = parser.parse_args()
+
+    module_name = ENGINE_MODULES[args.engine]
+    engine = importlib.import_module(module_name)
+
+    with tempfile.TemporaryDirectory() as folder:
+        image_paths = args.images or write_fixtures(folder, args.count)
+        engine.load_models()
+        # Warm up once so lazy initialisation isn't timed
+        list(engine.iter_classify_images(image_paths[:1]))
+
+        start = time.perf_counter()
+        list(engine.iter_classify_images(image_paths))
+        baseline = len(image_paths) / (time.perf_counter() - start)
+
+        print(f"engine={args.engine} images={len(image_paths)} cores={os.cpu_count()}")
+        print(f"{'workers':>8} {'threads':>8} {'images/sec':>11} {'speedup':>8}")
+        print(f"{'in-proc':>8} {os.cpu_count():>8} {baseline:11.2f} {1.0:7.2f}x")
+        for workers in args.workers:
+            # Includes starting the pool: that's what a run pays, too
+            start = time.perf_counter()
+            results = list(process_pool.iter_sharded(module_name, image_paths, workers=workers,
+                                                     chunk_size=args.chunk_size))
+            rate = len(results) / (time.perf_counter() - start)
+            print(f"{workers:>8} {process_pool.default_threads(workers):>8} {rate:11.2f} {rate / baseline:7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Tiny random-weight stand-ins for CLIP, BLIP and MiniLM, so the benchmarks run
+offline and in seconds (e.g. on CI) when the real weights aren't cached.
+
+The stand-ins have the real models' architectures and input sizes with a
+fraction of the layers and widths: decoding, preprocessing, batching and
+the pipeline around the models are exercised as usual, model time is not
+representative and tags are meaningless. build() writes them to a folder;
+install() points the classifier modules at them (no network access needed).
+
+Usage: python benchmarks/tiny_models.py FOLDER
+"""
+import os
+import sys
+
+# Shared by the BLIP tokenizer and the MiniLM stand-in
+VOCABULARY = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[DEC]"] + (
+    "a photo of the cat dog tree city night snow water flower person house light shadow "
+    "leaves with and in on at is . , street mountain lake river"
+).split()
+
+CLIP_FILE = "clip_tiny.pt"
+BLIP_DIR = "blip_tiny"
+MINILM_DIR = "minilm_tiny"
+
+
+def build(folder, seed=0):
+    """Writes the stand-ins to folder (once; an existing set is reused). Returns folder."""
+    if all(os.path.exists(os.path.join(folder, name)) for name in (CLIP_FILE, BLIP_DIR, MINILM_DIR)):
+        return folder
+    os.makedirs(folder, exist_ok=True)
+
+    import torch
+    from clip.model import CLIP
+    from transformers import (BertConfig, BertModel, BertTokenizer, BlipConfig, BlipForConditionalGeneration,
+                              BlipImageProcessor, BlipProcessor)
+
+    torch.manual_seed(seed)
+    clip_model = CLIP(embed_dim=32, image_resolution=224, vision_layers=2, vision_width=64, vision_patch_size=32,
+                      context_length=77, vocab_size=49408, transformer_width=64, transformer_heads=1,
+                      transformer_layers=2).eval()
+    # Saved as TorchScript, the format clip.load() reads from a file: it rebuilds
+    # the eager model from the archive's weights
+    example = (torch.zeros(1, 3, 224, 224), torch.zeros(1, 77, dtype=torch.long))
+    torch.jit.trace(clip_model, example, check_trace=False).save(os.path.join(folder, CLIP_FILE))
+
+    vocabulary_file = os.path.join(folder, "vocab.txt")
+    with open(vocabulary_file, "w") as f:
+        f.write("\n".join(VOCABULARY) + "\n")
+    tokenizer = BertTokenizer(vocabulary_file, bos_token="[DEC]")
+
+    blip_config = BlipConfig(
+        text_config=dict(vocab_size=len(VOCABULARY), hidden_size=32, encoder_hidden_size=32, intermediate_size=64,
+                         num_attention_heads=2, num_hidden_layers=2, bos_token_id=5, pad_token_id=0,
+                         sep_token_id=3, eos_token_id=3),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_attention_heads=2, num_hidden_layers=2,
+                           image_size=384, patch_size=32),
+    )
+    blip_dir = os.path.join(folder, BLIP_DIR)
+    BlipProcessor(image_processor=BlipImageProcessor(), tokenizer=tokenizer).save_pretrained(blip_dir)
+    BlipForConditionalGeneration(blip_config).save_pretrained(blip_dir)
+
+    minilm_dir = os.path.join(folder, MINILM_DIR)
+    BertModel(BertConfig(vocab_size=len(VOCABULARY), hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                         intermediate_size=64)).save_pretrained(minilm_dir)
+    tokenizer.save_pretrained(minilm_dir)
+    return folder
+
+
+def install(folder):
+    """Points clip_classifier and blip_classifier at the stand-ins in folder; call before any model is loaded."""
+    import blip_classifier
+    import clip_classifier
+
+    # clip.load() accepts a checkpoint path in place of a model name
+    clip_classifier.MODEL_NAME = os.path.join(folder, CLIP_FILE)
+    blip_classifier.BLIP_MODEL_NAME = os.path.join(folder, BLIP_DIR)
+    blip_classifier.SIMILARITY_MODEL_NAME = os.path.join(folder, MINILM_DIR)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(__doc__.strip().splitlines()[-1])
+    print(build(sys.argv[1]))
@@ -38,17 +38,19 @@ categories = [
 ]
 
 
+# Convert categories to CLIP input format and encode them once, not per image
+text_inputs = clip.tokenize(categories).to(device)
+with torch.no_grad():
+    text_features = model.encode_text(text_inputs)
+
+
 def classify_image(image_path):
     """Classifies an image using CLIP and returns the best matching categories."""
     image = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
 
-    # Convert categories to CLIP input format
-    text_inputs = clip.tokenize(categories).to(device)
-
-    # Run image and text through CLIP model
+    # Run the image through CLIP model
     with torch.no_grad():
         image_features = model.encode_image(image)
-        text_features = model.encode_text(text_inputs)
 
     # Compute cosine similarity between image and category descriptions
     similarities = (image_features @ text_features.T).squeeze(0)
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import numpy as np
+
+# The modules live in the plugin folder, not in an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LightroomDeepTag.lrplugin"))
+
+import embedding_cache  # noqa: E402
+
+DIM = 8
+
+
+def open_cache(tmp_path, capacity=4):
+    return embedding_cache.EmbeddingCache("test-model", DIM, cache_dir=str(tmp_path), max_mb=capacity * DIM * 2 / (1 << 20))
+
+
+def vector(value):
+    return np.full(DIM, value, dtype=np.float16)
+
+
+def test_reopen_hits_saved_entries(tmp_path):
+    cache = open_cache(tmp_path)
+    cache.put(None, vector(1), key="a", meta={"caption": "a dog"})
+    cache.close()
+
+    cache = open_cache(tmp_path)
+    found, meta = cache.get_entry(None, key="a")
+    assert np.array_equal(found, vector(1))
+    assert meta == {"caption": "a dog"}
+    cache.close()
+
+
+def test_evicted_key_misses_after_crash_before_save(tmp_path):
+    cache = open_cache(tmp_path)
+    for i, key in enumerate("abcd"):
+        cache.put(None, vector(i), key=key)
+    cache.save()
+
+    # Full: "a" is evicted and its slot reused, then the process dies before save()
+    cache.put(None, vector(9), key="e")
+    cache._lock_file.close()
+    del cache
+
+    cache = open_cache(tmp_path)
+    assert cache.get(None, key="a") is None
+    for i, key in enumerate("bcd", start=1):
+        assert np.array_equal(cache.get(None, key=key), vector(i))
+    cache.close()